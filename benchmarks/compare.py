@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.compare
+    ~~~~~~~~~~~~~~~~~~
+
+    Compares two benchmarks/suite.py reports and exits with status 1 when a
+    case got slower than --threshold percent:
+
+        $ python benchmarks/compare.py before.json after.json --threshold 10
+
+    Only reports taken with the same backend on the same machine are worth
+    comparing.
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(base, current, threshold):
+    """ Returns a list of (case, base median, current median, change
+        percent, regressed) tuples for the cases in both reports.
+    """
+    rows = []
+    for name in sorted(set(base['results']) & set(current['results'])):
+        before = base['results'][name]['median_us']
+        after = current['results'][name]['median_us']
+        change = (after - before) / before * 100 if before else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compares two benchmark reports.')
+    parser.add_argument('base')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='slowdown, in percent, reported as a '
+                        'regression.')
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    for key in ('backend', 'machine', 'python', 'bcrypt_rounds'):
+        if base['meta'].get(key) != current['meta'].get(key):
+            print('warning: %s differs (%s, %s)' % (
+                key, base['meta'].get(key), current['meta'].get(key)))
+
+    rows = compare(base, current, args.threshold)
+    print('%-20s %12s %12s %9s' % ('case', 'base us', 'current us',
+                                   'change'))
+    for name, before, after, change, regressed in rows:
+        print('%-20s %12.2f %12.2f %+8.1f%%%s' % (
+            name, before, after, change, '  REGRESSION' if regressed else ''))
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
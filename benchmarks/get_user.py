@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.get_user
+    ~~~~~~~~~~~~~~~~~~~
+
+    Compares the latency of Storage.get_user with the former implementation,
+    which issued a second query matching the computed hash, under concurrent
+    load. Needs a MongoDB server:
+
+        $ python benchmarks/get_user.py --uri mongodb://localhost:27017/bench
+
+    Users are hashed with a low bcrypt cost (see --rounds) so that database
+    round trips are not dwarfed by hashing.
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import threading
+
+import bcrypt
+from flask import Flask
+
+from flask_sentinel import ResourceOwnerPasswordCredentials
+from flask_sentinel.core import mongo
+from flask_sentinel.data import Storage, _from_json
+from flask_sentinel.models import User
+
+try:
+    from time import perf_counter as timer
+except ImportError:
+    # Python 2.
+    from timeit import default_timer as timer
+
+
+def legacy_get_user(username, password):
+    user = mongo.db.users.find_one({'username': username})
+    if user and password:
+        encoded_pw = password.encode('utf-8')
+        user_hash = user['hashpw']
+        if not isinstance(user_hash, bytes):
+            user_hash = user_hash.encode('utf-8')
+        user = mongo.db.users.find_one({
+            'username': username,
+            'hashpw': bcrypt.hashpw(encoded_pw, user_hash)
+        })
+    return _from_json(user, User)
+
+
+def run(app, func, users, threads, calls):
+    """ Runs `calls` lookups on each of `threads` threads and returns the
+        sorted latencies along with the elapsed time.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(n):
+        with app.app_context():
+            timings = []
+            for i in range(calls):
+                username, password = users[(n + i) % len(users)]
+                start = timer()
+                func(username, password)
+                timings.append(timer() - start)
+        with lock:
+            latencies.extend(timings)
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    start = timer()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sorted(latencies), timer() - start
+
+
+def report(name, latencies, elapsed):
+    def ms(p):
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * p))] * 1000
+    print('%-10s %8d %10.2f %10.2f %10.2f %10.1f' % (
+        name, len(latencies), ms(0.5), ms(0.95), ms(0.99),
+        len(latencies) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Storage.get_user latency under concurrent load.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/bench')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=4,
+                        help='bcrypt cost of the generated users.')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SENTINEL_MONGO_URI'] = args.uri
+    ResourceOwnerPasswordCredentials(app)
+
+    with app.app_context():
+        mongo.db.users.drop()
+        users = []
+        for n in range(args.users):
+            username, password = 'user%d' % n, 'pw%d' % n
+            hashpw = bcrypt.hashpw(password.encode('utf-8'),
+                                   bcrypt.gensalt(args.rounds))
+            mongo.db.users.insert({'username': username, 'hashpw': hashpw})
+            # half of the lookups use a wrong password.
+            users.append((username, password if n % 2 else 'wrong'))
+
+    print('%-10s %8s %10s %10s %10s %10s' % (
+        'impl', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/s'))
+    for name, func in (('legacy', legacy_get_user),
+                       ('current', Storage.get_user)):
+        report(name, *run(app, func, users, args.threads, args.calls))
+
+    with app.app_context():
+        mongo.db.users.drop()
+
+
+if __name__ == '__main__':
+    main()
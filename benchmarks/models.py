@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.models
+    ~~~~~~~~~~~~~~~~~
+
+    Compares per-instance memory and attribute access cost of the slotted
+    models with the former property-based ones. Needs no database:
+
+        $ python benchmarks/models.py
+
+    Memory is measured with tracemalloc (Python 3.4+).
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from flask_sentinel.models import Token, User
+
+
+class LegacyBaseModel(object):
+    def __init__(self, id=None):
+        self._id = id
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+
+class LegacyUser(LegacyBaseModel):
+    def __init__(self, id=None, username=None, hashpw=None):
+        super(LegacyUser, self).__init__(id)
+        self._username = username
+        self._hashpw = hashpw
+
+    @property
+    def username(self):
+        return self._username
+
+    @username.setter
+    def username(self, value):
+        self._username = value
+
+    @property
+    def hashpw(self):
+        return self._hashpw
+
+    @hashpw.setter
+    def hashpw(self, value):
+        self._hashpw = value
+
+
+class LegacyToken(LegacyBaseModel):
+    def __init__(self, id=None, client_id=None, user_id=None, user=None,
+                 token_type=None, access_token=None, refresh_token=None,
+                 expires=None, scopes=['']):
+        super(LegacyToken, self).__init__(id)
+        self._client_id = client_id
+        self._user_id = user_id
+        self._user = None
+        self._token_type = token_type
+        self._access_token = access_token
+        self._refresh_token = refresh_token
+        self._expires = expires
+        self._scopes = scopes
+
+    @property
+    def client_id(self):
+        return self._client_id
+
+    @property
+    def user_id(self):
+        return self._user_id
+
+    @property
+    def user(self):
+        return self._user
+
+    @property
+    def token_type(self):
+        return self._token_type
+
+    @property
+    def access_token(self):
+        return self._access_token
+
+    @property
+    def refresh_token(self):
+        return self._refresh_token
+
+    @property
+    def expires(self):
+        return self._expires.replace(tzinfo=None)
+
+    @property
+    def scopes(self):
+        return self._scopes
+
+
+def memory(factory, count):
+    """ Returns the number of bytes allocated per instance. """
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objs = [factory(n) for n in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del objs
+    return float(size) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Models benchmark.')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    # field values are shared, so that only the instances are measured.
+    expires = datetime.utcnow()
+    samples = [
+        ('User', lambda n: LegacyUser(n, 'user', 'hash'),
+         lambda n: User(n, 'user', 'hash'), ('username', 'hashpw')),
+        ('Token', lambda n: LegacyToken(n, 'client', n, None, 'Bearer',
+                                        'access', 'refresh', expires),
+         lambda n: Token(n, 'client', n, None, 'Bearer', 'access',
+                         'refresh', expires),
+         ('access_token', 'expires')),
+    ]
+
+    print('%-6s %-14s %12s %12s' % ('model', 'measure', 'legacy', 'current'))
+    for name, legacy, current, fields in samples:
+        print('%-6s %-14s %12.1f %12.1f' % (
+            name, 'bytes/object', memory(legacy, args.count),
+            memory(current, args.count)))
+        for field in fields:
+            timings = [min(timeit.repeat('obj.%s' % field, number=args.number,
+                                         repeat=5, globals={'obj': f(0)})) /
+                       args.number * 1e9 for f in (legacy, current)]
+            print('%-6s %-14s %12.1f %12.1f' % (
+                name, '%s ns' % field, timings[0], timings[1]))
+
+
+if __name__ == '__main__':
+    main()
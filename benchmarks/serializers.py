@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.serializers
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the compiled _from_json/_to_json serializers with the former,
+    inspect-based ones, and checks that both give the same results. Needs no
+    database:
+
+        $ python benchmarks/serializers.py
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import inspect
+import timeit
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from flask_sentinel.data import _from_json, _to_json, id
+from flask_sentinel.models import Client, Token, User
+
+
+def legacy_properties(obj, include_id=False):
+    return [
+        name for (name, value) in inspect.getmembers(
+            obj.__class__, lambda p: isinstance(p, property)
+        ) if name != id.cls or include_id
+    ]
+
+
+def legacy_from_json(json, cls, as_list=False):
+    if json is None:
+        return None
+
+    if not isinstance(json, list):
+        json = [json]
+
+    objs = []
+    for json_item in json:
+        obj = cls()
+
+        properties, json_keys = set(legacy_properties(obj)), \
+            set(json_item.keys())
+        for property in set.intersection(properties, json_keys):
+            try:
+                setattr(obj, property, json_item[property])
+            except AttributeError:
+                pass
+
+        if id.collection in json_item and json_item[id.collection] is not None:
+            setattr(obj, id.cls, json_item[id.collection])
+
+        objs.append(obj)
+
+    return objs if as_list else (objs.pop() if len(objs) else None)
+
+
+def legacy_to_json(obj):
+    json = {}
+    for prop in legacy_properties(obj):
+        json[prop] = getattr(obj, prop)
+
+    objid = getattr(obj, id.cls)
+    if objid is not None:
+        json[id.collection] = objid
+
+    return json
+
+
+SAMPLES = [
+    (User, User(id=ObjectId(), username='user', hashpw=b'$2b$12$hash')),
+    (Client, Client(id=ObjectId(), client_id='a' * 40,
+                    client_type='public')),
+    (Token, Token(id=ObjectId(), client_id='a' * 40, user_id=ObjectId(),
+                  token_type='Bearer', access_token='b' * 30,
+                  refresh_token='c' * 30, expires=datetime.utcnow())),
+]
+
+
+def check():
+    """ Makes sure both implementations give the same results. """
+    for cls, obj in SAMPLES:
+        json = legacy_to_json(obj)
+        assert _to_json(obj) == json, cls
+        assert _to_json(_from_json(json, cls)) == \
+            legacy_to_json(legacy_from_json(json, cls)), cls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serializers microbenchmark.')
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    check()
+    print('%-8s %-10s %12s %12s %8s' % (
+        'model', 'function', 'legacy us', 'current us', 'speedup'))
+    for cls, obj in SAMPLES:
+        json = _to_json(obj)
+        for name, legacy, current in (
+                ('to_json', lambda: legacy_to_json(obj),
+                 lambda: _to_json(obj)),
+                ('from_json', lambda: legacy_from_json(json, cls),
+                 lambda: _from_json(json, cls))):
+            timings = [min(timeit.repeat(f, number=args.number,
+                                         repeat=args.repeat)) /
+                       args.number * 1e6 for f in (legacy, current)]
+            print('%-8s %-10s %12.2f %12.2f %7.1fx' % (
+                cls.__name__, name, timings[0], timings[1],
+                timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.suite
+    ~~~~~~~~~~~~~~~~
+
+    Times the token issuance and validation hot paths and writes a JSON
+    report which benchmarks/compare.py can check for regressions:
+
+        $ python benchmarks/suite.py --output before.json
+        $ python benchmarks/suite.py --output after.json
+        $ python benchmarks/compare.py before.json after.json
+
+    Runs against local MongoDB and Redis servers when both are reachable,
+    and against in-process stand-ins (mongomock and fakeredis, see
+    dev-requirements.txt) otherwise, see --backend. The --uri database is
+    dropped before and after the run.
+    Timings of different backends are not comparable; neither are timings
+    taken on different machines.
+
+    Every case is run --repeat times, --number calls each, after a warm up
+    round and with the garbage collector disabled. The median of the
+    repeats is what compare.py looks at.
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+from datetime import datetime
+
+import bcrypt
+from flask import Flask
+from werkzeug.security import gen_salt
+
+from flask_sentinel import ResourceOwnerPasswordCredentials
+from flask_sentinel.core import mongo, oauth
+from flask_sentinel.data import Storage, _from_json, _to_json
+from flask_sentinel.models import Token, User
+
+try:
+    from time import perf_counter as timer
+except ImportError:
+    # Python 2.
+    from timeit import default_timer as timer
+
+# cases which hash a password, and are much slower than the others.
+SLOW = ('get_user', 'token_endpoint')
+
+
+class Request(object):
+    """ Stand-in for the oauthlib request handed to Storage.save_token. """
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+
+
+def servers_available(uri, redis_url):
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    from redis import StrictRedis
+    from redis.exceptions import RedisError
+    try:
+        MongoClient(uri, serverSelectionTimeoutMS=500).admin.command('ping')
+        StrictRedis.from_url(redis_url, socket_timeout=0.5).ping()
+    except (PyMongoError, RedisError):
+        return False
+    return True
+
+
+def use_stand_ins():
+    """ Replaces the MongoDB and Redis clients with in-process stand-ins.
+    """
+    import fakeredis
+    import flask_pymongo
+    import mongomock
+    from redis.connection import ConnectionPool
+
+    class MongoClient(mongomock.MongoClient):
+        # Flask-PyMongo passes options mongomock knows nothing about.
+        def __init__(self, host=None, port=None, **kwargs):
+            super(MongoClient, self).__init__(host, port)
+
+    flask_pymongo.MongoClient = MongoClient
+    server = fakeredis.FakeServer()
+    ConnectionPool.from_url = classmethod(
+        lambda cls, url, **kwargs:
+        fakeredis.FakeStrictRedis(server=server).connection_pool)
+
+
+def setup(args):
+    app = Flask(__name__)
+    app.config.update({
+        'SENTINEL_MONGO_URI': args.uri,
+        'SENTINEL_REDIS_URL': args.redis_url,
+        'SENTINEL_MANAGEMENT_URL': False,
+    })
+    sentinel = ResourceOwnerPasswordCredentials(app)
+
+    @app.route('/protected')
+    @oauth.require_oauth()
+    def protected():
+        return 'ok'
+
+    with app.app_context():
+        mongo.cx.drop_database(mongo.db.name)
+        sentinel.ensure_indexes()
+        client = Storage.generate_client()
+        hashpw = bcrypt.hashpw(b'pw', bcrypt.gensalt(args.rounds))
+        user = User(username='user', hashpw=hashpw)
+        user.id = mongo.db.users.insert(_to_json(user))
+    return app, client, user
+
+
+def cases(app, client, user):
+    """ Returns a list of (name, setup) tuples, setup returning the function
+        to time. Setups run within an app context.
+    """
+    test_client = app.test_client()
+    grant = '/oauth/token?client_id=%s&grant_type=password&username=user' \
+        '&password=pw' % client.client_id
+
+    def issue():
+        r = test_client.post(grant)
+        assert r.status_code == 200, r.status_code
+        return json.loads(r.get_data(as_text=True))
+
+    def get_user():
+        return lambda: Storage.get_user('user', 'pw')
+
+    def get_token():
+        access_token = issue()['access_token']
+        return lambda: Storage.get_token(access_token=access_token)
+
+    def get_token_db():
+        # refresh tokens are always looked up in MongoDB.
+        refresh_token = issue()['refresh_token']
+        return lambda: Storage.get_token(refresh_token=refresh_token)
+
+    def save_token():
+        request = Request(client, user)
+
+        def save():
+            Storage.save_token({'token_type': 'Bearer',
+                                'access_token': gen_salt(30),
+                                'refresh_token': gen_salt(30),
+                                'expires_in': 3600}, request)
+        return save
+
+    def to_json():
+        token = Storage.get_token(access_token=issue()['access_token'])
+        return lambda: _to_json(token)
+
+    def from_json():
+        json = mongo.db.tokens.find_one()
+        return lambda: _from_json(json, Token)
+
+    def token_endpoint():
+        return issue
+
+    def protected_endpoint():
+        headers = [('Authorization', 'Bearer %s' % issue()['access_token'])]
+
+        def protected():
+            r = test_client.get('/protected', headers=headers)
+            assert r.status_code == 200, r.status_code
+        return protected
+
+    return [(f.__name__, f) for f in (
+        get_user, get_token, get_token_db, save_token, to_json, from_json,
+        token_endpoint, protected_endpoint)]
+
+
+def measure(func, number, repeat):
+    """ Returns the per call timings, in microseconds, of `repeat` rounds of
+        `number` calls, after a warm up round.
+    """
+    for n in range(number):
+        func()
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for r in range(repeat):
+            start = timer()
+            for n in range(number):
+                func()
+            timings.append((timer() - start) / number * 1e6)
+    finally:
+        if enabled:
+            gc.enable()
+    return sorted(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Token issuance and validation benchmarks.')
+    parser.add_argument('--backend', choices=('auto', 'live', 'fake'),
+                        default='auto',
+                        help='"live" servers, in-process "fake" ones, or '
+                        'live ones when reachable (default).')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/bench')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--number', type=int, default=200,
+                        help='calls per round.')
+    parser.add_argument('--repeat', type=int, default=7,
+                        help='rounds per case.')
+    parser.add_argument('--rounds', type=int, default=4,
+                        help='bcrypt cost of the benchmark user.')
+    parser.add_argument('--only', nargs='*',
+                        help='names of the cases to run.')
+    parser.add_argument('--output', help='JSON report path.')
+    args = parser.parse_args(argv)
+
+    backend = args.backend
+    if backend == 'auto':
+        backend = 'live' if servers_available(args.uri, args.redis_url) \
+            else 'fake'
+    if backend == 'fake':
+        use_stand_ins()
+
+    app, client, user = setup(args)
+    results = {}
+    print('%-20s %8s %12s %12s %12s' % (
+        'case', 'calls', 'min us', 'median us', 'calls/s'))
+    for name, setup_case in cases(app, client, user):
+        if args.only and name not in args.only:
+            continue
+        # password hashing cases get fewer calls.
+        number = max(1, args.number // 10) if name in SLOW else args.number
+        with app.test_request_context():
+            timings = measure(setup_case(), number, args.repeat)
+        median = timings[len(timings) // 2]
+        results[name] = {
+            'number': number,
+            'repeat': args.repeat,
+            'min_us': round(timings[0], 2),
+            'median_us': round(median, 2),
+            'max_us': round(timings[-1], 2),
+            'calls_per_sec': round(1e6 / median, 1),
+        }
+        print('%-20s %8d %12.2f %12.2f %12.1f' % (
+            name, number * args.repeat, timings[0], median, 1e6 / median))
+
+    report = {
+        'meta': {
+            'date': datetime.utcnow().isoformat(),
+            'backend': backend,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'bcrypt_rounds': args.rounds,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    with app.app_context():
+        mongo.cx.drop_database(mongo.db.name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
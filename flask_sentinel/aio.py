@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.aio
+    ~~~~~~~~~~~~~~~~~~
+
+    Asyncio counterpart of the MongoDB storage layer and of the validator
+    getters, for ASGI deployments. Requires Python 3.5+, Motor and
+    redis-py 4.2+.
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+from redis import asyncio as aioredis
+
+from .core import lookup_filter, signer, token_cache, token_reuse
+from .data import TOKEN_KEY, _cache_token, _check_password, _from_json, \
+    _load_token, _snapshot, _to_json, _token_from_json, _write_concern, id
+from .filters import FILTER_KEY, NEXT_FILTER_KEY, _ADD
+from .models import Client, User, Token
+from .revocation import REVOKED_KEY
+from .utils import Config
+
+# get_running_loop is new in Python 3.7. Before, get_event_loop returns the
+# running loop when called from a coroutine.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncStorage(object):
+    """ Reads and writes the same documents and redis keys as
+        :class:`~flask_sentinel.data.MongoBackend`, without blocking the
+        event loop.
+
+    Passwords are checked on `executor`, the loop default executor unless
+    told otherwise, which also goes through the bcrypt pool when
+    ``SENTINEL_BCRYPT_WORKERS`` is set. The in-process token cache is not
+    read from, though replaced tokens are still published to the other
+    processes.
+
+    :param app: the Flask app whose settings are used.
+    :param executor: a :class:`concurrent.futures.Executor`.
+    """
+    def __init__(self, app=None, executor=None):
+        self.executor = executor
+        self.db = None
+        self.redis = None
+        self._write_concern = None
+        self._filter_add = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = Config(app)
+        uri = app.config.get('SENTINEL_MONGO_URI')
+        client = AsyncIOMotorClient(uri) if uri else AsyncIOMotorClient(
+            app.config.get('SENTINEL_MONGO_HOST', 'localhost'),
+            app.config.get('SENTINEL_MONGO_PORT', 27017))
+        self.db = client.get_default_database(config.value('MONGO_DBNAME'))
+        self.redis = aioredis.from_url(config.value('REDIS_URL'))
+        self._write_concern = _write_concern(app.config)
+        self._filter_add = self.redis.register_script(_ADD)
+
+    async def close(self):
+        self.db.client.close()
+        await self.redis.close()
+
+    async def get_client(self, client_id):
+        json = await self.db.clients.find_one({'client_id': client_id})
+        return _from_json(json, Client)
+
+    async def get_user(self, username, password, *args, **kwargs):
+        """ See :meth:`MongoBackend.get_user`. """
+        user = await self.db.users.find_one(
+            {'username': username},
+            {'username': True, 'hashpw': True, 'version': True})
+        if password:
+            hashpw = user['hashpw'] if user else None
+            loop = _running_loop()
+            match = await loop.run_in_executor(
+                self.executor, _check_password, password, hashpw)
+            if not match:
+                return None
+        return _from_json(user, User)
+
+    async def get_token(self, access_token=None, refresh_token=None):
+        """ See :meth:`MongoBackend.get_token`. """
+        if access_token:
+            token = _load_token(access_token,
+                                await self.redis.get(TOKEN_KEY % access_token))
+            if token is not None:
+                return token
+            field, value = 'access_token', access_token
+        elif refresh_token:
+            field, value = 'refresh_token', refresh_token
+        else:
+            return None
+
+        token = _token_from_json(await self.db.tokens.find_one({field: value}))
+        if token is None:
+            return None
+        if token.user is None:
+            json = await self.db.users.find_one(
+                {id.collection: token.user_id})
+            token.user = _from_json(json, User)
+
+        pipe = self.redis.pipeline()
+        cache = _cache_token(token, token.user)
+        if cache is not None:
+            pipe.setex(*cache)
+        pipe.exists(REVOKED_KEY % token.access_token)
+        if (await pipe.execute())[-1]:
+            if cache is not None:
+                await self.redis.delete(cache[0])
+            return None
+        return token
+
+    async def get_tokens(self, access_tokens):
+        """ See :meth:`MongoBackend.get_tokens`. Tokens missing from the
+            redis cache are loaded concurrently.
+        """
+        if not access_tokens:
+            return []
+        values = await self.redis.mget([TOKEN_KEY % access_token
+                                        for access_token in access_tokens])
+        tokens = [_load_token(access_token, value)
+                  for access_token, value in zip(access_tokens, values)]
+        missing = [index for index, token in enumerate(tokens)
+                   if token is None]
+        loaded = await asyncio.gather(*[
+            self.get_token(access_token=access_tokens[index])
+            for index in missing])
+        for index, token in zip(missing, loaded):
+            tokens[index] = token
+        return tokens
+
+    async def save_token(self, token, request, *args, **kwargs):
+        """ See :meth:`MongoBackend.save_token`. """
+        user_id = request.user.id
+        expires_in = token.get('expires_in')
+        issued, token = token, Token(
+            client_id=request.client.client_id,
+            user_id=user_id,
+            token_type=token['token_type'],
+            access_token=token['access_token'],
+            refresh_token=token['refresh_token'],
+            expires=datetime.utcnow() + timedelta(seconds=expires_in),
+        )
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.setex(token.access_token, expires_in, str(user_id))
+        cache = _cache_token(token, request.user, expires_in)
+        if cache is not None:
+            pipe.setex(*cache)
+        if lookup_filter.enabled:
+            positions = lookup_filter.queue([
+                ('access', token.access_token),
+                ('refresh', token.refresh_token)], pipe)
+            if positions:
+                await self._filter_add(keys=[FILTER_KEY, NEXT_FILTER_KEY],
+                                       args=positions, client=pipe)
+        if token_reuse.enabled:
+            # tokens issued here are never reused, but replace the ones
+            # which might be.
+            token_reuse.remember(issued, request, pipe)
+        await pipe.execute()
+
+        spec = {'client_id': token.client_id, 'user_id': user_id}
+        json = _to_json(token)
+        json['user'] = _snapshot(request.user)
+        tokens = self.db.tokens
+        if self._write_concern is not None:
+            tokens = tokens.with_options(write_concern=self._write_concern)
+        try:
+            old = await tokens.find_one_and_replace(
+                spec, json, {'access_token': True}, upsert=True)
+        except DuplicateKeyError:
+            old = await tokens.find_one_and_replace(
+                spec, json, {'access_token': True}, upsert=True)
+
+        if old is not None:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(old['access_token'], TOKEN_KEY % old['access_token'])
+            if token_cache.enabled:
+                token_cache.publish(old['access_token'], pipe)
+            await pipe.execute()
+
+
+class AsyncValidator(object):
+    """ Asyncio counterpart of the client, user and bearer token checks of
+        :class:`~flask_sentinel.validator.MyRequestValidator`, for resource
+        servers and token endpoints running on an event loop.
+
+    :param storage: an :class:`AsyncStorage`.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def authenticate_client_id(self, client_id):
+        """ Returns the Client, or None. """
+        return await self.storage.get_client(client_id)
+
+    async def validate_user(self, username, password, client=None):
+        """ Returns the User if the password matches, None otherwise. """
+        return await self.storage.get_user(username, password, client)
+
+    async def validate_bearer_token(self, token, scopes=None):
+        """ Returns the Token if it exists, has not expired and grants any
+            of `scopes`, None otherwise. Signed tokens are checked without
+            any datastore lookup.
+        """
+        if signer.enabled and token.count('.') == 2:
+            tok = signer.load_token(token)
+        else:
+            tok = await self.storage.get_token(access_token=token)
+        if tok is None:
+            return None
+        if tok.expires is not None and datetime.utcnow() > tok.expires:
+            return None
+        if scopes and not set(tok.scopes) & set(scopes):
+            return None
+        return tok
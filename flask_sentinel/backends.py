@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.backends
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+import bcrypt
+from bson.objectid import ObjectId
+from flask import current_app
+from werkzeug.security import gen_salt
+from werkzeug.utils import import_string
+
+from .core import redis, hasher, token_cache
+from .data import Backend, MongoBackend, _check_password
+from .indexes import EXPIRED_TOKEN_TTL
+from .models import Client, User, Token
+
+# redis-only backend keys.
+CLIENT_KEY = 'sentinel:client:%s'
+CLIENTS_KEY = 'sentinel:clients'
+USER_KEY = 'sentinel:user:%s'
+USERS_KEY = 'sentinel:users'
+USER_ID_KEY = 'sentinel:userid:%s'
+ACCESS_KEY = 'sentinel:access:%s'
+REFRESH_KEY = 'sentinel:refresh:%s'
+GRANT_KEY = 'sentinel:grant:%s:%s'
+
+# deletes KEYS[1] only if it still holds ARGV[1].
+_DELETE_IF = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# sets the ARGV[1] field of the KEYS[1] hash to ARGV[2], only if it exists.
+_HSET_IF = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
+
+def load(backend):
+    """ Returns a storage backend instance.
+
+    :param backend: 'mongo', 'memory', 'redis', the import path of a
+                    :class:`Backend` subclass, or a backend instance.
+    """
+    backend = {
+        'mongo': MongoBackend,
+        'memory': MemoryBackend,
+        'redis': RedisBackend,
+    }.get(backend, backend)
+    if isinstance(backend, str):
+        backend = import_string(backend)
+    if isinstance(backend, type):
+        backend = backend()
+    if not isinstance(backend, Backend):
+        raise ValueError('%r is not a storage backend.' % backend)
+    return backend
+
+
+def _new_user(username, password):
+    salt = bcrypt.gensalt()
+    return User(username=username,
+                hashpw=hasher.hashpw(password.encode('utf-8'), salt))
+
+
+def _new_token(token, request):
+    """ Returns the Token issued by oauthlib, along with its lifetime. """
+    expires_in = token.get('expires_in')
+    return Token(
+        client_id=request.client.client_id,
+        user_id=request.user.id,
+        token_type=token['token_type'],
+        access_token=token['access_token'],
+        refresh_token=token['refresh_token'],
+        expires=datetime.utcnow() + timedelta(seconds=expires_in),
+    ), expires_in
+
+
+def _expired_token_ttl():
+    """ Seconds tokens are kept after they expire, so that they can still be
+        refreshed.
+    """
+    ttl = current_app.config['SENTINEL_EXPIRED_TOKEN_TTL']
+    if ttl is None or ttl is False:
+        ttl = EXPIRED_TOKEN_TTL
+    return ttl
+
+
+def _range(keys, after=None, prefix=None):
+    """ Returns the (start, stop) slice of the sorted `keys` which sort
+        after `after` and start with `prefix`.
+    """
+    start = 0
+    if prefix:
+        start = bisect_left(keys, prefix)
+    if after is not None:
+        start = max(start, bisect_right(keys, after))
+    stop = len(keys)
+    if prefix:
+        stop = bisect_right(keys, prefix + u'\U0010ffff')
+    return start, stop
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class MemoryBackend(Backend):
+    """ Keeps everything in the memory of the current process. Meant for
+        tests and benchmarks, as nothing is shared with other processes
+        nor survives a restart.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clients = {}
+        # username: User, and id: username.
+        self._users = {}
+        self._usernames = {}
+        # access_token: Token, refresh_token: access_token, and
+        # (client_id, user_id): access_token.
+        self._tokens = {}
+        self._refresh = {}
+        self._grants = {}
+
+    def get_client(self, client_id):
+        client = self._clients.get(client_id)
+        if client is None:
+            return None
+        return Client(client_id=client.client_id,
+                      client_type=client.client_type)
+
+    def get_user(self, username, password, *args, **kwargs):
+        user = self._users.get(username)
+        if password:
+            hashpw = user.hashpw if user else None
+            if not _check_password(password, hashpw):
+                return None
+        if user is None:
+            return None
+        return User(id=user.id, username=user.username, hashpw=user.hashpw)
+
+    def get_token(self, access_token=None, refresh_token=None):
+        with self._lock:
+            if not access_token and refresh_token:
+                access_token = self._refresh.get(refresh_token)
+            tok = self._tokens.get(access_token)
+            if tok is None:
+                return None
+            token = Token(id=tok.id, client_id=tok.client_id,
+                          user_id=tok.user_id, token_type=tok.token_type,
+                          access_token=tok.access_token,
+                          refresh_token=tok.refresh_token,
+                          expires=tok.expires, scopes=tok.scopes)
+            token.user = User(id=tok.user_id,
+                              username=self._usernames.get(tok.user_id))
+        return token
+
+    def save_token(self, token, request, *args, **kwargs):
+        token, _ = _new_token(token, request)
+        with self._lock:
+            old = self._grants.get((token.client_id, token.user_id))
+            if old is not None:
+                self._delete(old)
+            self._tokens[token.access_token] = token
+            self._refresh[token.refresh_token] = token.access_token
+            self._grants[token.client_id, token.user_id] = token.access_token
+
+    def revoke_token(self, token, token_type_hint=None, client_id=None):
+        with self._lock:
+            access_token = token
+            if token not in self._tokens:
+                access_token = self._refresh.get(token)
+            tok = self.get_token(access_token=access_token)
+            if tok is None or client_id not in (None, tok.client_id):
+                return None
+            self._delete(tok.access_token)
+        return tok
+
+    def generate_client(self):
+        client = Client(client_id=gen_salt(40), client_type='public')
+        with self._lock:
+            self._clients[client.client_id] = client
+        return client
+
+    def save_user(self, username, password):
+        user = _new_user(username, password)
+        with self._lock:
+            if username in self._users:
+                raise ValueError('User %r already exists.' % username)
+            user.id = ObjectId()
+            self._users[username] = user
+            self._usernames[user.id] = username
+        return user
+
+    def update_user(self, user_id, username=None, password=None):
+        hashpw = None
+        if password:
+            hashpw = _new_user(None, password).hashpw
+        with self._lock:
+            user = self._users.get(self._usernames.get(user_id))
+            if user is None:
+                return None
+            if username and username != user.username:
+                if username in self._users:
+                    raise ValueError('User %r already exists.' % username)
+                del self._users[user.username]
+                user.username = username
+                self._users[username] = user
+                self._usernames[user_id] = username
+            if hashpw is not None:
+                user.hashpw = hashpw
+        return User(id=user.id, username=user.username)
+
+    def all_users(self):
+        return [User(id=user.id, username=user.username)
+                for user in self._ordered(self._users)]
+
+    def all_clients(self):
+        return [self.get_client(client.client_id)
+                for client in self._ordered(self._clients)]
+
+    def users_page(self, after=None, prefix=None, limit=50):
+        users, after = self._page(self._users, after, prefix, limit)
+        return [User(id=u.id, username=u.username) for u in users], after
+
+    def clients_page(self, after=None, prefix=None, limit=50):
+        clients, after = self._page(self._clients, after, prefix, limit)
+        return [self.get_client(c.client_id) for c in clients], after
+
+    def count_users(self, prefix=None):
+        start, stop = _range(sorted(self._users), prefix=prefix)
+        return stop - start
+
+    def count_clients(self, prefix=None):
+        start, stop = _range(sorted(self._clients), prefix=prefix)
+        return stop - start
+
+    def _delete(self, access_token):
+        tok = self._tokens.pop(access_token, None)
+        if tok is None:
+            return
+        self._refresh.pop(tok.refresh_token, None)
+        if self._grants.get((tok.client_id, tok.user_id)) == access_token:
+            del self._grants[tok.client_id, tok.user_id]
+
+    def _ordered(self, objs):
+        with self._lock:
+            return [objs[key] for key in sorted(objs)]
+
+    def _page(self, objs, after, prefix, limit):
+        with self._lock:
+            keys = sorted(objs)
+            start, stop = _range(keys, after, prefix)
+            page = [objs[key] for key in keys[start:min(stop,
+                                                        start + limit)]]
+        if start + limit < stop:
+            return page, keys[start + limit - 1]
+        return page, None
+
+
+class RedisBackend(Backend):
+    """ Keeps everything in redis, without MongoDB.
+
+    Clients, users and tokens are stored as hashes. Tokens expire on their
+    own, once they can no longer be refreshed (``SENTINEL_EXPIRED_TOKEN_TTL``
+    seconds after their own expiration), and are deleted right away when
+    revoked. Usernames and client ids are also kept in sorted sets, which
+    the management pages are read from.
+    """
+    def __init__(self):
+        self._delete_if = redis.register_script(_DELETE_IF)
+        self._hset_if = redis.register_script(_HSET_IF)
+
+    def get_client(self, client_id):
+        client = redis.hgetall(CLIENT_KEY % client_id)
+        return self._client(client_id, client)
+
+    def get_user(self, username, password, *args, **kwargs):
+        user = redis.hmget(USER_KEY % username, 'id', 'hashpw')
+        if password:
+            if not _check_password(password, user[1]):
+                return None
+        if user[0] is None:
+            return None
+        return User(id=_text(user[0]), username=username, hashpw=user[1])
+
+    def get_token(self, access_token=None, refresh_token=None):
+        if not access_token and refresh_token:
+            access_token = redis.get(REFRESH_KEY % refresh_token)
+            if access_token is None:
+                return None
+            access_token = _text(access_token)
+        elif access_token and token_cache.enabled:
+            token = token_cache.get(access_token)
+            if token is not None:
+                return token
+
+        generation = token_cache.generation
+        token = self._token(access_token,
+                            redis.read('hgetall', ACCESS_KEY % access_token))
+        if token is not None and token_cache.enabled:
+            token_cache.set(token, generation)
+        return token
+
+    def get_tokens(self, access_tokens):
+        pipe = redis.pipeline(transaction=False)
+        for access_token in access_tokens:
+            pipe.hgetall(ACCESS_KEY % access_token)
+        return [self._token(access_token, value)
+                for access_token, value in zip(access_tokens,
+                                               pipe.execute())]
+
+    def save_token(self, token, request, *args, **kwargs):
+        token, expires_in = _new_token(token, request)
+        ttl = expires_in + _expired_token_ttl()
+        grant = GRANT_KEY % (token.client_id, token.user_id)
+
+        # the new token is stored and takes over the (client, user) pair at
+        # once, so that of two racing grants the last one wins, and each
+        # deletes the token it replaced.
+        pipe = redis.pipeline()
+        pipe.getset(grant, token.access_token)
+        pipe.expire(grant, ttl)
+        pipe.hset(ACCESS_KEY % token.access_token, mapping={
+            'client_id': token.client_id,
+            'user_id': token.user_id,
+            'username': request.user.username,
+            'token_type': token.token_type,
+            'refresh_token': token.refresh_token,
+            'expires': token.expires.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            'scopes': ' '.join(token.scopes),
+        })
+        pipe.expire(ACCESS_KEY % token.access_token, ttl)
+        pipe.setex(REFRESH_KEY % token.refresh_token, ttl, token.access_token)
+        # plain access token key, mapping to the user id, as with MongoDB.
+        pipe.setex(token.access_token, expires_in, str(token.user_id))
+        old = pipe.execute()[0]
+
+        if old is not None and _text(old) != token.access_token:
+            self._delete(_text(old))
+
+    def revoke_token(self, token, token_type_hint=None, client_id=None):
+        fields = ['access_token', 'refresh_token']
+        if token_type_hint == 'refresh_token':
+            fields.reverse()
+        for field in fields:
+            tok = self.get_token(**{field: token})
+            if tok is not None:
+                break
+        if tok is None or client_id not in (None, tok.client_id):
+            return None
+        self._delete(tok.access_token, tok)
+        return tok
+
+    def generate_client(self):
+        client = Client(client_id=gen_salt(40), client_type='public')
+        pipe = redis.pipeline()
+        pipe.hset(CLIENT_KEY % client.client_id,
+                  mapping={'client_type': client.client_type})
+        pipe.zadd(CLIENTS_KEY, {client.client_id: 0})
+        pipe.execute()
+        return client
+
+    def save_user(self, username, password):
+        user = _new_user(username, password)
+        user.id = str(ObjectId())
+        # the id is set first, and only if the user does not exist.
+        if not redis.hsetnx(USER_KEY % username, 'id', user.id):
+            raise ValueError('User %r already exists.' % username)
+        pipe = redis.pipeline()
+        pipe.hset(USER_KEY % username, 'hashpw', user.hashpw)
+        pipe.zadd(USERS_KEY, {username: 0})
+        pipe.set(USER_ID_KEY % user.id, username)
+        pipe.execute()
+        return user
+
+    def update_user(self, user_id, username=None, password=None):
+        """ Updates a user and returns it as a User, or None if there is no
+            such user.
+
+        Renamed users are moved to a new hash, claimed as in
+        :meth:`save_user`. The tokens of the user are found by scanning the
+        pair keys, which is fine for an occasional update.
+        """
+        user_id = str(user_id)
+        hashpw = None
+        if password:
+            hashpw = _new_user(None, password).hashpw
+        current = self._username(user_id)
+        if current is None:
+            return None
+        if not username or username == current:
+            if hashpw is not None:
+                redis.hset(USER_KEY % current, 'hashpw', hashpw)
+            return User(id=user_id, username=current)
+
+        if not redis.hsetnx(USER_KEY % username, 'id', user_id):
+            raise ValueError('User %r already exists.' % username)
+        if hashpw is None:
+            hashpw = redis.hget(USER_KEY % current, 'hashpw')
+        pipe = redis.pipeline()
+        pipe.hset(USER_KEY % username, 'hashpw', hashpw)
+        pipe.delete(USER_KEY % current)
+        pipe.zrem(USERS_KEY, current)
+        pipe.zadd(USERS_KEY, {username: 0})
+        pipe.set(USER_ID_KEY % user_id, username)
+        pipe.execute()
+
+        grants = list(redis.scan_iter(GRANT_KEY % ('*', user_id)))
+        access_tokens = [_text(access_token) for access_token
+                         in redis.mget(grants) if access_token is not None] \
+            if grants else []
+        pipe = redis.pipeline()
+        for access_token in access_tokens:
+            # tokens which expired meanwhile are not brought back.
+            self._hset_if(keys=[ACCESS_KEY % access_token],
+                          args=['username', username], client=pipe)
+            if token_cache.enabled:
+                token_cache.publish(access_token, pipe)
+        pipe.execute()
+        return User(id=user_id, username=username)
+
+    def all_users(self):
+        return self._users(redis.zrange(USERS_KEY, 0, -1))
+
+    def all_clients(self):
+        return self._clients(redis.zrange(CLIENTS_KEY, 0, -1))
+
+    def users_page(self, after=None, prefix=None, limit=50):
+        usernames, after = self._page(USERS_KEY, after, prefix, limit)
+        return self._users(usernames), after
+
+    def clients_page(self, after=None, prefix=None, limit=50):
+        client_ids, after = self._page(CLIENTS_KEY, after, prefix, limit)
+        return self._clients(client_ids), after
+
+    def count_users(self, prefix=None):
+        return redis.zlexcount(USERS_KEY, *self._bounds(prefix=prefix))
+
+    def count_clients(self, prefix=None):
+        return redis.zlexcount(CLIENTS_KEY, *self._bounds(prefix=prefix))
+
+    def _delete(self, access_token, tok=None):
+        """ Deletes an access token, along with its refresh token. """
+        if tok is None:
+            tok = self._token(access_token,
+                              redis.hgetall(ACCESS_KEY % access_token))
+        pipe = redis.pipeline()
+        pipe.delete(ACCESS_KEY % access_token)
+        pipe.delete(access_token)
+        if tok is not None:
+            pipe.delete(REFRESH_KEY % tok.refresh_token)
+            # the pair key may point to a newer token already.
+            self._delete_if(keys=[GRANT_KEY % (tok.client_id, tok.user_id)],
+                            args=[access_token], client=pipe)
+        if token_cache.enabled:
+            token_cache.publish(access_token, pipe)
+        pipe.execute()
+
+    def _username(self, user_id):
+        """ Returns the username of a user id, or None. """
+        return _text(redis.get(USER_ID_KEY % user_id))
+
+    def _client(self, client_id, client):
+        if not client:
+            return None
+        client = dict((_text(k), _text(v)) for k, v in client.items())
+        return Client(client_id=client_id, client_type=client['client_type'])
+
+    def _clients(self, client_ids):
+        client_ids = [_text(client_id) for client_id in client_ids]
+        pipe = redis.pipeline(transaction=False)
+        for client_id in client_ids:
+            pipe.hgetall(CLIENT_KEY % client_id)
+        return [self._client(client_id, client) for client_id, client
+                in zip(client_ids, pipe.execute()) if client]
+
+    def _users(self, usernames):
+        usernames = [_text(username) for username in usernames]
+        pipe = redis.pipeline(transaction=False)
+        for username in usernames:
+            pipe.hget(USER_KEY % username, 'id')
+        return [User(id=_text(id), username=username) for username, id
+                in zip(usernames, pipe.execute()) if id is not None]
+
+    def _token(self, access_token, value):
+        if not value:
+            return None
+        value = dict((_text(k), _text(v)) for k, v in value.items())
+        token = Token(
+            client_id=value['client_id'],
+            user_id=value['user_id'],
+            token_type=value['token_type'],
+            access_token=access_token,
+            refresh_token=value['refresh_token'],
+            expires=datetime.strptime(value['expires'],
+                                      '%Y-%m-%dT%H:%M:%S.%f'),
+            scopes=value['scopes'].split(' '),
+        )
+        token.user = User(id=value['user_id'], username=value['username'])
+        return token
+
+    def _bounds(self, after=None, prefix=None):
+        """ Returns the ZRANGEBYLEX bounds of the members which sort after
+            `after` and start with `prefix`.
+        """
+        low, high = b'-', b'+'
+        if prefix:
+            prefix = prefix.encode('utf-8')
+            low, high = b'[' + prefix, b'[' + prefix + b'\xff'
+        if after is not None:
+            after = after.encode('utf-8')
+            if not prefix or after >= prefix:
+                low = b'(' + after
+        return low, high
+
+    def _page(self, key, after, prefix, limit):
+        members = redis.zrangebylex(key, *self._bounds(after, prefix),
+                                    start=0, num=limit + 1)
+        if len(members) > limit:
+            return members[:limit], _text(members[limit - 1])
+        return members, None
@@ -25,15 +25,26 @@ def authenticate():
                     )
 
 
-def requires_basicauth(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        user = current_app.config.get('SENTINEL_MANAGEMENT_USERNAME')
-        pw = current_app.config.get('SENTINEL_MANAGEMENT_PASSWORD')
-        auth = request.authorization
-        if user and pw:
-            if not auth or \
-                    not check_auth(auth.username, auth.password, user, pw):
+def basicauth(prefix, required=False):
+    """Returns a decorator protecting a view with the credentials set in the
+    ``<prefix>_USERNAME`` and ``<prefix>_PASSWORD`` settings. Unless
+    `required`, the view is left open when they are not set.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            user = current_app.config.get('%s_USERNAME' % prefix)
+            pw = current_app.config.get('%s_PASSWORD' % prefix)
+            auth = request.authorization
+            if user and pw:
+                if not auth or \
+                        not check_auth(auth.username, auth.password, user, pw):
+                    return authenticate()
+            elif required:
                 return authenticate()
-        return f(*args, **kwargs)
-    return decorated
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+requires_basicauth = basicauth('SENTINEL_MANAGEMENT')
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.bulk
+    ~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+import time
+
+import bcrypt
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from werkzeug.security import gen_salt
+
+from .data import _to_json
+from .models import Client, User
+
+
+class ImportReport(object):
+    """ Outcome of a bulk import.
+
+    `keys` holds the username, or client_id, of every inserted record, and
+    `errors` a (record number, message) tuple for every rejected one. Records
+    are numbered from 1, in input order.
+    """
+    def __init__(self):
+        self.keys = []
+        self.errors = []
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    @property
+    def inserted(self):
+        return len(self.keys)
+
+    @property
+    def rate(self):
+        """ Inserted records per second. """
+        return self.inserted / self.elapsed if self.elapsed else 0.0
+
+
+def read_records(stream, format='jsonl'):
+    """ Yields the records of a CSV file, with a header row, or of a file
+        holding a JSON object per line. Lines which cannot be parsed are
+        yielded as a `ValueError`, so that they are reported along with the
+        other rejected records.
+    """
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+        return
+
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield ValueError('invalid JSON: %s' % e)
+            continue
+        if isinstance(record, dict):
+            yield record
+        else:
+            yield ValueError('not a JSON object')
+
+
+def import_users(db, records, processes=None, batch_size=1000, rounds=None,
+                 progress=None):
+    """ Inserts users from `records`, an iterable of dicts with a username
+        and a password, and returns an :class:`ImportReport`.
+
+    Passwords are hashed on a pool of `processes` processes (as many as
+    there are CPUs by default, none to hash in the current process), while
+    the previous batch is written with a single unordered `insert_many`.
+    Rejected records, like existing usernames, are reported and do not stop
+    the import. Duplicates are only detected when the unique index on
+    username exists, see :mod:`flask_sentinel.indexes`.
+
+    :param db: the MongoDB database.
+    :param rounds: bcrypt work factor. Defaults to bcrypt's own.
+    :param progress: called with the report after every batch.
+    """
+    report = ImportReport()
+    pool = multiprocessing.Pool(processes) if processes != 0 else None
+    try:
+        pending = None
+        for batch in _batches(_users(records, rounds, report), batch_size):
+            args = [(password, salt) for _, _, password, salt in batch]
+            if pool is None:
+                hashes = list(map(_hashpw, args))
+            else:
+                hashes = pool.map_async(_hashpw, args)
+            if pending is not None:
+                _insert_users(db, report, progress, *pending)
+            pending = batch, hashes
+        if pending is not None:
+            _insert_users(db, report, progress, *pending)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return _done(report)
+
+
+def import_clients(db, records, batch_size=1000, progress=None):
+    """ Inserts clients from `records`, an iterable of dicts with an optional
+        client_id and client_type, and returns an :class:`ImportReport`.
+        Missing client ids are generated and clients are public unless told
+        otherwise. See :func:`import_users`.
+    """
+    report = ImportReport()
+    for batch in _batches(_clients(records, report), batch_size):
+        _insert(db.clients, report, progress, batch)
+    return _done(report)
+
+
+def _hashpw(args):
+    return bcrypt.hashpw(*args)
+
+
+def _done(report):
+    report.errors.sort()
+    report.elapsed = time.time() - report.started
+    return report
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _users(records, rounds, report):
+    """ Yields a (number, username, password, salt) tuple for every valid
+        record, and reports the invalid ones.
+    """
+    for number, record in enumerate(records, 1):
+        if isinstance(record, Exception):
+            report.errors.append((number, str(record)))
+            continue
+        username, password = record.get('username'), record.get('password')
+        if not username or not hasattr(password, 'encode') or not password:
+            report.errors.append((number, 'username and password required'))
+            continue
+        salt = bcrypt.gensalt(rounds) if rounds else bcrypt.gensalt()
+        yield number, username, password.encode('utf-8'), salt
+
+
+def _clients(records, report):
+    for number, record in enumerate(records, 1):
+        if isinstance(record, Exception):
+            report.errors.append((number, str(record)))
+            continue
+        client = Client(client_id=record.get('client_id') or gen_salt(40),
+                        client_type=record.get('client_type') or 'public')
+        yield number, client.client_id, _to_json(client)
+
+
+def _insert_users(db, report, progress, batch, hashes):
+    if not isinstance(hashes, list):
+        hashes = hashes.get()
+    docs = [(number, username,
+             _to_json(User(username=username, hashpw=hashpw, version=0)))
+            for (number, username, _, _), hashpw in zip(batch, hashes)]
+    _insert(db.users, report, progress, docs)
+
+
+def _insert(collection, report, progress, batch):
+    """ Writes a batch of (number, key, document) tuples at once. """
+    failed = {}
+    try:
+        collection.insert_many([doc for _, _, doc in batch], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            message = error['errmsg']
+            if error.get('code') == 11000:
+                message = '%s already exists' % batch[error['index']][1]
+            failed[error['index']] = message
+
+    for index, (number, key, _) in enumerate(batch):
+        if index in failed:
+            report.errors.append((number, failed[index]))
+        else:
+            report.keys.append(key)
+    report.elapsed = time.time() - report.started
+    if progress is not None:
+        progress(report)
+
+
+def _print_progress(report):
+    sys.stderr.write('\r%d inserted, %d rejected, %.0f records/s' % (
+        report.inserted, len(report.errors), report.rate))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    """ Console entry point importing users or clients from a CSV or JSONL
+        file.
+    """
+    parser = argparse.ArgumentParser(
+        description='Import users or clients into Flask-Sentinel.')
+    parser.add_argument('kind', choices=('users', 'clients'))
+    parser.add_argument('file', nargs='?',
+                        help='CSV or JSONL file, "-" for stdin. Clients can '
+                        'be generated with --count instead.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/oauth',
+                        help='MongoDB connection string, including the '
+                        'database name.')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='input format. Guessed from the file extension '
+                        'by default.')
+    parser.add_argument('--count', type=int,
+                        help='number of clients to generate.')
+    parser.add_argument('--processes', type=int,
+                        help='password hashing processes. Defaults to the '
+                        'number of CPUs.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--rounds', type=int,
+                        help='bcrypt work factor.')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not report progress.')
+    args = parser.parse_args(argv)
+
+    if args.kind == 'clients' and args.count:
+        records = ({} for _ in range(args.count))
+    elif args.file:
+        stream = sys.stdin if args.file == '-' else open(args.file)
+        format = args.format or (
+            'csv' if args.file.lower().endswith('.csv') else 'jsonl')
+        records = read_records(stream, format)
+    else:
+        parser.error('a file is required.')
+
+    db = MongoClient(args.uri).get_default_database()
+    progress = None if args.quiet else _print_progress
+    if args.kind == 'users':
+        report = import_users(db, records, args.processes, args.batch_size,
+                              args.rounds, progress)
+    else:
+        report = import_clients(db, records, args.batch_size, progress)
+        # generated client ids are of no use unless someone gets to see them.
+        for client_id in report.keys:
+            print(client_id)
+
+    if not args.quiet:
+        sys.stderr.write('\n')
+    for number, message in report.errors:
+        sys.stderr.write('record %d: %s\n' % (number, message))
+    sys.stderr.write('%d %s inserted, %d rejected in %.1fs (%.0f/s)\n' % (
+        report.inserted, args.kind, len(report.errors), report.elapsed,
+        report.rate))
+    return 1 if report.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
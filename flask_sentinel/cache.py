@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.cache
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import calendar
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .models import User
+
+# redis counters bumped on every client, and user, write.
+CLIENTS_VERSION_KEY = 'sentinel:version:clients'
+USERS_VERSION_KEY = 'sentinel:version:users'
+
+
+class TokenCache(object):
+    """ In-process LRU cache of validated tokens, sitting in front of the
+        redis cache.
+
+    Entries are capped in number and never outlive either the configured TTL
+    or the token own expiration. Tokens replaced or revoked by any process
+    are published on a redis channel, which every process listens to in
+    order to drop them from its own cache. Tokens loaded while one was
+    dropped are not cached, as they might be the dropped one.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.size = 1024
+        self.ttl = 60
+        self.channel = 'sentinel:invalidate'
+        self.hits = 0
+        self.misses = 0
+
+        self._redis = None
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, config, redis):
+        self.enabled = bool(config.value('TOKEN_CACHE'))
+        self.size = config.value('TOKEN_CACHE_SIZE')
+        self.ttl = config.value('TOKEN_CACHE_TTL')
+        self.channel = config.value('TOKEN_CACHE_CHANNEL')
+        self._redis = redis
+        self.clear()
+
+    @property
+    def generation(self):
+        """ Changes whenever tokens are dropped. Tokens loaded before are
+            not cached, see :meth:`set`.
+        """
+        return self._generation
+
+    def get(self, access_token):
+        """ Returns the cached Token for `access_token`, or None.
+        """
+        self._listen()
+        with self._lock:
+            entry = self._entries.pop(access_token, None)
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used.
+            self._entries[access_token] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token, generation):
+        """ Caches a validated Token loaded while :attr:`generation` was
+            `generation`.
+        """
+        deadline = time.time() + self.ttl
+        if token.expires is not None:
+            deadline = min(
+                deadline, calendar.timegm(token.expires.utctimetuple()))
+
+        self._listen()
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries.pop(token.access_token, None)
+            self._entries[token.access_token] = (token, deadline)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, access_token):
+        """ Drops `access_token` from the local cache only.
+        """
+        with self._lock:
+            self._entries.pop(access_token, None)
+            self._generation += 1
+
+    def publish(self, access_token, pipe=None):
+        """ Drops `access_token` from the cache of every process.
+
+        :param access_token: the token to invalidate.
+        :param pipe: optional redis pipeline the message is queued on.
+        """
+        self.invalidate(access_token)
+        (pipe or self._redis).publish(self.channel, access_token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+    def _listen(self):
+        """ Makes sure the invalidation listener is running in the current
+            process. This is done lazily so that it survives forking
+            servers like gunicorn.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # entries inherited from a parent process might have missed
+            # invalidations.
+            self._entries.clear()
+            self._generation += 1
+            self._pid = pid
+        thread = threading.Thread(target=self._run,
+                                  name='sentinel-token-cache')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        reconnect = False
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                if reconnect:
+                    # invalidations might have been lost while disconnected.
+                    self.clear()
+                reconnect = True
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    access_token = message['data']
+                    if not isinstance(access_token, str):
+                        access_token = access_token.decode('utf-8')
+                    self.invalidate(access_token)
+            except Exception:
+                time.sleep(1)
+
+
+class MetadataCache(object):
+    """ In-process cache of clients by client id, and of the username and
+        version of users by id, sparing the token endpoint most client
+        lookups.
+
+    Every client, or user, update bumps a version counter in redis. Each
+    process checks the counters at most every `check_interval` seconds, and
+    drops the entries of a kind once its counter has moved; writes made by
+    the process itself drop them at once. Optionally, a thread also watches
+    the clients and users collections through a MongoDB change stream, so
+    that changes made outside of Flask-Sentinel, like bulk imports, are
+    noticed within moments as well. Change streams need a replica set.
+
+    Users are capped in number, clients are not.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.size = 10000
+        self.check_interval = 1
+        self.change_stream = False
+        self.hits = 0
+        self.misses = 0
+
+        self._app = None
+        self._redis = None
+        self._mongo = None
+        self._clients = {}
+        self._users = OrderedDict()
+        self._versions = [None, None]
+        self._generations = [0, 0]
+        self._checked_until = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, config, redis, mongo):
+        self.enabled = bool(config.value('METADATA_CACHE'))
+        self.size = config.value('METADATA_CACHE_SIZE')
+        self.check_interval = config.value('METADATA_CACHE_INTERVAL')
+        self.change_stream = bool(config.value('METADATA_CHANGE_STREAM'))
+        self.hits = self.misses = 0
+        self._app = config.app
+        self._redis = redis
+        self._mongo = mongo
+        self._pid = None
+        self._versions = [None, None]
+        self._checked_until = 0
+        self.clear()
+
+    @property
+    def generation(self):
+        """ Changes whenever entries are dropped. Entries loaded before are
+            not cached, see :meth:`set_client`.
+        """
+        return tuple(self._generations)
+
+    def get_client(self, client_id):
+        """ Returns the cached Client, or None. """
+        self._check()
+        return self._count(self._clients.get(client_id))
+
+    def set_client(self, client, generation):
+        """ Caches a Client loaded while :attr:`generation` was
+            `generation`.
+        """
+        with self._lock:
+            if generation[0] == self._generations[0]:
+                self._clients[client.client_id] = client
+
+    def get_user(self, user_id):
+        """ Returns the cached User, without password hash, or None. """
+        self._check()
+        with self._lock:
+            user = self._users.pop(user_id, None)
+            if user is not None:
+                self._users[user_id] = user
+        return self._count(user)
+
+    def set_user(self, user, generation):
+        """ Caches the username and version of a User loaded while
+            :attr:`generation` was `generation`.
+        """
+        with self._lock:
+            if generation[1] != self._generations[1]:
+                return
+            self._users.pop(user.id, None)
+            self._users[user.id] = User(
+                id=user.id, username=user.username, version=user.version)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+    def warm(self, load):
+        """ Caches the clients returned by `load`, like all of them at
+            startup.
+        """
+        self._check()
+        generation = self.generation
+        for client in load():
+            self.set_client(client, generation)
+
+    def bump(self, clients=False, users=False, pipe=None):
+        """ Drops the clients, and/or users, from the cache of every
+            process.
+
+        :param pipe: optional redis pipeline the bump is queued on.
+        """
+        target = pipe or self._redis
+        if clients:
+            target.incr(CLIENTS_VERSION_KEY)
+        if users:
+            target.incr(USERS_VERSION_KEY)
+        self._drop(clients, users)
+        # have this process catch up with the counters on the next lookup.
+        self._checked_until = 0
+
+    def clear(self):
+        self._drop(True, True)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'clients': len(self._clients),
+            'users': len(self._users),
+        }
+
+    def _count(self, obj):
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return obj
+
+    def _drop(self, clients, users):
+        with self._lock:
+            if clients:
+                self._clients = {}
+                self._generations[0] += 1
+            if users:
+                self._users.clear()
+                self._generations[1] += 1
+
+    def _check(self):
+        """ Drops the entries whose counter moved since last checked. """
+        if self.change_stream:
+            self._watch()
+        now = time.time()
+        if now < self._checked_until:
+            return
+        self._checked_until = now + self.check_interval
+        versions = self._redis.mget([CLIENTS_VERSION_KEY, USERS_VERSION_KEY])
+        changed = [old != new for old, new in zip(self._versions, versions)]
+        self._versions = versions
+        self._drop(*changed)
+
+    def _watch(self):
+        """ Makes sure the change stream is watched from the current process.
+            This is done lazily so that it survives forking servers like
+            gunicorn.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+        thread = threading.Thread(target=self._run,
+                                  name='sentinel-metadata-cache')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        match = [{'$match': {'ns.coll': {'$in': ['clients', 'users']}}}]
+        while True:
+            try:
+                with self._app.app_context():
+                    with self._mongo.db.watch(match) as stream:
+                        # changes might have been missed meanwhile.
+                        self.clear()
+                        for change in stream:
+                            collection = change['ns']['coll']
+                            self._drop(collection == 'clients',
+                                       collection == 'users')
+            except Exception as e:
+                self._app.logger.warning('MongoDB change stream lost: %s', e)
+                time.sleep(1)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.coalesce
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+from werkzeug.security import gen_salt
+
+# redis lock held by the process answering a grant, holding its id, and the
+# answer it publishes for the other processes, by grant key and process id.
+# The braces keep both on one cluster slot.
+FLIGHT_KEY = '{sentinel:flight:%s}'
+RESULT_KEY = '{sentinel:flight:%s}:%s'
+
+# seconds between two looks at the answer of another process.
+POLL_INTERVAL = 0.01
+
+# KEYS: the lock and the answer. ARGV: the id of the process, its answer,
+# if any, and how long it is kept in milliseconds. Publishes the answer and
+# releases the lock at once, so that waiting processes seeing the lock gone
+# without an answer know the grant failed.
+_RELEASE = """
+if ARGV[2] ~= '' then
+    redis.call('set', KEYS[2], ARGV[2], 'px', ARGV[3])
+end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.decode('utf-8')
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class Coalescer(object):
+    """ Answers concurrent, identical grants once.
+
+    Grants are identified by a keyed hash of their client credentials,
+    username, password and scope, see :meth:`key`. The first one does the
+    work while the others wait for its answer, within the process or, in
+    ``redis`` mode, across processes through a redis lock. Whoever waits
+    more than `timeout` seconds, or sees the first grant fail, does the work
+    itself.
+
+    Across processes the hash key is the app ``SECRET_KEY``, which must then
+    be the same for every process.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.shared = False
+        self.timeout = 5
+        self.coalesced = 0
+
+        self._redis = None
+        self._release = None
+        self._secret = os.urandom(32)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, config, redis):
+        mode = config.value('COALESCE')
+        if mode not in (None, 'process', 'redis'):
+            raise ValueError('Unknown coalescing mode %r.' % mode)
+        secret = config.app.secret_key
+        if mode == 'redis' and not secret:
+            raise ValueError('SECRET_KEY is required to coalesce grants '
+                             'across processes.')
+        self.enabled = mode is not None
+        self.shared = mode == 'redis'
+        self.timeout = config.value('COALESCE_TIMEOUT')
+        self.coalesced = 0
+        self._redis = redis
+        self._release = redis.register_script(_RELEASE)
+        if secret:
+            if not isinstance(secret, bytes):
+                secret = secret.encode('utf-8')
+            self._secret = secret
+
+    def key(self, *values):
+        """ Returns the key of a grant made of `values`, which tells nothing
+            of them, passwords included.
+        """
+        message = u'\0'.join(value or u'' for value in values)
+        return hmac.new(self._secret, message.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def run(self, key, work):
+        """ Returns the result of `work`, which is only called once for
+            concurrent calls with the same `key`. Results must be JSON
+            serializable in ``redis`` mode.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.result is not None:
+                self.coalesced += 1
+                return flight.result
+            return work()
+
+        try:
+            if self.shared:
+                flight.result = self._run_shared(key, work)
+            else:
+                flight.result = work()
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _run_shared(self, key, work):
+        """ Runs `work`, or waits for another process to run it. """
+        flight_id = gen_salt(16)
+        timeout = int(self.timeout * 1000)
+        deadline = time.time() + self.timeout
+        leader = None
+        while leader is None:
+            if self._redis.set(FLIGHT_KEY % key, flight_id, px=timeout,
+                               nx=True):
+                return self._lead(key, flight_id, work, timeout)
+            # None if the lock was released meanwhile, then try again.
+            leader = _text(self._redis.get(FLIGHT_KEY % key))
+
+        while time.time() < deadline:
+            # the lock is read first: once it is gone, the answer is there
+            # unless the grant failed.
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.get(FLIGHT_KEY % key)
+            pipe.get(RESULT_KEY % (key, leader))
+            current, value = pipe.execute()
+            if value is not None:
+                self.coalesced += 1
+                return json.loads(_text(value))
+            if _text(current) != leader:
+                # released without an answer, or expired: the grant failed.
+                break
+            time.sleep(POLL_INTERVAL)
+        return work()
+
+    def _lead(self, key, flight_id, work, timeout):
+        """ Runs `work` while holding the lock, and publishes its result. """
+        value = ''
+        try:
+            result = work()
+            value = json.dumps(result)
+            return result
+        finally:
+            self._release(keys=[FLIGHT_KEY % key,
+                                RESULT_KEY % (key, flight_id)],
+                          args=[flight_id, value, timeout])
@@ -8,8 +8,27 @@
 """
 from flask.ext.pymongo import PyMongo
 from flask_oauthlib.provider import OAuth2Provider
-from redis import StrictRedis
+
+from .cache import MetadataCache, TokenCache
+from .coalesce import Coalescer
+from .filters import LookupFilter
+from .hashing import Hasher
+from .metrics import metrics  # noqa
+from .ratelimit import RateLimiter
+from .reuse import TokenReuse
+from .revocation import RevocationQueue
+from .signing import Signer
+from .topology import RedisClient
 
 mongo = PyMongo()
 oauth = OAuth2Provider()
-redis = StrictRedis()
+redis = RedisClient()
+token_cache = TokenCache()
+metadata_cache = MetadataCache()
+hasher = Hasher()
+revocations = RevocationQueue()
+signer = Signer()
+limiter = RateLimiter()
+lookup_filter = LookupFilter()
+token_reuse = TokenReuse()
+coalescer = Coalescer()
@@ -6,15 +6,29 @@
     :copyright: (c) 2015 by Nicola Iarocci.
     :license: BSD, see LICENSE for more details.
 """
+import hmac
 import inspect
+import re
 from collections import namedtuple
 from datetime import datetime, timedelta
 
 import bcrypt
+from bson import json_util
+from flask import current_app
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, \
+    SecondaryPreferred, Nearest
+from pymongo.write_concern import WriteConcern
 from werkzeug.security import gen_salt
 
-from .core import mongo, redis
+from .core import mongo, redis, hasher, lookup_filter, metadata_cache, \
+    revocations, token_cache, token_reuse
+from .indexes import EXPIRED_TOKEN_TTL
+from .metrics import timed
 from .models import Client, User, Token
+from .revocation import REVOKED_KEY
 
 
 # TODO use SONManipulator instead of custom de/serializers perhaps?
@@ -23,6 +37,83 @@ from .models import Client, User, Token
 idFieldsMap = namedtuple('idFields', 'cls, collection')
 id = idFieldsMap(cls='id', collection='_id')
 
+# redis key holding everything needed to rebuild a Token and its User.
+TOKEN_KEY = 'sentinel:token:%s'
+
+# hash checked when a user does not exist, so that unknown users and wrong
+# passwords take the same time. Generated on first use.
+_dummy_hash = []
+
+# compiled serializers, by model class.
+_schemas = {}
+
+# read preferences, by MongoDB mode name.
+_read_preferences = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+class _Schema(object):
+    """ Public attributes of a model class, either slots or properties,
+        along with serializers generated for them, so that the class is only
+        inspected once.
+
+    :param cls: model class.
+    """
+    def __init__(self, cls):
+        members = dict(inspect.getmembers(
+            cls, lambda p: isinstance(p, property)))
+        for klass in cls.__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                if not name.startswith('_'):
+                    members[name] = None
+        self.properties = sorted(members)
+        self.fields = [name for name in self.properties if name != id.cls]
+
+        # readonly properties are serialized but never deserialized.
+        writable = [name for name in self.fields
+                    if members[name] is None or members[name].fset]
+
+        source = [
+            'def to_json(obj):',
+            '    json = {%s}' % ', '.join(
+                '%r: obj.%s' % (name, name) for name in self.fields),
+            '    if obj.%s is not None:' % id.cls,
+            '        json[%r] = obj.%s' % (id.collection, id.cls),
+            '    return json',
+            '',
+            'def from_json(json):',
+            '    obj = cls()',
+        ]
+        for name in writable:
+            source.extend([
+                '    if %r in json:' % name,
+                '        obj.%s = json[%r]' % (name, name),
+            ])
+        source.extend([
+            '    if json.get(%r) is not None:' % id.collection,
+            '        obj.%s = json[%r]' % (id.cls, id.collection),
+            '    return obj',
+        ])
+
+        namespace = {'cls': cls}
+        exec(compile('\n'.join(source), '<%s schema>' % cls.__name__,
+                     'exec'), namespace)
+        self.to_json = namespace['to_json']
+        self.from_json = namespace['from_json']
+
+
+def _schema(cls):
+    """ Returns the (cached) schema of a model class. """
+    schema = _schemas.get(cls)
+    if schema is None:
+        schema = _schemas[cls] = _Schema(cls)
+    return schema
+
 
 def _from_json(json, cls, as_list=False):
     """ Serializes a JSON stream to a list of objects, or a single objects
@@ -35,26 +126,12 @@ def _from_json(json, cls, as_list=False):
     if json is None:
         return None
 
+    from_json = _schema(cls).from_json
     if not isinstance(json, list):
-        json = [json]
-
-    objs = []
-    for json_item in json:
-        obj = cls()
-
-        properties, json_keys = set(_properties(obj)), set(json_item.keys())
-        for property in set.intersection(properties, json_keys):
-            try:
-                setattr(obj, property, json_item[property])
-            except AttributeError:
-                # Probably a readonly property.
-                pass
-
-        if id.collection in json_item and json_item[id.collection] is not None:
-            setattr(obj, id.cls, json_item[id.collection])
-
-        objs.append(obj)
+        obj = from_json(json)
+        return [obj] if as_list else obj
 
+    objs = [from_json(json_item) for json_item in json]
     return objs if as_list else (objs.pop() if len(objs) else None)
 
 
@@ -63,16 +140,7 @@ def _to_json(obj):
 
     :param obj: object to be serialized to JSON.
     """
-
-    json = {}
-    for prop in _properties(obj):
-        json[prop] = getattr(obj, prop)
-
-    objid = getattr(obj, id.cls)
-    if objid is not None:
-        json[id.collection] = objid
-
-    return json
+    return _schema(obj.__class__).to_json(obj)
 
 
 def _properties(obj, include_id=False):
@@ -81,71 +149,481 @@ def _properties(obj, include_id=False):
     :param obj: object to be inspected.
     :param include_id: True if db.cls (usually 'id') is to be included.
     """
-    a = [
-        name for (name, value) in inspect.getmembers(
-            obj.__class__, lambda p: isinstance(p, property)
-        ) if name != id.cls or include_id
-    ]
-    return a
+    schema = _schema(obj.__class__)
+    return list(schema.properties if include_id else schema.fields)
 
 
-class Storage(object):
+def _encode(value):
+    """ Returns `value` as utf-8 encoded bytes. """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+
+def _check_password(password, hashpw):
+    """ Checks `password` against a bcrypt hash in constant time.
+
+    :param password: clear text password.
+    :param hashpw: bcrypt hash, or None if the user does not exist. The
+                   password is then checked against a dummy hash and the
+                   check fails.
+    """
+    if hashpw is None:
+        if not _dummy_hash:
+            _dummy_hash.append(bcrypt.hashpw(b'', bcrypt.gensalt()))
+        hashpw, found = _dummy_hash[0], False
+    else:
+        hashpw, found = _encode(hashpw), True
+
+    match = hmac.compare_digest(hasher.hashpw(_encode(password), hashpw),
+                                hashpw)
+    return match and found
+
+
+def _page(collection, field, cls, projection, after=None, prefix=None,
+          limit=50):
+    """ Returns a page of documents sorted by `field` as a list of `cls`
+        objects, along with the `field` value the next page starts after, or
+        None if this is the last page.
+
+    :param collection: pymongo collection.
+    :param field: indexed field the documents are sorted and searched by.
+    :param cls: target class.
+    :param projection: fields to be loaded.
+    :param after: only return documents whose `field` sorts after this.
+    :param prefix: only return documents whose `field` starts with this.
+    :param limit: page size.
+    """
+    spec = {}
+    if prefix:
+        # anchored, case sensitive regular expressions use the index.
+        spec[field] = {'$regex': '^%s' % re.escape(prefix)}
+    if after is not None:
+        spec.setdefault(field, {})['$gt'] = after
+
+    json = list(collection.find(spec, projection).sort(field, ASCENDING)
+                .limit(limit + 1))
+    objs = _from_json(json, cls, as_list=True)
+    if len(objs) > limit:
+        return objs[:limit], getattr(objs[limit - 1], field)
+    return objs, None
+
+
+def _count(collection, field, prefix=None):
+    """ Returns the number of documents whose `field` starts with `prefix`.
+        Without a prefix the count is estimated from collection metadata.
+    """
+    if not prefix:
+        return collection.count()
+    return collection.count({field: {'$regex': '^%s' % re.escape(prefix)}})
+
+
+def _write_concern(config):
+    """ Returns the WriteConcern configured in `config`, or None. """
+    options = {}
+    for option, key in (('w', 'SENTINEL_WRITE_CONCERN'),
+                        ('j', 'SENTINEL_WRITE_JOURNAL')):
+        value = config[key]
+        if value is not None:
+            options[option] = value
+    return WriteConcern(**options) if options else None
+
+
+def _writes(collection):
+    """ Returns `collection` with the configured write concern, if any. """
+    write_concern = _write_concern(current_app.config)
+    if write_concern is None:
+        return collection
+    return collection.with_options(write_concern=write_concern)
+
+
+def _read_options(config, operation):
+    """ Returns the read preference and read concern configured for a
+        storage `operation`, like 'get_token', as `with_options` arguments.
+        Raises ValueError for unknown read preferences.
+    """
+    options = {}
+    mode = (config['SENTINEL_MONGO_READ_PREFERENCES'] or {}).get(operation)
+    if isinstance(mode, tuple(_read_preferences.values())):
+        options['read_preference'] = mode
+    elif mode is not None:
+        if mode not in _read_preferences:
+            raise ValueError('No such read preference: %r' % mode)
+        cls = _read_preferences[mode]
+        staleness = config['SENTINEL_MONGO_MAX_STALENESS']
+        if cls is Primary or staleness is None:
+            options['read_preference'] = cls()
+        else:
+            options['read_preference'] = cls(max_staleness=staleness)
+
+    level = (config['SENTINEL_MONGO_READ_CONCERNS'] or {}).get(operation)
+    if level is not None:
+        options['read_concern'] = ReadConcern(level)
+    return options
+
+
+def _reads(collection, operation):
+    """ Returns `collection` with the read preference and read concern
+        configured for `operation`, if any.
+    """
+    options = _read_options(current_app.config, operation)
+    return collection.with_options(**options) if options else collection
+
+
+def _find_one(collection, operation, spec, projection=None):
+    """ Finds a document as configured for `operation`. Documents missing
+        on a secondary are looked up on the primary, as they may not have
+        been replicated yet.
+    """
+    reads = _reads(collection, operation)
+    json = reads.find_one(spec, projection)
+    if json is None and reads.read_preference.mode != Primary().mode:
+        json = reads.with_options(read_preference=Primary()).find_one(
+            spec, projection)
+    return json
+
+
+def _cache_token(token, user, ttl=None):
+    """ Returns a (key, ttl, value) tuple suitable for caching `token` in
+        redis with SETEX, or None if the token cannot be cached.
+
+    :param token: Token instance.
+    :param user: User instance the token has been issued to.
+    :param ttl: key lifetime in seconds. Defaults to the token remaining
+                lifetime.
+    """
+    if user is None or token.expires is None:
+        return None
+
+    if ttl is None:
+        ttl = int((token.expires - datetime.utcnow()).total_seconds())
+    if ttl <= 0:
+        return None
+
+    value = json_util.dumps({
+        'client_id': token.client_id,
+        'user_id': token.user_id,
+        'username': user.username,
+        'token_type': token.token_type,
+        'refresh_token': token.refresh_token,
+        'expires': token.expires,
+        'scopes': token.scopes,
+    })
+    return TOKEN_KEY % token.access_token, ttl, value
+
+
+def _snapshot(user):
+    """ Returns the copy of `user` embedded in the documents of the tokens
+        issued to it, so that a token and its user are loaded by a single
+        query. Its version tells stale copies apart, see
+        :meth:`MongoBackend.update_user`.
+    """
+    return {'username': user.username, 'version': user.version or 0}
+
+
+def _stale_snapshots(user):
+    """ Returns the spec of the token documents of `user` whose user copy is
+        older than `user`, or missing.
+    """
+    return {'user_id': user.id, '$or': [
+        {'user': None}, {'user.version': {'$lt': user.version}}]}
+
+
+def _token_from_json(json):
+    """ Returns a token document as a Token, along with the User embedded
+        in it. Documents written before users were embedded come with no
+        User.
+    """
+    token = _from_json(json, Token)
+    if token is None:
+        return None
+    snapshot, token.user = token.user, None
+    if snapshot:
+        token.user = User(id=token.user_id, username=snapshot['username'],
+                          version=snapshot['version'])
+    return token
+
+
+def _cached_token(access_token):
+    """ Loads a token from the redis cache and returns it as a Token or None.
+
+    :param access_token: the access token to look for.
+    """
+    return _load_token(access_token,
+                       redis.read('get', TOKEN_KEY % access_token))
+
+
+def _load_token(access_token, value):
+    """ Rebuilds a Token from its redis cache `value`, see
+        :func:`_cache_token`.
+    """
+    if value is None:
+        return None
+
+    if not isinstance(value, str):
+        value = value.decode('utf-8')
+    json = json_util.loads(value)
+
+    token = Token(
+        client_id=json['client_id'],
+        user_id=json['user_id'],
+        token_type=json['token_type'],
+        access_token=access_token,
+        refresh_token=json['refresh_token'],
+        expires=json['expires'],
+        scopes=json['scopes'],
+    )
+    token.user = User(id=json['user_id'], username=json['username'])
+    return token
+
+
+class Backend(object):
+    """ Storage backend interface, which :class:`Storage` forwards every call
+        to. Backends are selected with ``SENTINEL_BACKEND``, see
+        :func:`flask_sentinel.backends.load`.
+
+    Users and clients returned by the page methods carry no password hash.
+    Pages are sorted by username, or client_id, and come along with the key
+    the next page starts after, or None if this is the last page.
+    """
+    def get_client(self, client_id):
+        """ Returns a Client, or None. """
+        raise NotImplementedError
+
+    def get_user(self, username, password, *args, **kwargs):
+        """ Returns a User, or None if there is no such user or `password`
+            does not match. Unchecked without a password.
+        """
+        raise NotImplementedError
+
+    def get_token(self, access_token=None, refresh_token=None):
+        """ Returns a Token, along with its User, or None. """
+        raise NotImplementedError
+
+    def get_tokens(self, access_tokens):
+        """ Returns a list holding a Token, or None, for each access token.
+        """
+        return [self.get_token(access_token=access_token)
+                for access_token in access_tokens]
+
+    def save_token(self, token, request, *args, **kwargs):
+        """ Stores a token issued by oauthlib, replacing the previous token
+            of the same client and user.
+        """
+        raise NotImplementedError
+
+    def revoke_token(self, token, token_type_hint=None, client_id=None):
+        """ Revokes an access or refresh token, along with its counterpart,
+            and returns it as a Token, or None if there was no such token.
+        """
+        raise NotImplementedError
+
+    def generate_client(self):
+        raise NotImplementedError
+
+    def save_user(self, username, password):
+        """ Creates a user, unless the username is taken: MongoDB raises
+            DuplicateKeyError then, and the other backends ValueError.
+        """
+        raise NotImplementedError
+
+    def update_user(self, user_id, username=None, password=None):
+        """ Renames a user and/or changes its password, and returns it as a
+            User, or None if there is no such user. Tokens issued to the
+            user are kept, and carry the new username from then on. Taken
+            usernames are refused as with :meth:`save_user`.
+        """
+        raise NotImplementedError
+
+    def all_users(self):
+        raise NotImplementedError
+
+    def all_clients(self):
+        raise NotImplementedError
+
+    def users_page(self, after=None, prefix=None, limit=50):
+        raise NotImplementedError
+
+    def clients_page(self, after=None, prefix=None, limit=50):
+        raise NotImplementedError
+
+    def count_users(self, prefix=None):
+        raise NotImplementedError
+
+    def count_clients(self, prefix=None):
+        raise NotImplementedError
+
+
+class MongoBackend(Backend):
+    """ Stores everything in MongoDB, with access tokens cached in redis.
+        This is the default backend.
+    """
 
     @staticmethod
     def get_client(client_id):
         """ Loads a client from mongodb and returns it as a Client or None.
+            Clients are served from the metadata cache, if enabled.
         """
-        json = mongo.db.clients.find_one({'client_id': client_id})
-        return _from_json(json, Client)
+        if metadata_cache.enabled:
+            client = metadata_cache.get_client(client_id)
+            if client is not None:
+                return client
+            generation = metadata_cache.generation
+        if lookup_filter.enabled and lookup_filter.rejects('client',
+                                                           client_id):
+            return None
+        json = _find_one(mongo.db.clients, 'get_client',
+                         {'client_id': client_id})
+        if json is None and lookup_filter.enabled:
+            lookup_filter.missed('client', client_id)
+        client = _from_json(json, Client)
+        if client is not None and metadata_cache.enabled:
+            metadata_cache.set_client(client, generation)
+        return client
 
     @staticmethod
     def get_user(username, password, *args, **kwargs):
         """ Loads a user from mongodb and returns it as a User or None.
+
+        The password is checked in constant time, and unknown users cost
+        as much as wrong passwords. If no password is provided the user is
+        returned unchecked.
         """
-        user = mongo.db.users.find_one({'username': username})
-        if user and password:
-            encoded_pw = password.encode('utf-8')
-            user_hash = user['hashpw'].encode('utf-8')
-            user = mongo.db.users.find_one({
-                'username': username,
-                'hashpw': bcrypt.hashpw(encoded_pw, user_hash)
-            })
+        user = _find_one(mongo.db.users, 'get_user', {'username': username},
+                         {'username': True, 'hashpw': True, 'version': True})
+        if password:
+            hashpw = user['hashpw'] if user else None
+            if not _check_password(password, hashpw):
+                return None
         return _from_json(user, User)
 
     @staticmethod
     def get_token(access_token=None, refresh_token=None):
-        """ Loads a token from mongob and returns it as a Token or None.
+        """ Loads a token and returns it as a Token or None.
+
+        Access tokens are served from the in-process cache, if enabled,
+        then from the redis cache whenever possible. MongoDB is only hit on
+        a cache miss, which also refills the caches. Token documents embed
+        their user, which is only looked up for documents written before
+        that. Unknown tokens are mostly told apart by the lookup filter,
+        if enabled, without querying the database.
         """
         if not (access_token or refresh_token):
             return None
 
         if access_token:
-            field, value = 'access_token', access_token
+            if token_cache.enabled:
+                token = token_cache.get(access_token)
+                if token is not None:
+                    return token
+                # recorded before the token is read, so that it is not
+                # cached if revoked meanwhile.
+                generation = token_cache.generation
+            token = _cached_token(access_token)
+            if token is not None:
+                if token_cache.enabled:
+                    token_cache.set(token, generation)
+                return token
+            kind, field, value = 'access', 'access_token', access_token
         elif refresh_token:
-            field, value = 'refresh_token', refresh_token
+            kind, field, value = 'refresh', 'refresh_token', refresh_token
 
-        json = mongo.db.tokens.find_one({field: value})
-        token = _from_json(json, Token)
+        if lookup_filter.enabled and lookup_filter.rejects(kind, value):
+            return None
+        json = _find_one(mongo.db.tokens, 'get_token', {field: value})
+        token = _token_from_json(json)
         if token is None:
+            if lookup_filter.enabled:
+                lookup_filter.missed(kind, value)
+            return None
+
+        if token.user is None:
+            token.user = MongoBackend._user(token.user_id)
+
+        # Revoked tokens are only deleted from the database later on. The
+        # revoked mark is checked along with the cache refill, so that a
+        # token revoked meanwhile is not put back in the cache either.
+        pipe = redis.pipeline()
+        cache = _cache_token(token, token.user)
+        if cache is not None:
+            pipe.setex(*cache)
+        pipe.exists(REVOKED_KEY % token.access_token)
+        if pipe.execute()[-1]:
+            if cache is not None:
+                redis.delete(cache[0])
             return None
 
-        json = mongo.db.users.find_one({id.collection: token.user_id})
-        token.user = _from_json(json, User)
+        if cache is not None and access_token and token_cache.enabled:
+            token_cache.set(token, generation)
 
         return token
 
+    @staticmethod
+    def _user(user_id):
+        """ Loads a user, without its password hash, from the metadata
+            cache if enabled, or from mongodb.
+        """
+        if metadata_cache.enabled:
+            user = metadata_cache.get_user(user_id)
+            if user is not None:
+                return user
+            generation = metadata_cache.generation
+        json = _find_one(mongo.db.users, 'get_token',
+                         {id.collection: user_id},
+                         {'username': True, 'version': True})
+        user = _from_json(json, User)
+        if user is not None and metadata_cache.enabled:
+            metadata_cache.set_user(user, generation)
+        return user
+
+    @staticmethod
+    def get_tokens(access_tokens):
+        """ Loads many access tokens at once and returns a list holding a
+            Token, or None, for each of them.
+
+        Tokens missing from the in-process cache are fetched from the redis
+        cache with a single MGET. The ones missing there too are loaded one
+        by one with :meth:`get_token`.
+        """
+        tokens = [None] * len(access_tokens)
+        missing = []
+        for index, access_token in enumerate(access_tokens):
+            if token_cache.enabled:
+                tokens[index] = token_cache.get(access_token)
+            if tokens[index] is None:
+                missing.append(index)
+        if not missing:
+            return tokens
+
+        generation = token_cache.generation
+        values = redis.read('mget', [TOKEN_KEY % access_tokens[index]
+                                     for index in missing])
+        for index, value in zip(missing, values):
+            token = _load_token(access_tokens[index], value)
+            if token is None:
+                token = MongoBackend.get_token(
+                    access_token=access_tokens[index])
+            elif token_cache.enabled:
+                token_cache.set(token, generation)
+            tokens[index] = token
+        return tokens
+
     @staticmethod
     def save_token(token, request, *args, **kwargs):
+        """ Stores a token issued by oauthlib. With token reuse enabled,
+            password grants may be answered with the current token of the
+            client and user instead, which `token` is then updated with.
+        """
+        if token_reuse.enabled and token_reuse.reuse(token, request):
+            return
+
         client_id = request.client.client_id
         user_id = request.user.id
 
-        # Make sure there is only one grant token for every (client, user)
-        mongo.db.tokens.remove({'client_id': client_id, 'user_id': user_id})
-
         expires_in = token.get('expires_in')
         expires = datetime.utcnow() + timedelta(seconds=expires_in)
 
-        token = Token(
+        issued, token = token, Token(
             client_id=request.client.client_id,
             user_id=user_id,
             token_type=token['token_type'],
@@ -155,28 +633,150 @@ class Storage(object):
         )
 
         # Add the access token to the Redis cache and set it to
-        # expire at the appropriate time.
-        redis.setex(token.access_token, expires_in, user_id)
+        # expire at the appropriate time. Besides the plain access token
+        # key, which maps to the user id, we also cache everything needed
+        # to validate the token without hitting the database. This is done
+        # before the database write, so that a grant racing with this one
+        # can never put back a token that this one replaced.
+        pipe = redis.pipeline(transaction=False)
+        pipe.setex(token.access_token, expires_in, str(user_id))
+        cache = _cache_token(token, request.user, expires_in)
+        if cache is not None:
+            pipe.setex(*cache)
+        if lookup_filter.enabled:
+            lookup_filter.add([('access', token.access_token),
+                               ('refresh', token.refresh_token)], pipe)
+        if token_reuse.enabled:
+            token_reuse.remember(issued, request, pipe)
+        pipe.execute()
+
+        # Replace the token of this (client, user) if it exists already,
+        # insert it otherwise, and get the replaced one back so that it is not
+        # served from the cache anymore. Two grants racing to insert the
+        # first token for a pair conflict on the unique index, in which case
+        # the loser replaces the winner's token.
+        spec = {'client_id': client_id, 'user_id': user_id}
+        json = _to_json(token)
+        json['user'] = _snapshot(request.user)
+        tokens = _writes(mongo.db.tokens)
+        try:
+            old = tokens.find_and_modify(spec, json, upsert=True,
+                                         fields={'access_token': True})
+        except DuplicateKeyError:
+            old = tokens.find_and_modify(spec, json, upsert=True,
+                                         fields={'access_token': True})
+
+        if old is not None:
+            pipe = redis.pipeline(transaction=False)
+            pipe.delete(old['access_token'])
+            pipe.delete(TOKEN_KEY % old['access_token'])
+            if token_cache.enabled:
+                token_cache.publish(old['access_token'], pipe)
+            pipe.execute()
 
-        spec = {'user_id': user_id, 'client_id': client_id}
+    @staticmethod
+    def revoke_token(token, token_type_hint=None, client_id=None):
+        """ Revokes an access or refresh token, along with its counterpart,
+            and returns it as a Token, or None if there was no such token.
+
+        The token is rejected right away, by marking it as revoked and
+        dropping it from the caches, while its document is deleted from the
+        database in the background, see :class:`RevocationQueue`.
+
+        :param token: the access or refresh token.
+        :param token_type_hint: 'access_token' or 'refresh_token', the kind
+                                of token looked for first.
+        :param client_id: when given, tokens issued to other clients are
+                          left alone.
+        """
+        fields = ['access_token', 'refresh_token']
+        if token_type_hint == 'refresh_token':
+            fields.reverse()
+        for field in fields:
+            tok = MongoBackend.get_token(**{field: token})
+            if tok is not None:
+                break
+        if tok is None or client_id not in (None, tok.client_id):
+            return None
 
-        # Replace token if it exists already, insert otherwise.
-        mongo.db.tokens.update(spec, _to_json(token), upsert=True)
+        # the mark must last as long as the document might, that is until
+        # the expired tokens TTL index reaps it.
+        ttl = current_app.config['SENTINEL_EXPIRED_TOKEN_TTL']
+        if ttl is None or ttl is False:
+            ttl = EXPIRED_TOKEN_TTL
+        ttl += max(int((tok.expires - datetime.utcnow()).total_seconds()), 0)
+
+        pipe = redis.pipeline()
+        pipe.setex(REVOKED_KEY % tok.access_token, ttl, 1)
+        pipe.delete(tok.access_token)
+        pipe.delete(TOKEN_KEY % tok.access_token)
+        if token_cache.enabled:
+            token_cache.publish(tok.access_token, pipe)
+        if token_reuse.enabled:
+            token_reuse.forget(tok.client_id, tok.user_id, pipe)
+        revocations.push(tok.access_token, pipe)
+        pipe.execute()
+        revocations.notify()
+        return tok
 
     @staticmethod
     def generate_client():
         client = Client()
         client.client_id = gen_salt(40)
         client.client_type = "public"
-        mongo.db.clients.insert(_to_json(client))
+        _writes(mongo.db.clients).insert(_to_json(client))
+        if lookup_filter.enabled:
+            lookup_filter.add([('client', client.client_id)])
         return client
 
     @staticmethod
     def save_user(username, password):
         salt = bcrypt.gensalt()
-        hash = bcrypt.hashpw(password.encode('utf-8'), salt)
-        user = User(username=username, hashpw=hash)
-        user.id = mongo.db.users.insert(_to_json(user))
+        hash = hasher.hashpw(password.encode('utf-8'), salt)
+        user = User(username=username, hashpw=hash, version=0)
+        user.id = _writes(mongo.db.users).insert(_to_json(user))
+        return user
+
+    @staticmethod
+    def update_user(user_id, username=None, password=None):
+        """ Updates a user and returns it as a User, or None if there is no
+            such user.
+
+        Every update bumps the user version. The copies of the user embedded
+        in its token documents are then replaced, unless a later update got
+        there first, and the tokens are dropped from the caches, which hold
+        the username as well.
+        """
+        changes = {}
+        if username:
+            changes['username'] = username
+        if password:
+            changes['hashpw'] = hasher.hashpw(password.encode('utf-8'),
+                                              bcrypt.gensalt())
+        update = {'$inc': {'version': 1}}
+        if changes:
+            update['$set'] = changes
+        json = _writes(mongo.db.users).find_and_modify(
+            {id.collection: user_id}, update, new=True,
+            fields={'username': True, 'version': True})
+        user = _from_json(json, User)
+        if user is None:
+            return None
+        if metadata_cache.enabled:
+            metadata_cache.bump(users=True)
+
+        tokens = _writes(mongo.db.tokens)
+        stale = [json['access_token'] for json in tokens.find(
+            _stale_snapshots(user), {'access_token': True})]
+        if stale:
+            tokens.update(_stale_snapshots(user),
+                          {'$set': {'user': _snapshot(user)}}, multi=True)
+            pipe = redis.pipeline(transaction=False)
+            for access_token in stale:
+                pipe.delete(TOKEN_KEY % access_token)
+                if token_cache.enabled:
+                    token_cache.publish(access_token, pipe)
+            pipe.execute()
         return user
 
     @staticmethod
@@ -188,3 +788,113 @@ class Storage(object):
     def all_clients():
         json = list(mongo.db.clients.find())
         return _from_json(json, Client, as_list=True)
+
+    @staticmethod
+    def users_page(after=None, prefix=None, limit=50):
+        """ Returns a page of users sorted by username, without their
+            password hash, along with the username the next page starts
+            after. See :func:`_page`.
+        """
+        return _page(_reads(mongo.db.users, 'users_page'), 'username', User,
+                     {'username': True}, after, prefix, limit)
+
+    @staticmethod
+    def clients_page(after=None, prefix=None, limit=50):
+        """ Returns a page of clients sorted by client_id, along with the
+            client_id the next page starts after. See :func:`_page`.
+        """
+        return _page(_reads(mongo.db.clients, 'clients_page'), 'client_id',
+                     Client, {'client_id': True, 'client_type': True}, after,
+                     prefix, limit)
+
+    @staticmethod
+    def count_users(prefix=None):
+        return _count(_reads(mongo.db.users, 'count_users'), 'username',
+                      prefix)
+
+    @staticmethod
+    def count_clients(prefix=None):
+        return _count(_reads(mongo.db.clients, 'count_clients'),
+                      'client_id', prefix)
+
+
+class Storage(object):
+    """ Storage layer the validator and the views talk to. Every call is
+        timed, then forwarded to the configured :class:`Backend`.
+    """
+    backend = MongoBackend()
+
+    @staticmethod
+    @timed('storage.get_client')
+    def get_client(client_id):
+        return Storage.backend.get_client(client_id)
+
+    @staticmethod
+    @timed('storage.get_user')
+    def get_user(username, password, *args, **kwargs):
+        return Storage.backend.get_user(username, password, *args, **kwargs)
+
+    @staticmethod
+    @timed('storage.get_token')
+    def get_token(access_token=None, refresh_token=None):
+        return Storage.backend.get_token(access_token, refresh_token)
+
+    @staticmethod
+    @timed('storage.get_tokens')
+    def get_tokens(access_tokens):
+        return Storage.backend.get_tokens(access_tokens)
+
+    @staticmethod
+    @timed('storage.save_token')
+    def save_token(token, request, *args, **kwargs):
+        return Storage.backend.save_token(token, request, *args, **kwargs)
+
+    @staticmethod
+    @timed('storage.revoke_token')
+    def revoke_token(token, token_type_hint=None, client_id=None):
+        return Storage.backend.revoke_token(token, token_type_hint, client_id)
+
+    @staticmethod
+    @timed('storage.generate_client')
+    def generate_client():
+        return Storage.backend.generate_client()
+
+    @staticmethod
+    @timed('storage.save_user')
+    def save_user(username, password):
+        return Storage.backend.save_user(username, password)
+
+    @staticmethod
+    @timed('storage.update_user')
+    def update_user(user_id, username=None, password=None):
+        return Storage.backend.update_user(user_id, username, password)
+
+    @staticmethod
+    @timed('storage.all_users')
+    def all_users():
+        return Storage.backend.all_users()
+
+    @staticmethod
+    @timed('storage.all_clients')
+    def all_clients():
+        return Storage.backend.all_clients()
+
+    @staticmethod
+    @timed('storage.users_page')
+    def users_page(after=None, prefix=None, limit=50):
+        return Storage.backend.users_page(after, prefix, limit)
+
+    @staticmethod
+    @timed('storage.clients_page')
+    def clients_page(after=None, prefix=None, limit=50):
+        return Storage.backend.clients_page(after, prefix, limit)
+
+    @staticmethod
+    @timed('storage.count_users')
+    def count_users(prefix=None):
+        return Storage.backend.count_users(prefix)
+
+    @staticmethod
+    @timed('storage.count_clients')
+    def count_clients(prefix=None):
+        return Storage.backend.count_clients(prefix)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.filters
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import hashlib
+import math
+import struct
+import threading
+
+# redis key remembering that a token or client does not exist, by kind
+# ('access', 'refresh' or 'client') and value.
+MISS_KEY = 'sentinel:miss:%s:%s'
+
+# redis bitmaps of the Bloom filter, and of the one being rebuilt. The braces
+# keep both on one cluster slot.
+FILTER_KEY = '{sentinel:filter}'
+NEXT_FILTER_KEY = '{sentinel:filter}:next'
+
+# seconds an interrupted rebuild keeps the next filter around.
+REBUILD_TIMEOUT = 3600
+
+# KEYS: the filter and the one being rebuilt. ARGV: bit positions. Bits are
+# only set in existing filters, as a filter is incomplete until built.
+_ADD = """
+for i = 1, 2 do
+    if redis.call('exists', KEYS[i]) == 1 then
+        for _, bit in ipairs(ARGV) do
+            redis.call('setbit', KEYS[i], bit, 1)
+        end
+    end
+end
+return 0
+"""
+
+
+class BloomFilter(object):
+    """ Size and hash functions of a Bloom filter holding `capacity` items
+        with a false positive rate of `error_rate`.
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+
+    def positions(self, item):
+        """ Returns the bits of `item`, by double hashing. """
+        digest = hashlib.md5(item.encode('utf-8')).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def false_positive_rate(self, bits_set):
+        """ Estimated false positive rate once `bits_set` bits are set. """
+        return (float(bits_set) / self.size) ** self.hashes
+
+
+class LookupFilter(object):
+    """ Rejects lookups of unknown tokens and clients before they reach
+        MongoDB.
+
+    Lookups which missed in the database are remembered in redis for
+    ``SENTINEL_NEGATIVE_CACHE_TTL`` seconds. Besides, a Bloom filter of the
+    access tokens, refresh tokens and client ids in the database answers
+    for the values it has never seen, like random ones. It is kept in redis
+    and shared by every process, or in the memory of the current process,
+    in which case it only knows the tokens and clients created by the
+    process itself and must not be used by more than one process.
+
+    Filters cannot forget: revoked and expired tokens take up room until
+    the filter is rebuilt, see :meth:`rebuild`.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.ttl = None
+        self.mode = None
+        self.bloom = BloomFilter(1000000, 0.001)
+        self.negative_hits = 0
+        self.filtered = 0
+
+        self._redis = None
+        self._add = None
+        self._bits = None
+        self._next = None
+        self._lock = threading.Lock()
+
+    def init_app(self, config, redis):
+        self.ttl = config.value('NEGATIVE_CACHE_TTL')
+        self.mode = config.value('FILTER')
+        if self.mode not in (None, 'redis', 'memory'):
+            raise ValueError('Unknown filter %r.' % self.mode)
+        self.bloom = BloomFilter(config.value('FILTER_CAPACITY'),
+                                 config.value('FILTER_ERROR_RATE'))
+        self.enabled = bool(self.ttl) or self.mode is not None
+        self.negative_hits = self.filtered = 0
+        self._redis = redis
+        self._add = redis.register_script(_ADD)
+        self._bits = self._next = None
+
+    @property
+    def built(self):
+        """ Whether the Bloom filter holds every existing value. """
+        if self.mode == 'redis':
+            return bool(self._redis.exists(FILTER_KEY))
+        return self._bits is not None
+
+    def rejects(self, kind, value):
+        """ Returns True if there is surely no token, or client, `value`.
+
+        :param kind: 'access', 'refresh' or 'client'.
+        """
+        positions = None
+        if self.mode is not None:
+            positions = self.bloom.positions('%s:%s' % (kind, value))
+        if self.mode == 'memory' and self._bits is not None:
+            if not all(self._bits[p >> 3] & (1 << (p & 7))
+                       for p in positions):
+                self.filtered += 1
+                return True
+        if not self.ttl and self.mode != 'redis':
+            return False
+
+        pipe = self._redis.pipeline(transaction=False)
+        if self.ttl:
+            pipe.exists(MISS_KEY % (kind, value))
+        if self.mode == 'redis':
+            pipe.exists(FILTER_KEY)
+            for position in positions:
+                pipe.getbit(FILTER_KEY, position)
+        values = pipe.execute()
+        if self.ttl and values.pop(0):
+            self.negative_hits += 1
+            return True
+        if self.mode == 'redis' and values[0] and not all(values[1:]):
+            self.filtered += 1
+            return True
+        return False
+
+    def missed(self, kind, value):
+        """ Remembers that a lookup missed in the database. """
+        if self.ttl:
+            self._redis.setex(MISS_KEY % (kind, value), self.ttl, 1)
+
+    def add(self, items, pipe=None):
+        """ Adds new tokens, or clients, to the filter.
+
+        :param items: list of (kind, value) tuples.
+        :param pipe: redis pipeline the additions are queued on, if any.
+        """
+        execute = pipe is None
+        if execute:
+            pipe = self._redis.pipeline(transaction=False)
+        positions = self.queue(items, pipe)
+        if positions:
+            self._add(keys=[FILTER_KEY, NEXT_FILTER_KEY], args=positions,
+                      client=pipe)
+        if execute:
+            pipe.execute()
+
+    def queue(self, items, pipe):
+        """ Like :meth:`add`, but returns the bits to set in the redis
+            filter instead of queuing the :data:`_ADD` script on `pipe`, for
+            clients the script is not registered with, like asyncio ones.
+        """
+        positions = []
+        for kind, value in items:
+            if self.ttl:
+                pipe.delete(MISS_KEY % (kind, value))
+            if self.mode is not None:
+                positions.extend(self.bloom.positions('%s:%s' % (kind,
+                                                                 value)))
+        if self.mode == 'memory':
+            with self._lock:
+                for bits in (self._bits, self._next):
+                    if bits is not None:
+                        self._set(bits, positions)
+            return []
+        return positions
+
+    def rebuild(self, items, batch_size=10000):
+        """ Replaces the Bloom filter with one holding `items` only, and
+            returns the number of items, or None if another process is
+            rebuilding the redis filter already. Values added meanwhile are
+            kept.
+
+        :param items: iterable of (kind, value) tuples, see :func:`items`.
+        """
+        if self.mode == 'memory':
+            with self._lock:
+                self._next = bytearray((self.bloom.size + 7) // 8)
+            count = 0
+            for kind, value in items:
+                positions = self.bloom.positions('%s:%s' % (kind, value))
+                with self._lock:
+                    self._set(self._next, positions)
+                count += 1
+            with self._lock:
+                self._bits, self._next = self._next, None
+            return count
+
+        # once the next filter exists, additions go there too.
+        if not self._redis.set(NEXT_FILTER_KEY,
+                               bytes(bytearray((self.bloom.size + 7) // 8)),
+                               ex=REBUILD_TIMEOUT, nx=True):
+            return None
+        count = 0
+        pipe = self._redis.pipeline(transaction=False)
+        for kind, value in items:
+            for position in self.bloom.positions('%s:%s' % (kind, value)):
+                pipe.setbit(NEXT_FILTER_KEY, position, 1)
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.rename(NEXT_FILTER_KEY, FILTER_KEY)
+        pipe.persist(FILTER_KEY)
+        pipe.execute()
+        return count
+
+    def stats(self):
+        bits_set = 0
+        if self.mode == 'redis':
+            bits_set = self._redis.bitcount(FILTER_KEY)
+        elif self._bits is not None:
+            with self._lock:
+                bits_set = sum(bin(byte).count('1') for byte in self._bits)
+        return {
+            'negative_hits': self.negative_hits,
+            'filtered': self.filtered,
+            'bytes': (self.bloom.size + 7) // 8 if self.mode else 0,
+            'hashes': self.bloom.hashes,
+            'fill': float(bits_set) / self.bloom.size,
+            'false_positive_rate': self.bloom.false_positive_rate(bits_set),
+        }
+
+    def _set(self, bits, positions):
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+
+
+def items(db):
+    """ Yields a (kind, value) tuple for every token and client stored in
+        the MongoDB database `db`.
+    """
+    fields = {'access_token': True, 'refresh_token': True}
+    for json in db.tokens.find({}, fields):
+        yield 'access', json['access_token']
+        if json.get('refresh_token'):
+            yield 'refresh', json['refresh_token']
+    for json in db.clients.find({}, {'client_id': True}):
+        yield 'client', json['client_id']
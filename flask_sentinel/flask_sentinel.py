@@ -6,13 +6,17 @@
     :copyright: (c) 2015 by Nicola Iarocci.
     :license: BSD, see LICENSE for more details.
 """
-from flask import Blueprint
+from flask import Blueprint, current_app
+from oauthlib.oauth2.rfc6749.tokens import random_token_generator
+from pymongo.errors import ConnectionFailure
 
-from . import views
-from .core import oauth, mongo, redis
+from . import backends, filters, indexes, views
+from .core import oauth, mongo, redis, coalescer, hasher, limiter, \
+    lookup_filter, metadata_cache, metrics, revocations, signer, \
+    token_cache, token_reuse
+from .data import MongoBackend, Storage, _read_options
 from .utils import Config
 from .validator import MyRequestValidator
-from redis.connection import ConnectionPool
 
 
 class ResourceOwnerPasswordCredentials(object):
@@ -23,8 +27,24 @@ class ResourceOwnerPasswordCredentials(object):
 
     def init_app(self, app):
         config = Config(app)
-        redis.connection_pool = ConnectionPool.from_url(
-            config.value('REDIS_URL'))
+        redis.init_app(config)
+        token_cache.init_app(config, redis)
+        metadata_cache.init_app(config, redis, mongo)
+        hasher.init_app(config)
+        limiter.init_app(config, redis)
+        lookup_filter.init_app(config, redis)
+        token_reuse.init_app(config, redis)
+        coalescer.init_app(config, redis)
+        metrics.init_app(config)
+        revocations.init_app(config, redis, mongo)
+        signer.init_app(config)
+        Storage.backend = backends.load(config.value('BACKEND'))
+        if signer.enabled:
+            # refresh tokens stay opaque, random strings.
+            app.config.setdefault('OAUTH2_PROVIDER_TOKEN_GENERATOR',
+                                  signer.generate_token)
+            app.config.setdefault('OAUTH2_PROVIDER_REFRESH_TOKEN_GENERATOR',
+                                  random_token_generator)
         self.register_blueprint(app)
 
         if config.value('TOKEN_URL') is not False:
@@ -34,6 +54,35 @@ class ResourceOwnerPasswordCredentials(object):
                 methods=['POST']
             )
 
+        if config.value('REVOKE_URL') is not False:
+            app.add_url_rule(
+                config.url_rule_for('REVOKE_URL'),
+                view_func=views.revoke_token,
+                methods=['POST']
+            )
+
+        if config.value('INTROSPECT_URL') is not False:
+            app.add_url_rule(
+                config.url_rule_for('INTROSPECT_URL'),
+                view_func=views.introspect,
+                methods=['POST']
+            )
+
+        if config.value('INTROSPECT_BATCH_URL') is not False:
+            app.add_url_rule(
+                config.url_rule_for('INTROSPECT_BATCH_URL'),
+                view_func=views.introspect_batch,
+                methods=['POST']
+            )
+
+        if config.value('METRICS') and \
+                config.value('METRICS_URL') is not False:
+            app.add_url_rule(
+                config.url_rule_for('METRICS_URL'),
+                view_func=views.metrics_endpoint,
+                methods=['GET']
+            )
+
         if config.value('MANAGEMENT_URL') is not False:
             app.add_url_rule(
                 config.url_rule_for('MANAGEMENT_URL'),
@@ -42,9 +91,67 @@ class ResourceOwnerPasswordCredentials(object):
             )
 
         mongo.init_app(app, config_prefix='SENTINEL_MONGO')
+        for operation in config.value('MONGO_READ_PREFERENCES') or {}:
+            # fail early on unknown read preferences.
+            _read_options(app.config, operation)
         self.mongo = mongo
+        if isinstance(Storage.backend, MongoBackend):
+            with app.app_context():
+                self._load(app, config)
         oauth.init_app(app)
         oauth._validator = MyRequestValidator()
+        # the oauthlib server is cached by the provider, make sure it is
+        # built with this app settings.
+        oauth.__dict__.pop('server', None)
+
+    def _load(self, app, config):
+        """ Creates the indexes, if asked to, builds the lookup filter and
+            caches the clients. Each waits for MongoDB up to its server
+            selection timeout, so the others are skipped once it is found
+            unreachable.
+        """
+        steps = []
+        if config.value('ENSURE_INDEXES'):
+            steps.append(('create MongoDB indexes', self.ensure_indexes))
+        if lookup_filter.mode is not None and not lookup_filter.built:
+            steps.append(('build the lookup filter', self.rebuild_filter))
+        if metadata_cache.enabled:
+            steps.append(('load the clients',
+                          lambda: metadata_cache.warm(Storage.all_clients)))
+        for name, step in steps:
+            try:
+                step()
+            except ConnectionFailure as e:
+                app.logger.warning('Could not %s: %s', name, e)
+                break
+
+    def ensure_indexes(self):
+        """ Creates the MongoDB indexes needed by the storage layer, along
+            with a TTL index reaping expired tokens. Indexes which could not
+            be created are logged and returned, see
+            :func:`indexes.ensure_indexes`.
+        """
+        errors = indexes.ensure_indexes(
+            mongo.db, current_app.config['SENTINEL_EXPIRED_TOKEN_TTL'])
+        for collection, keys, error in errors:
+            current_app.logger.warning('Could not create index %s on %s: %s',
+                                       keys, collection, error)
+        return errors
+
+    def index_report(self):
+        """ Lists missing or conflicting MongoDB indexes, see
+            :func:`indexes.index_report`.
+        """
+        return indexes.index_report(
+            mongo.db, current_app.config['SENTINEL_EXPIRED_TOKEN_TTL'])
+
+    def rebuild_filter(self):
+        """ Rebuilds the filter of existing tokens and clients from
+            MongoDB, dropping the revoked and expired tokens it still holds.
+            Needed after clients are imported in bulk. Returns the number of
+            tokens and clients, see :meth:`LookupFilter.rebuild`.
+        """
+        return lookup_filter.rebuild(filters.items(mongo.db))
 
     def register_blueprint(self, app):
             module = Blueprint('flask-sentinel', __name__,
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.hashing
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+
+import bcrypt
+
+from .metrics import timed
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class Overloaded(Exception):
+    """ Raised when a password cannot be hashed because the hashing pool is
+        saturated.
+    """
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__(
+            'Password hashing pool is saturated, retry in %s seconds.' %
+            retry_after)
+        self.retry_after = retry_after
+
+
+class _Job(object):
+    def __init__(self, password, salt):
+        self.password = password
+        self.salt = salt
+        self.queued = time.time()
+        self.started = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Pool(object):
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.pending = 0
+        self.busy = 0
+
+
+class Hasher(object):
+    """ Runs bcrypt on a dedicated, size-bounded pool of threads.
+
+    bcrypt releases the GIL, so hashing in a few threads keeps it from
+    starving the threads serving other requests. Hashes beyond what the
+    workers and the queue can hold are rejected right away by raising
+    :class:`Overloaded`, and so are the ones waiting in the queue for more
+    than `timeout` seconds. With no workers, passwords are hashed in the
+    calling thread.
+    """
+    def __init__(self):
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout = None
+        self.retry_after = 1
+
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+        self._hashpw = bcrypt.hashpw
+        self._pool = _Pool()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, config):
+        self.workers = config.value('BCRYPT_WORKERS')
+        self.queue_size = config.value('BCRYPT_QUEUE_SIZE')
+        self.timeout = config.value('BCRYPT_TIMEOUT')
+        self.retry_after = config.value('BCRYPT_RETRY_AFTER')
+        # workers are (re)started on next use.
+        self._pid = None
+
+    @timed('bcrypt')
+    def hashpw(self, password, salt):
+        """ Same as `bcrypt.hashpw`, run on the pool.
+        """
+        if not self.workers:
+            return self._hashpw(password, salt)
+
+        pool = self._start()
+        with self._lock:
+            if pool.pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise Overloaded(self.retry_after)
+            pool.pending += 1
+
+        job = _Job(password, salt)
+        pool.jobs.put(job)
+        if not job.done.wait(self.timeout):
+            with self._lock:
+                if not job.started:
+                    job.cancelled = True
+                    self.timeouts += 1
+                    raise Overloaded(self.retry_after)
+            job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    @property
+    def busy(self):
+        """ Number of hashes being computed. """
+        return self._pool.busy
+
+    @property
+    def depth(self):
+        """ Number of hashes waiting for a worker. """
+        return self._pool.pending - self._pool.busy
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'depth': self.depth,
+            'busy': self.busy,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+    def _start(self):
+        """ Returns the pool of the current process, starting it if needed.
+            This is done lazily so that workers survive forking servers like
+            gunicorn.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._pool
+        with self._lock:
+            if self._pid != pid:
+                self._pool = _Pool()
+                for n in range(self.workers):
+                    thread = threading.Thread(target=self._run,
+                                              args=(self._pool,),
+                                              name='sentinel-bcrypt-%d' % n)
+                    thread.daemon = True
+                    thread.start()
+                self._pid = pid
+            return self._pool
+
+    def _run(self, pool):
+        while True:
+            job = pool.jobs.get()
+            with self._lock:
+                if job.cancelled:
+                    pool.pending -= 1
+                    continue
+                wait = time.time() - job.queued
+                self.wait_time += wait
+                self.max_wait_time = max(self.max_wait_time, wait)
+                pool.busy += 1
+                job.started = True
+            try:
+                job.result = self._hashpw(job.password, job.salt)
+            except Exception as e:
+                job.error = e
+            with self._lock:
+                pool.busy -= 1
+                pool.pending -= 1
+                self.completed += 1
+                job.done.set()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.indexes
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import sys
+
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+# tokens are kept around for a while after expiring, so that they can still
+# be refreshed.
+EXPIRED_TOKEN_TTL = 14 * 24 * 3600
+
+# options which make two indexes on the same keys different.
+OPTIONS = ('unique', 'sparse', 'expireAfterSeconds')
+
+
+def indexes(expired_token_ttl=EXPIRED_TOKEN_TTL):
+    """ Returns a list of (collection, keys, options) tuples describing the
+        indexes needed by the storage layer.
+
+    :param expired_token_ttl: number of seconds expired tokens are kept
+                              before being reaped, or None to keep them
+                              forever.
+    """
+    spec = [
+        ('tokens', [('access_token', ASCENDING)], {'unique': True}),
+        ('tokens', [('refresh_token', ASCENDING)],
+         {'unique': True, 'sparse': True}),
+        ('tokens', [('client_id', ASCENDING), ('user_id', ASCENDING)],
+         {'unique': True}),
+        ('tokens', [('user_id', ASCENDING)], {}),
+        ('users', [('username', ASCENDING)], {'unique': True}),
+        ('clients', [('client_id', ASCENDING)], {'unique': True}),
+    ]
+    if expired_token_ttl is not None and expired_token_ttl is not False:
+        spec.append(('tokens', [('expires', ASCENDING)],
+                     {'expireAfterSeconds': expired_token_ttl}))
+    return spec
+
+
+def ensure_indexes(db, expired_token_ttl=EXPIRED_TOKEN_TTL):
+    """ Creates the indexes needed by the storage layer. Returns a list of
+        (collection, keys, error) tuples for the indexes which could not be
+        created, usually because a conflicting index already exists.
+
+    :param db: pymongo database.
+    :param expired_token_ttl: see :func:`indexes`.
+    """
+    errors = []
+    for collection, keys, options in indexes(expired_token_ttl):
+        try:
+            db[collection].create_index(keys, **options)
+        except ConnectionFailure:
+            raise
+        except PyMongoError as e:
+            errors.append((collection, keys, e))
+    return errors
+
+
+def index_report(db, expired_token_ttl=EXPIRED_TOKEN_TTL):
+    """ Compares the indexes needed by the storage layer with the existing
+        ones. Returns a list of dictionaries with `collection`, `keys`,
+        `status` and, if the index exists, `name` keys. Status is one of
+        ``ok``, ``missing`` or ``conflicting``.
+
+    :param db: pymongo database.
+    :param expired_token_ttl: see :func:`indexes`.
+    """
+    existing = {}
+    report = []
+    for collection, keys, options in indexes(expired_token_ttl):
+        if collection not in existing:
+            existing[collection] = db[collection].index_information()
+
+        entry = {'collection': collection, 'keys': keys, 'status': 'missing'}
+        for name, info in existing[collection].items():
+            if [tuple(key) for key in info['key']] != keys:
+                continue
+            entry['name'] = name
+            actual = dict((o, info[o]) for o in OPTIONS if o in info)
+            entry['status'] = 'ok' if actual == options else 'conflicting'
+            break
+        report.append(entry)
+    return report
+
+
+def main(argv=None):
+    """ Console entry point listing missing or conflicting indexes, and
+        optionally creating them.
+    """
+    parser = argparse.ArgumentParser(
+        description='Check the MongoDB indexes used by Flask-Sentinel.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/oauth',
+                        help='MongoDB connection string, including the '
+                        'database name.')
+    parser.add_argument('--expired-token-ttl', type=int,
+                        default=EXPIRED_TOKEN_TTL,
+                        help='seconds expired tokens are kept around.')
+    parser.add_argument('--create', action='store_true',
+                        help='create missing indexes.')
+    args = parser.parse_args(argv)
+
+    db = MongoClient(args.uri).get_default_database()
+    if args.create:
+        ensure_indexes(db, args.expired_token_ttl)
+
+    report = index_report(db, args.expired_token_ttl)
+    for entry in report:
+        keys = ', '.join('%s:%s' % key for key in entry['keys'])
+        print('%-12s %-8s (%s)' % (entry['status'], entry['collection'],
+                                   keys))
+    return 0 if all(e['status'] == 'ok' for e in report) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from flask.signals import Namespace, signals_available
+
+_signals = Namespace()
+
+#: Sent after every timed stage, with the stage name as sender, along with
+#: its `duration` in seconds and whether it raised an `error`. Only sent
+#: when ``SENTINEL_METRICS`` is enabled and blinker is installed.
+stage_timed = _signals.signal('stage-timed')
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.errors = 0
+
+
+class Metrics(object):
+    """ Latency histograms of the timed stages, see :func:`timed`.
+
+    Figures are kept by each process, and are rendered in the Prometheus
+    text format by the metrics endpoint.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.buckets = BUCKETS
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, config):
+        self.enabled = bool(config.value('METRICS'))
+        self.buckets = tuple(sorted(config.value('METRICS_BUCKETS')))
+        self.clear()
+
+    def observe(self, stage, duration, error=False):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = _Histogram(self.buckets)
+            histogram.counts[bisect_left(self.buckets, duration)] += 1
+            histogram.sum += duration
+            if error:
+                histogram.errors += 1
+        if signals_available and stage_timed.receivers:
+            stage_timed.send(stage, duration=duration, error=error)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def stats(self):
+        """ Returns a dict of (count, sum, errors) tuples, by stage. """
+        with self._lock:
+            return dict((stage, (sum(h.counts), h.sum, h.errors))
+                        for stage, h in self._histograms.items())
+
+    def render(self, counters=(), gauges=()):
+        """ Returns the histograms, along with extra `counters` and `gauges`
+            given as (name, help, value) tuples, in the Prometheus text
+            format.
+        """
+        name = 'sentinel_stage_duration_seconds'
+        lines = [
+            '# HELP %s Time spent in each stage.' % name,
+            '# TYPE %s histogram' % name,
+        ]
+        errors = []
+        with self._lock:
+            for stage in sorted(self._histograms):
+                histogram = self._histograms[stage]
+                count = 0
+                for le, n in zip(self.buckets + ('+Inf',), histogram.counts):
+                    count += n
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (
+                        name, stage, le, count))
+                lines.append('%s_sum{stage="%s"} %r' % (
+                    name, stage, histogram.sum))
+                lines.append('%s_count{stage="%s"} %d' % (
+                    name, stage, count))
+                errors.append('sentinel_stage_errors_total{stage="%s"} %d' % (
+                    stage, histogram.errors))
+
+        lines.append('# HELP sentinel_stage_errors_total Stages which raised '
+                     'an exception.')
+        lines.append('# TYPE sentinel_stage_errors_total counter')
+        lines.extend(errors)
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for metric, help, value in metrics:
+                lines.append('# HELP %s %s' % (metric, help))
+                lines.append('# TYPE %s %s' % (metric, kind))
+                lines.append('%s %r' % (metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def timed(stage):
+    """ Decorator timing every call of a function as `stage`, when metrics
+        are enabled. Otherwise, it only costs a flag check.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not metrics.enabled:
+                return f(*args, **kwargs)
+            start = _clock()
+            try:
+                result = f(*args, **kwargs)
+            except Exception:
+                metrics.observe(stage, _clock() - start, True)
+                raise
+            metrics.observe(stage, _clock() - start)
+            return result
+        return decorated
+    return decorator
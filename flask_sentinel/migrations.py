@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.migrations
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import sys
+
+from pymongo import MongoClient, UpdateMany
+
+from .data import _snapshot, _stale_snapshots
+from .models import User
+
+
+def embed_users(db, batch_size=1000):
+    """ Embeds a copy of their user in the token documents written before
+        users were embedded, and refreshes the stale copies, like the ones
+        written by a grant racing with a user update. Returns the number of
+        updated token documents.
+
+    :param db: pymongo database.
+    :param batch_size: number of users whose tokens are updated with a
+                       single bulk write.
+    """
+    updated = 0
+    batch = []
+    users = db.users.find({}, {'username': True, 'version': True})
+    for json in users:
+        user = User(id=json['_id'], username=json['username'],
+                    version=json.get('version') or 0)
+        batch.append(UpdateMany(_stale_snapshots(user),
+                                {'$set': {'user': _snapshot(user)}}))
+        if len(batch) == batch_size:
+            updated += db.tokens.bulk_write(batch,
+                                            ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += db.tokens.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+def main(argv=None):
+    """ Console entry point bringing the token documents up to date. """
+    parser = argparse.ArgumentParser(
+        description='Migrate the Flask-Sentinel token documents.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/oauth',
+                        help='MongoDB connection string, including the '
+                        'database name.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    db = MongoClient(args.uri).get_default_database()
+    print('%d tokens updated' % embed_users(db, args.batch_size))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,41 +9,28 @@
 
 
 class BaseModel(object):
-    def __init__(self, id=None):
-        self._id = id
-
-    @property
-    def id(self):
-        return self._id
+    """ Models are slotted: fields are plain attributes, and instances carry
+        no per-instance dictionary.
+    """
+    __slots__ = ('id',)
 
-    @id.setter
-    def id(self, value):
-        self._id = value
+    def __init__(self, id=None):
+        self.id = id
 
 
 class User(BaseModel):
     """ User which will be querying resources from the API.
-    """
-    def __init__(self, id=None, username=None, hashpw=None):
-        super(User, self).__init__(id)
-        self._username = username
-        self._hashpw = hashpw
-
-    @property
-    def username(self):
-        return self._username
 
-    @username.setter
-    def username(self, value):
-        self._username = value
-
-    @property
-    def hashpw(self):
-        return self._hashpw
+        `version` is bumped on every update of the user, so that the copies
+        of the user kept along with its tokens can be told apart when stale.
+    """
+    __slots__ = ('username', 'hashpw', 'version')
 
-    @hashpw.setter
-    def hashpw(self, value):
-        self._hashpw = value
+    def __init__(self, id=None, username=None, hashpw=None, version=None):
+        super(User, self).__init__(id)
+        self.username = username
+        self.hashpw = hashpw
+        self.version = version
 
 
 class Client(BaseModel):
@@ -76,26 +63,12 @@ class Client(BaseModel):
     Server will not redirect the user as described in subsection 3.1.2
     (Redirection Endpoint).
     """
+    __slots__ = ('client_id', 'client_type')
+
     def __init__(self, id=None, client_id=None, client_type=None):
         super(Client, self).__init__(id)
-        self._client_id = client_id
-        self._client_type = client_type
-
-    @property
-    def client_id(self):
-        return self._client_id
-
-    @client_id.setter
-    def client_id(self, value):
-        self._client_id = value
-
-    @property
-    def client_type(self):
-        return self._client_type
-
-    @client_type.setter
-    def client_type(self, value):
-        self._client_type = value
+        self.client_id = client_id
+        self.client_type = client_type
 
     @property
     def allowed_grant_types(self):
@@ -125,80 +98,30 @@ class Token(BaseModel):
         with the users who are requesting them. This can be used to track usage
         and potential abuse. Only bearer tokens currently supported.
     """
+    __slots__ = ('client_id', 'user_id', 'user', 'token_type', 'access_token',
+                 'refresh_token', '_expires', 'scopes')
 
     def __init__(self, id=None, client_id=None, user_id=None, user=None,
                  token_type=None, access_token=None, refresh_token=None,
                  expires=None, scopes=['']):
         super(Token, self).__init__(id)
-        self._client_id = client_id
-        self._user_id = user_id
-        self._user = None
-        self._token_type = token_type
-        self._access_token = access_token
-        self._refresh_token = refresh_token
-        self._expires = expires
-        self._scopes = scopes
-
-    @property
-    def client_id(self):
-        return self._client_id
-
-    @client_id.setter
-    def client_id(self, value):
-        self._client_id = value
-
-    @property
-    def user_id(self):
-        return self._user_id
-
-    @user_id.setter
-    def user_id(self, value):
-        self._user_id = value
-
-    @property
-    def user(self):
-        return self._user
-
-    @user.setter
-    def user(self, value):
-        self._user = value
-
-    @property
-    def token_type(self):
-        return self._token_type
-
-    @token_type.setter
-    def token_type(self, value):
-        self._token_type = value
-
-    @property
-    def access_token(self):
-        return self._access_token
-
-    @access_token.setter
-    def access_token(self, value):
-        self._access_token = value
-
-    @property
-    def refresh_token(self):
-        return self._refresh_token
-
-    @refresh_token.setter
-    def refresh_token(self, value):
-        self._refresh_token = value
+        self.client_id = client_id
+        self.user_id = user_id
+        self.user = None
+        self.token_type = token_type
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires = expires
+        self.scopes = scopes
 
     @property
     def expires(self):
-        return self._expires.replace(tzinfo=None)
+        return self._expires
 
     @expires.setter
     def expires(self, value):
+        # naive UTC datetimes are compared with utcnow() on validation, so
+        # timezone info is dropped once here rather than on every read.
+        if value is not None:
+            value = value.replace(tzinfo=None)
         self._expires = value
-
-    @property
-    def scopes(self):
-        return self._scopes
-
-    @scopes.setter
-    def scopes(self, value):
-        self._scopes = value
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+import time
+from collections import namedtuple
+
+from werkzeug.security import gen_salt
+
+# redis sorted set of the requests made within the window, by limit and
+# value. The braces keep all the limits of a request on one cluster slot.
+RATE_KEY = '{sentinel:ratelimit}:%s:%s'
+
+# request attributes requests can be limited by.
+LIMITED_BY = ('client_id', 'username', 'remote_addr')
+
+#: Outcome of a check: whether the request is allowed, the tightest limit,
+#: requests left within it and, for rejected requests, seconds to wait.
+RateLimit = namedtuple('RateLimit', 'allowed limit remaining retry_after')
+
+# KEYS: a sorted set per limit. ARGV: the time in milliseconds, a unique
+# member, then the limit and window in milliseconds of every key. Returns
+# whether the request is allowed, the index of the tightest key, requests
+# left within it and milliseconds to wait before retrying.
+_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tightest, remaining, wait = 1, -1, 0
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[i * 2 + 1])
+    local window = tonumber(ARGV[i * 2 + 2])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    local count = redis.call('ZCARD', key)
+    if count >= limit then
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        local retry = window
+        if oldest[2] then
+            retry = tonumber(oldest[2]) + window - now
+        end
+        if retry > wait then
+            tightest, wait = i, retry
+        end
+    elseif wait == 0 and (remaining < 0 or limit - count - 1 < remaining) then
+        tightest, remaining = i, limit - count - 1
+    end
+end
+if wait > 0 then
+    return {0, tightest, 0, wait}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('PEXPIRE', key, ARGV[i * 2 + 2])
+end
+return {1, tightest, remaining, 0}
+"""
+
+
+class RateLimiter(object):
+    """ Sliding window limits of the token endpoint requests, kept in redis.
+
+    Each limit allows `limit` requests per `window` seconds for every value
+    of a request attribute, see :data:`LIMITED_BY`. A request is checked
+    against all of its limits, and only counted by them if none is
+    exceeded, with a single script call.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.limits = []
+        self.rejected = 0
+
+        self._script = None
+
+    def init_app(self, config, redis):
+        limits = config.value('RATE_LIMITS') or {}
+        for name in limits:
+            if name not in LIMITED_BY:
+                raise ValueError('Cannot rate limit by %r.' % name)
+        self.limits = [(name, int(limits[name][0]), float(limits[name][1]))
+                       for name in LIMITED_BY if name in limits]
+        self.enabled = bool(self.limits)
+        self._script = redis.register_script(_SCRIPT)
+
+    def hit(self, values):
+        """ Counts a request and returns its :data:`RateLimit`.
+
+        :param values: dict of the request attribute values. Limits of
+                       missing attributes do not apply.
+        """
+        limits = [(name, limit, window) for name, limit, window in self.limits
+                  if values.get(name)]
+        if not limits:
+            return RateLimit(True, None, None, 0)
+
+        keys = [RATE_KEY % (name, values[name]) for name, _, _ in limits]
+        args = [int(time.time() * 1000), gen_salt(16)]
+        for _, limit, window in limits:
+            args.extend([limit, int(window * 1000)])
+        allowed, tightest, remaining, wait = self._script(keys=keys,
+                                                          args=args)
+        limit = limits[tightest - 1][1]
+        if not allowed:
+            self.rejected += 1
+            return RateLimit(False, limit, 0, int(math.ceil(wait / 1000.0)))
+        return RateLimit(True, limit, remaining, 0)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.reuse
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import time
+
+# redis key holding the current token of a (client, user) pair, as issued.
+PAIR_KEY = 'sentinel:pair:%s:%s'
+
+
+class TokenReuse(object):
+    """ Answers password grants with the current token of the client and
+        user, as long as it has more than `min_ttl` seconds left, instead of
+        issuing a new one.
+
+    The current token of every pair is kept in redis until it expires, so
+    that reused tokens are served with two reads and no write at all.
+    Replaced tokens are overwritten, and revoked ones dropped. Refresh
+    grants always issue a new token.
+
+    Of two racing grants, the one remembered last may lose the database
+    write and be deleted. Tokens are thus only reused while their access
+    token key, which replaced and revoked tokens lose, still exists.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.min_ttl = None
+        self.reused = 0
+        self.issued = 0
+
+        self._redis = None
+
+    def init_app(self, config, redis):
+        self.min_ttl = config.value('TOKEN_REUSE_MIN_TTL')
+        self.enabled = self.min_ttl is not None and self.min_ttl is not False
+        self.reused = self.issued = 0
+        self._redis = redis
+
+    def reuse(self, token, request):
+        """ Replaces the contents of `token`, as issued by oauthlib, with
+            the current token of the client and user if it can be reused,
+            and returns True. Returns False otherwise.
+        """
+        if request.grant_type != 'password':
+            return False
+        value = self._redis.get(PAIR_KEY % (request.client.client_id,
+                                            request.user.id))
+        if value is None:
+            return False
+        if not isinstance(value, str):
+            value = value.decode('utf-8')
+        current = json.loads(value)
+        expires_in = int(current.pop('expires') - time.time())
+        if expires_in <= self.min_ttl or \
+                current.get('scope') != token.get('scope'):
+            return False
+        if not self._redis.exists(current['access_token']):
+            return False
+        token.update(current)
+        token['expires_in'] = expires_in
+        self.reused += 1
+        return True
+
+    def remember(self, token, request, pipe):
+        """ Makes `token`, as issued by oauthlib, the current token of the
+            client and user.
+
+        :param pipe: redis pipeline the token is stored on.
+        """
+        expires_in = token.get('expires_in')
+        current = dict((key, token[key]) for key in (
+            'access_token', 'refresh_token', 'token_type', 'scope')
+            if key in token)
+        current['expires'] = int(time.time()) + expires_in
+        pipe.setex(PAIR_KEY % (request.client.client_id, request.user.id),
+                   expires_in, json.dumps(current))
+        self.issued += 1
+
+    def forget(self, client_id, user_id, pipe):
+        """ Stops reusing the token of a client and user, like a revoked
+            one.
+        """
+        pipe.delete(PAIR_KEY % (client_id, user_id))
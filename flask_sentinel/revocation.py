@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.revocation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+
+# redis key marking a token as revoked until it is gone from the database.
+REVOKED_KEY = 'sentinel:revoked:%s'
+
+# redis list of the access tokens waiting to be deleted from the database.
+REVOKE_QUEUE = 'sentinel:revoke:queue'
+
+
+class RevocationQueue(object):
+    """ Deletes revoked tokens from the database in batches, off the request
+        path.
+
+    Revoked tokens are rejected as soon as they are marked in redis, see
+    :meth:`Storage.revoke_token`, so their documents can be deleted later
+    on. Their access tokens are queued in a redis list, which a thread of
+    every process empties every `interval` seconds. With no interval, the
+    queue is flushed right away instead.
+    """
+    def __init__(self):
+        self.interval = 1
+        self.batch_size = 500
+        self.flushed = 0
+
+        self._app = None
+        self._redis = None
+        self._mongo = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, config, redis, mongo):
+        self.interval = config.value('REVOKE_FLUSH_INTERVAL')
+        self.batch_size = config.value('REVOKE_BATCH_SIZE')
+        self._app = config.app
+        self._redis = redis
+        self._mongo = mongo
+
+    def push(self, access_token, pipe=None):
+        """ Queues `access_token` for deletion.
+
+        :param access_token: the token to delete.
+        :param pipe: optional redis pipeline the token is queued on. The
+                     queue is only flushed after the pipeline has been
+                     executed.
+        """
+        (pipe or self._redis).rpush(REVOKE_QUEUE, access_token)
+
+    def notify(self):
+        """ Lets the queue know that tokens have been pushed. """
+        if self.interval:
+            self._start()
+        else:
+            self.flush()
+
+    def flush(self):
+        """ Deletes a batch of queued tokens and returns their number. Needs
+            an application context.
+        """
+        pipe = self._redis.pipeline()
+        pipe.lrange(REVOKE_QUEUE, 0, self.batch_size - 1)
+        pipe.ltrim(REVOKE_QUEUE, self.batch_size, -1)
+        tokens = pipe.execute()[0]
+        if not tokens:
+            return 0
+
+        access_tokens = [t if isinstance(t, str) else t.decode('utf-8')
+                         for t in tokens]
+        try:
+            self._mongo.db.tokens.remove(
+                {'access_token': {'$in': access_tokens}})
+        except Exception:
+            # tokens stay rejected meanwhile, see REVOKED_KEY.
+            self._redis.rpush(REVOKE_QUEUE, *tokens)
+            raise
+        self.flushed += len(tokens)
+        return len(tokens)
+
+    def depth(self):
+        """ Number of tokens waiting to be deleted. """
+        return self._redis.llen(REVOKE_QUEUE)
+
+    def _start(self):
+        """ Makes sure the flushing thread is running in the current process.
+            This is done lazily so that it survives forking servers like
+            gunicorn.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+        thread = threading.Thread(target=self._run,
+                                  name='sentinel-revocation')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            app = self._app
+            with app.app_context():
+                try:
+                    while self.flush() == self.batch_size:
+                        pass
+                except Exception as e:
+                    app.logger.warning('Could not delete revoked tokens: %s',
+                                       e)
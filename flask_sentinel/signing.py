@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.signing
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from werkzeug.security import gen_salt
+
+from .models import Token, User
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _header(kid):
+    return _b64encode(_bytes(json.dumps(
+        {'alg': 'HS256', 'typ': 'JWT', 'kid': kid},
+        separators=(',', ':'), sort_keys=True)))
+
+
+class Signer(object):
+    """ Issues and verifies self-contained access tokens, as HS256 signed
+        JSON Web Tokens carrying the user, client, scopes and expiration.
+
+    Tokens are signed with the `key_id` key and verified with any of the
+    configured keys, so keys can be rotated by adding a new key, signing
+    with it, and dropping the old one once its tokens have expired. Keys
+    are prepared once, when loaded, along with the token header they sign.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.key_id = None
+
+        # header of the tokens signed with the current key.
+        self._header = None
+        # kid: HMAC prepared with the key, copied for every token.
+        self._keys = {}
+        # encoded header: kid, so that headers are never parsed.
+        self._headers = {}
+
+    def init_app(self, config):
+        self.enabled = bool(config.value('TOKEN_SIGNING'))
+        self.load(config.value('SIGNING_KEYS') or {},
+                  config.value('SIGNING_KEY_ID'))
+
+    def load(self, keys, key_id=None):
+        """ Replaces the keys.
+
+        :param keys: dict of secrets by key id.
+        :param key_id: id of the key new tokens are signed with. Defaults to
+                       the only key, if there is just one.
+        """
+        if key_id is None and len(keys) == 1:
+            key_id = list(keys)[0]
+        if self.enabled and key_id not in keys:
+            raise ValueError('Signing key %r is not configured.' % key_id)
+
+        self._keys = dict(
+            (kid, hmac.new(_bytes(secret), digestmod=hashlib.sha256))
+            for kid, secret in keys.items())
+        self._headers = dict((_header(kid), kid) for kid in keys)
+        self._header = _header(key_id)
+        self.key_id = key_id
+
+    def sign(self, claims):
+        """ Returns a token carrying `claims`, signed with the current key.
+        """
+        signing_input = b'.'.join([
+            self._header,
+            _b64encode(_bytes(json.dumps(claims, separators=(',', ':')))),
+        ])
+        return b'.'.join([
+            signing_input, _b64encode(self._digest(self.key_id,
+                                                   signing_input))
+        ]).decode('ascii')
+
+    def verify(self, token):
+        """ Returns the claims of `token`, or None if it is malformed, signed
+            with an unknown key, tampered with or expired.
+        """
+        try:
+            token = _bytes(token)
+            header, payload, signature = token.split(b'.')
+            kid = self._headers.get(header)
+            if kid is None:
+                return None
+            digest = self._digest(kid, header + b'.' + payload)
+            if not hmac.compare_digest(digest, _b64decode(signature)):
+                return None
+            claims = json.loads(_b64decode(payload).decode('utf-8'))
+        except (ValueError, TypeError):
+            return None
+        if not isinstance(claims, dict) or \
+                not claims.get('exp', 0) > time.time():
+            return None
+        return claims
+
+    def generate_token(self, request):
+        """ Token generator for oauthlib, see
+            ``OAUTH2_PROVIDER_TOKEN_GENERATOR``.
+        """
+        now = int(time.time())
+        return self.sign({
+            'sub': str(request.user.id),
+            'username': request.user.username,
+            'client_id': request.client.client_id,
+            'scope': ' '.join(request.scopes or ()),
+            'iat': now,
+            'exp': now + request.expires_in,
+            'jti': gen_salt(16),
+        })
+
+    def load_token(self, access_token):
+        """ Returns a Token, along with its User, rebuilt from a signed
+            access token, or None if it is not valid.
+        """
+        claims = self.verify(access_token)
+        if claims is None:
+            return None
+        user_id = claims['sub']
+        if ObjectId.is_valid(user_id):
+            user_id = ObjectId(user_id)
+        token = Token(
+            client_id=claims['client_id'],
+            user_id=user_id,
+            token_type='Bearer',
+            access_token=access_token,
+            expires=datetime.utcfromtimestamp(claims['exp']),
+            scopes=claims['scope'].split(),
+        )
+        token.user = User(id=user_id, username=claims['username'])
+        return token
+
+    def _digest(self, kid, signing_input):
+        mac = self._keys[kid].copy()
+        mac.update(signing_input)
+        return mac.digest()
@@ -7,12 +7,20 @@
     :license: BSD, see LICENSE for more details.
 """
 import json
+import os
+import subprocess
+import time
 import unittest
 from flask import Flask
 from flask.ext.sentinel import ResourceOwnerPasswordCredentials, oauth
 from flask.ext.sentinel.core import mongo
 from flask.ext.sentinel.data import Storage
 
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
+
 
 def is_redis_available():
     try:
@@ -26,6 +34,34 @@ def is_redis_available():
     return True
 
 
+REDIS_SERVER = which('redis-server')
+
+
+def redis_server(port, *args, **kwargs):
+    """ Starts a throwaway redis-server process listening on `port`, with
+        extra command line `args`, and waits until it answers.
+
+    :param config: optional configuration file, which sentinels need.
+    """
+    from redis import StrictRedis, ConnectionError
+    argv = [REDIS_SERVER]
+    if kwargs.get('config'):
+        argv.append(kwargs['config'])
+    argv.extend(['--port', str(port), '--save', '', '--appendonly', 'no'])
+    argv.extend(args)
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen(argv, stdout=devnull, stderr=devnull)
+    client = StrictRedis(port=port)
+    for _ in range(50):
+        try:
+            client.ping()
+            return process
+        except ConnectionError:
+            time.sleep(.1)
+    process.kill()
+    raise RuntimeError('redis-server did not start on port %d' % port)
+
+
 class TestBase(unittest.TestCase):
     def setUp(self):
         self.app = Flask(__name__)
@@ -34,7 +70,7 @@ class TestBase(unittest.TestCase):
         self.app.add_url_rule('/endpoint', view_func=restricted_access)
         self.app.config.update(self.settings())
 
-        ResourceOwnerPasswordCredentials(self.app)
+        self.sentinel = ResourceOwnerPasswordCredentials(self.app)
 
         self.context = self.app.test_request_context('/')
         self.context.push()
@@ -6,12 +6,60 @@
     :copyright: (c) 2015 by Nicola Iarocci.
     :license: BSD, see LICENSE for more details.
 """
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import warnings
+from datetime import datetime, timedelta, tzinfo
 
-from .base import TestBase, is_redis_available
-from ..core import mongo, redis
-from ..data import Storage
-from ..models import Client, User
+import bcrypt
+from flask import Flask
+from pymongo.errors import ConnectionFailure
+from pymongo.read_preferences import Nearest
+from redis import StrictRedis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+from .. import ResourceOwnerPasswordCredentials
+from .base import REDIS_SERVER, TestBase, is_redis_available, redis_server
+from ..backends import MemoryBackend, load
+from ..bulk import import_clients, import_users, read_records
+from ..cache import CLIENTS_VERSION_KEY, TokenCache
+from ..coalesce import FLIGHT_KEY, Coalescer
+from ..filters import FILTER_KEY, MISS_KEY, NEXT_FILTER_KEY, BloomFilter
+from ..core import mongo, redis, coalescer, hasher, limiter, \
+    lookup_filter, metadata_cache, revocations, signer, token_cache, \
+    token_reuse
+from .. import data
+from ..data import Storage, TOKEN_KEY, _from_json, _properties, \
+    _read_options, _reads, _to_json
+from ..hashing import Overloaded
+from ..indexes import EXPIRED_TOKEN_TTL
+from ..metrics import metrics, signals_available, stage_timed
+from ..migrations import embed_users
+from ..models import Client, User, Token
+from ..ratelimit import RATE_KEY, RateLimiter
+from ..reuse import PAIR_KEY
+from ..utils import Config
+
+aio = None
+if sys.version_info >= (3, 5):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        from .. import aio
+    except ImportError:  # Motor or redis-py 4.2+ missing
+        pass
 
 
 class TestTokenEndpoint(TestBase):
@@ -70,6 +118,7 @@ class TestAuthEndpoint(TestBase):
         r = self.test_client.get(self.auth_endpoint)
         self.assert401(r.status_code)
 
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
     def test_invalid_auth(self):
         headers = [('Authorization', 'Bearer DontThinkSo')]
         r = self.test_client.get(self.auth_endpoint, headers=headers)
@@ -87,6 +136,341 @@ class TestAuthEndpoint(TestBase):
         r = self.test_client.get(self.auth_endpoint, headers=headers)
         self.assert200(r.status_code)
 
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_replaced_token(self):
+        token = self.get_token()['access_token']
+        self.get_token()
+        headers = [('Authorization', 'Bearer %s' % token)]
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assert401(r.status_code)
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_concurrent_grants(self):
+        self.sentinel.ensure_indexes()
+        query = self.url % (self.clientid, self.username, self.pw)
+        responses = []
+
+        def grant():
+            responses.append(self.app.test_client().post(query))
+
+        threads = [threading.Thread(target=grant) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([r.status_code for r in responses], [200] * 8)
+        tokens = list(mongo.db.tokens.find({'client_id': self.clientid,
+                                            'user_id': self.user.id}))
+        self.assertEqual(len(tokens), 1)
+
+        # only the stored token is still valid.
+        valid = []
+        for r in responses:
+            token = json.loads(r.get_data())['access_token']
+            headers = [('Authorization', 'Bearer %s' % token)]
+            r = self.test_client.get(self.auth_endpoint, headers=headers)
+            if r.status_code == 200:
+                valid.append(token)
+        self.assertEqual(valid, [tokens[0]['access_token']])
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_write_concern(self):
+        self.app.config['SENTINEL_WRITE_CONCERN'] = 1
+        self.app.config['SENTINEL_WRITE_JOURNAL'] = False
+        self.get_token()
+        son = self.get_token()
+        self.assertEqual(mongo.db.tokens.count(), 1)
+        self.assertEqual(mongo.db.tokens.find_one()['access_token'],
+                         son['access_token'])
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestRevokeEndpoint(TestBase):
+    def settings(self):
+        settings = super(TestRevokeEndpoint, self).settings()
+        settings['SENTINEL_REVOKE_URL'] = '/testrevoke'
+        settings['SENTINEL_REVOKE_FLUSH_INTERVAL'] = 0
+        return settings
+
+    def revoke(self, token, headers=None, **params):
+        if headers is None:
+            params.setdefault('client_id', self.clientid)
+        params['token'] = token
+        return self.test_client.post('/testauth/testrevoke', data=params,
+                                     headers=headers)
+
+    def basic_auth(self, client_id):
+        credentials = base64.b64encode(('%s:' % client_id).encode('utf-8'))
+        return [('Authorization', 'Basic %s' % credentials.decode('utf-8'))]
+
+    def assertValid(self, token, valid=True):
+        headers = [('Authorization', 'Bearer %s' % token)]
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assertEqual(r.status_code, 200 if valid else 401)
+
+    def test_revoke_access_token(self):
+        son = self.get_token()
+        self.assertValid(son['access_token'])
+
+        r = self.revoke(son['access_token'])
+        self.assert200(r.status_code)
+        self.assertValid(son['access_token'], False)
+        self.assertIsNone(
+            Storage.get_token(refresh_token=son['refresh_token']))
+        self.assertEqual(mongo.db.tokens.count(), 0)
+
+    def test_revoke_refresh_token(self):
+        son = self.get_token()
+        r = self.revoke(son['refresh_token'], token_type_hint='refresh_token')
+        self.assert200(r.status_code)
+        self.assertValid(son['access_token'], False)
+
+    def test_revoke_unknown_token(self):
+        # as per RFC 7009, invalid tokens are not reported to the client.
+        r = self.revoke('notreally')
+        self.assert200(r.status_code)
+
+    def test_revoke_other_client_token(self):
+        son = self.get_token()
+        client = Storage.generate_client()
+        r = self.revoke(son['access_token'], client_id=client.client_id)
+        self.assert200(r.status_code)
+        self.assertValid(son['access_token'])
+
+    def test_revoke_basic_auth(self):
+        son = self.get_token()
+        other = Storage.generate_client()
+        r = self.revoke(son['access_token'],
+                        headers=self.basic_auth(other.client_id))
+        self.assert200(r.status_code)
+        self.assertValid(son['access_token'])
+
+        r = self.revoke(son['access_token'],
+                        headers=self.basic_auth(self.clientid))
+        self.assert200(r.status_code)
+        self.assertValid(son['access_token'], False)
+
+    def test_deferred_deletion(self):
+        revocations.interval = 3600
+        son = self.get_token()
+        self.revoke(son['access_token'])
+
+        # the document is still there, but the token is rejected anyway.
+        self.assertEqual(revocations.depth(), 1)
+        self.assertEqual(mongo.db.tokens.count(), 1)
+        self.assertIsNone(Storage.get_token(son['access_token']))
+        self.assertValid(son['access_token'], False)
+
+        self.assertEqual(revocations.flush(), 1)
+        self.assertEqual(revocations.depth(), 0)
+        self.assertEqual(mongo.db.tokens.count(), 0)
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestIntrospectEndpoint(TestBase):
+    def settings(self):
+        settings = super(TestIntrospectEndpoint, self).settings()
+        settings['SENTINEL_INTROSPECT_USERNAME'] = 'rs'
+        settings['SENTINEL_INTROSPECT_PASSWORD'] = 'pw'
+        settings['SENTINEL_INTROSPECT_MAX_AGE'] = 600
+        return settings
+
+    def introspect(self, url='/testauth/introspect', **kwargs):
+        headers = [('Authorization', 'Basic %s' % 'cnM6cHc=')]
+        return self.test_client.post(url, headers=headers, **kwargs)
+
+    def test_auth_required(self):
+        r = self.test_client.post('/testauth/introspect',
+                                  data={'token': 'notreally'})
+        self.assert401(r.status_code)
+
+        # the endpoint is closed unless credentials are set.
+        del self.app.config['SENTINEL_INTROSPECT_PASSWORD']
+        r = self.introspect(data={'token': 'notreally'})
+        self.assert401(r.status_code)
+
+    def test_introspect(self):
+        son = self.get_token()
+        r = self.introspect(data={'token': son['access_token']})
+        self.assert200(r.status_code)
+        body = json.loads(r.get_data(as_text=True))
+        self.assertTrue(body['active'])
+        self.assertEqual(body['client_id'], self.clientid)
+        self.assertEqual(body['username'], self.username)
+        self.assertEqual(body['sub'], str(self.user.id))
+        self.assertTrue(0 < body['exp'] - time.time() <= 999)
+
+        # cacheable until the token expires, up to the configured maximum.
+        max_age = int(r.headers['Cache-Control'].split('max-age=')[1])
+        self.assertTrue(0 < max_age <= 600)
+
+        r = self.introspect(data={'token': son['refresh_token']})
+        body = json.loads(r.get_data(as_text=True))
+        self.assertTrue(body['active'])
+        self.assertEqual(body['token_type'], 'refresh_token')
+
+    def test_introspect_inactive(self):
+        r = self.introspect(data={'token': 'notreally'})
+        self.assert200(r.status_code)
+        self.assertEqual(json.loads(r.get_data(as_text=True)),
+                         {'active': False})
+        self.assertEqual(r.headers['Cache-Control'], 'no-store')
+
+        r = self.introspect(data={})
+        self.assert400(r.status_code)
+
+    def test_introspect_batch(self):
+        son = self.get_token()
+        tokens = [son['access_token'], 'notreally']
+
+        # json and form bodies.
+        for kwargs in ({'data': json.dumps({'tokens': tokens}),
+                        'content_type': 'application/json'},
+                       {'data': {'token': tokens}}):
+            r = self.introspect('/testauth/introspect/batch', **kwargs)
+            self.assert200(r.status_code)
+            body = json.loads(r.get_data(as_text=True))['tokens']
+            self.assertEqual([b['active'] for b in body], [True, False])
+            self.assertEqual(body[0]['username'], self.username)
+            self.assertIn('max-age', r.headers['Cache-Control'])
+
+        self.app.config['SENTINEL_INTROSPECT_BATCH_SIZE'] = 1
+        r = self.introspect('/testauth/introspect/batch',
+                            data={'token': tokens})
+        self.assert400(r.status_code)
+
+    def test_get_tokens(self):
+        son = self.get_token()
+        redis.delete(TOKEN_KEY % son['access_token'])
+        other = Storage.save_user('other', 'pw')
+        query = self.url % (self.clientid, 'other', 'pw')
+        other_token = json.loads(
+            self.test_client.post(query).get_data(as_text=True))
+
+        tokens = Storage.get_tokens([other_token['access_token'],
+                                     'notreally', son['access_token']])
+        self.assertEqual(tokens[0].user.username, other.username)
+        self.assertIsNone(tokens[1])
+        self.assertEqual(tokens[2].user.username, self.username)
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestSignedTokens(TestBase):
+    def settings(self):
+        settings = super(TestSignedTokens, self).settings()
+        settings['SENTINEL_TOKEN_SIGNING'] = True
+        settings['SENTINEL_SIGNING_KEYS'] = {'k1': 'secret1'}
+        return settings
+
+    def access(self, token):
+        headers = [('Authorization', 'Bearer %s' % token)]
+        return self.test_client.get(self.auth_endpoint, headers=headers)
+
+    def test_signed_token(self):
+        son = self.get_token()
+        self.assertEqual(son['access_token'].count('.'), 2)
+        self.assertEqual(son['refresh_token'].count('.'), 0)
+
+        claims = signer.verify(son['access_token'])
+        self.assertEqual(claims['sub'], str(self.user.id))
+        self.assertEqual(claims['client_id'], self.clientid)
+        self.assertEqual(claims['username'], self.username)
+
+        # refresh tokens are still stored.
+        token = Storage.get_token(refresh_token=son['refresh_token'])
+        self.assertEqual(token.access_token, son['access_token'])
+
+    def test_no_datastore_lookup(self):
+        son = self.get_token()
+        redis.delete(son['access_token'], TOKEN_KEY % son['access_token'])
+        for collection in (mongo.db.tokens, mongo.db.users,
+                           mongo.db.clients):
+            collection.remove({})
+        self.assert200(self.access(son['access_token']).status_code)
+
+    def test_invalid_signature(self):
+        son = self.get_token()
+        header, payload, signature = son['access_token'].split('.')
+        self.assert401(self.access('%s.%s.%s' % (
+            header, payload, signature[::-1])).status_code)
+        self.assert401(self.access('%s.%s.%s' % (
+            header, payload[:-2], signature)).status_code)
+        self.assertIsNone(signer.verify('not.a.token'))
+
+    def test_expired(self):
+        token = signer.sign({'exp': int(time.time()) - 1})
+        self.assertIsNone(signer.verify(token))
+
+    def test_key_rotation(self):
+        old = signer.sign({'exp': int(time.time()) + 60})
+
+        signer.load({'k1': 'secret1', 'k2': 'secret2'}, 'k2')
+        new = signer.sign({'exp': int(time.time()) + 60})
+        self.assertIsNotNone(signer.verify(old))
+        self.assertIsNotNone(signer.verify(new))
+        self.assertNotEqual(old.split('.')[0], new.split('.')[0])
+
+        signer.load({'k2': 'secret2'})
+        self.assertIsNone(signer.verify(old))
+        self.assertIsNotNone(signer.verify(new))
+
+        self.assertRaises(ValueError, signer.load, {'k2': 'secret2'}, 'k3')
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestMetrics(TestBase):
+    def settings(self):
+        settings = super(TestMetrics, self).settings()
+        settings['SENTINEL_METRICS'] = True
+        settings['SENTINEL_METRICS_URL'] = '/testmetrics'
+        return settings
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.clear()
+
+    def test_metrics_endpoint(self):
+        self.get_token()
+        r = self.test_client.get('/testauth/testmetrics')
+        self.assert200(r.status_code)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        body = r.get_data(as_text=True)
+        for stage in ('storage.get_user', 'storage.save_token', 'bcrypt',
+                      'oauthlib.token'):
+            self.assertIn('sentinel_stage_duration_seconds_count'
+                          '{stage="%s"} 1' % stage, body)
+        self.assertIn('sentinel_stage_duration_seconds_bucket'
+                      '{stage="bcrypt",le="+Inf"} 1', body)
+        self.assertIn('sentinel_bcrypt_queue_depth 0', body)
+
+        self.app.config['SENTINEL_MANAGEMENT_USERNAME'] = 'user'
+        self.app.config['SENTINEL_MANAGEMENT_PASSWORD'] = 'pw'
+        r = self.test_client.get('/testauth/testmetrics')
+        self.assert401(r.status_code)
+
+    @unittest.skipIf(not signals_available, "blinker unavailable")
+    def test_signal(self):
+        received = []
+
+        def receiver(stage, duration, error):
+            received.append((stage, error))
+        stage_timed.connect(receiver)
+        try:
+            Storage.get_client(self.clientid)
+        finally:
+            stage_timed.disconnect(receiver)
+        self.assertEqual(received, [('storage.get_client', False)])
+
+    def test_errors(self):
+        self.assertRaises(AttributeError, Storage.save_token, {}, None)
+        self.assertEqual(metrics.stats()['storage.save_token'][2], 1)
+
+    def test_disabled(self):
+        metrics.enabled = False
+        Storage.get_client(self.clientid)
+        self.assertEqual(metrics.stats(), {})
+
 
 class TestManagementEndpoint(TestBase):
     def test_man_endpoint(self):
@@ -111,6 +495,45 @@ class TestManagementEndpoint(TestBase):
         r = self.test_client.get(self.man_endpoint, headers=headers)
         self.assert200(r.status_code)
 
+    def test_man_pagination(self):
+        self.app.config['SENTINEL_MANAGEMENT_PAGE_SIZE'] = 1
+        Storage.save_user('other', 'pw')
+
+        r = self.test_client.get(self.man_endpoint)
+        self.assert200(r.status_code)
+        page = r.get_data(as_text=True)
+        self.assertIn('There are 2 authorized users', page)
+        self.assertIn('user_after=other', page)
+        self.assertNotIn(self.user.hashpw.decode('utf-8')
+                         if isinstance(self.user.hashpw, bytes)
+                         else self.user.hashpw, page)
+
+        r = self.test_client.get(self.man_endpoint + '?user_after=other')
+        page = r.get_data(as_text=True)
+        self.assertIn('<td>user</td>', page)
+        self.assertNotIn('user_after=', page)
+
+        r = self.test_client.get(self.man_endpoint + '?user_prefix=us')
+        page = r.get_data(as_text=True)
+        self.assertIn('There are 1 authorized users', page)
+        self.assertIn('<td>user</td>', page)
+
+    def test_man_existing_user(self):
+        self.sentinel.ensure_indexes()
+        form = {'submit': 'Add User', 'username': self.username,
+                'password': 'other'}
+        r = self.test_client.post(self.man_endpoint, data=form)
+        self.assertEqual(r.status_code, 409)
+        page = r.get_data(as_text=True)
+        self.assertIn('User user already exists.', page)
+        self.assertIn('There are 1 authorized users', page)
+
+        form['username'] = 'other'
+        r = self.test_client.post(self.man_endpoint, data=form)
+        self.assert200(r.status_code)
+        self.assertNotIn('already exists', r.get_data(as_text=True))
+        self.assertEqual(Storage.count_users(), 2)
+
 
 class TestStorage(TestBase):
     def test_get_client(self):
@@ -150,6 +573,19 @@ class TestStorage(TestBase):
         self.assertEqual(user.username, self.username)
         self.assertEqual(user.hashpw, self.user.hashpw)
 
+    def test_get_user_wrong_password(self):
+        user = Storage.get_user(self.username, 'notreally')
+        self.assertIsNone(user)
+
+    def test_get_user_text_hash(self):
+        # hashes stored as text rather than binary are supported too.
+        hashpw = bcrypt.hashpw(b'testpw', bcrypt.gensalt(4))
+        mongo.db.users.insert({'username': 'test',
+                               'hashpw': hashpw.decode('utf-8')})
+        user = Storage.get_user('test', 'testpw')
+        self.assertEqual(user.username, 'test')
+        self.assertIsNone(Storage.get_user('test', 'notreally'))
+
     def test_save_user(self):
         user = Storage.save_user('test', 'testpw')
         self.assertEqual(mongo.db.users.count(), 2)
@@ -168,3 +604,1501 @@ class TestStorage(TestBase):
         self.assertEqual(users[0].hashpw, self.user.hashpw)
         self.assertEqual(users[1].username, user.username)
         self.assertEqual(users[1].hashpw, user.hashpw)
+
+    def test_users_page(self):
+        for username in ('b', 'a.b', 'ab'):
+            mongo.db.users.insert({'username': username, 'hashpw': 'x'})
+
+        users, after = Storage.users_page(limit=2)
+        self.assertEqual([u.username for u in users], ['a.b', 'ab'])
+        self.assertIsNone(users[0].hashpw)
+        self.assertEqual(after, 'ab')
+
+        users, after = Storage.users_page(after, limit=2)
+        self.assertEqual([u.username for u in users], ['b', 'user'])
+        self.assertIsNone(after)
+
+        # prefixes are matched literally.
+        users, after = Storage.users_page(prefix='a.')
+        self.assertEqual([u.username for u in users], ['a.b'])
+        self.assertEqual(Storage.count_users('a'), 2)
+        self.assertEqual(Storage.count_users(), 4)
+
+    def test_clients_page(self):
+        client = Storage.generate_client()
+        clients, after = Storage.clients_page(limit=1)
+        self.assertEqual(len(clients), 1)
+        self.assertEqual(after, clients[0].client_id)
+
+        clients, after = Storage.clients_page(prefix=client.client_id)
+        self.assertEqual([c.client_id for c in clients], [client.client_id])
+        self.assertEqual(clients[0].client_type, 'public')
+        self.assertEqual(Storage.count_clients(), 2)
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_get_token_from_cache(self):
+        son = self.get_token()
+
+        # once cached, the token is validated without hitting the database.
+        mongo.db.tokens.remove({'access_token': son['access_token']})
+        token = Storage.get_token(access_token=son['access_token'])
+        self.assertIsInstance(token, Token)
+        self.assertEqual(token.access_token, son['access_token'])
+        self.assertEqual(token.refresh_token, son['refresh_token'])
+        self.assertEqual(token.client_id, self.clientid)
+        self.assertEqual(token.user_id, self.user.id)
+        self.assertEqual(token.user.id, self.user.id)
+        self.assertEqual(token.user.username, self.username)
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_get_token_refills_cache(self):
+        son = self.get_token()
+        key = TOKEN_KEY % son['access_token']
+
+        redis.delete(key)
+        token = Storage.get_token(access_token=son['access_token'])
+        self.assertEqual(token.user.username, self.username)
+        self.assertTrue(redis.exists(key))
+        self.assertTrue(0 < redis.ttl(key) <= 999)
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_get_token_embedded_user(self):
+        son = self.get_token()
+        doc = mongo.db.tokens.find_one({'access_token': son['access_token']})
+        self.assertEqual(doc['user'], {'username': self.username,
+                                       'version': 0})
+
+        # the token and its user come from the token document alone.
+        redis.delete(TOKEN_KEY % son['access_token'])
+        mongo.db.users.remove()
+        token = Storage.get_token(refresh_token=son['refresh_token'])
+        self.assertEqual(token.user.id, self.user.id)
+        self.assertEqual(token.user.username, self.username)
+        self.assertEqual(token.user.version, 0)
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_update_user(self):
+        son = self.get_token()
+        self.assertEqual(Storage.get_token(son['access_token']).user.username,
+                         self.username)
+
+        user = Storage.update_user(self.user.id, username='renamed',
+                                   password='newpw')
+        self.assertEqual((user.username, user.version), ('renamed', 1))
+        self.assertEqual(Storage.get_user('renamed', 'newpw').id,
+                         self.user.id)
+        self.assertIsNone(Storage.get_user(self.username, self.pw))
+
+        # snapshots and caches follow the update.
+        self.assertFalse(redis.exists(TOKEN_KEY % son['access_token']))
+        token = Storage.get_token(son['access_token'])
+        self.assertEqual((token.user.username, token.user.version),
+                         ('renamed', 1))
+        self.assertIsNone(Storage.update_user('notreally', 'test'))
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_update_user_newer_snapshot(self):
+        self.get_token()
+        # a later update got to the tokens first.
+        mongo.db.tokens.update({}, {'$set': {'user': {'username': 'later',
+                                                      'version': 2}}})
+        Storage.update_user(self.user.id, username='renamed')
+        self.assertEqual(mongo.db.tokens.find_one()['user']['username'],
+                         'later')
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_embed_users(self):
+        self.get_token()
+        mongo.db.tokens.update({}, {'$set': {'user': None}})
+        mongo.db.users.update({}, {'$unset': {'version': 1}})
+
+        # legacy token documents still come along with their user.
+        token = Storage.get_token(
+            refresh_token=mongo.db.tokens.find_one()['refresh_token'])
+        self.assertEqual(token.user.username, self.username)
+
+        self.assertEqual(embed_users(mongo.db), 1)
+        self.assertEqual(mongo.db.tokens.find_one()['user'],
+                         {'username': self.username, 'version': 0})
+        self.assertEqual(embed_users(mongo.db), 0)
+
+
+class BackendTests(object):
+    """ Storage tests run against the backends other than MongoDB. """
+    backend = None
+
+    def settings(self):
+        settings = super(BackendTests, self).settings()
+        settings['SENTINEL_BACKEND'] = self.backend
+        return settings
+
+    def test_nothing_in_mongo(self):
+        self.get_token()
+        self.assertEqual(mongo.db.users.count(), 0)
+        self.assertEqual(mongo.db.clients.count(), 0)
+        self.assertEqual(mongo.db.tokens.count(), 0)
+
+    def test_access(self):
+        son = self.get_token()
+        headers = [('Authorization', 'Bearer %s' % son['access_token'])]
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assert200(r.status_code)
+
+        token = Storage.get_token(refresh_token=son['refresh_token'])
+        self.assertEqual(token.access_token, son['access_token'])
+        self.assertEqual(token.client_id, self.clientid)
+        self.assertEqual(token.user_id, self.user.id)
+        self.assertEqual(token.user.username, self.username)
+        self.assertTrue(token.expires > datetime.utcnow())
+
+    def test_token_replaced(self):
+        old, new = self.get_token(), self.get_token()
+        self.assertIsNone(Storage.get_token(access_token=old['access_token']))
+        self.assertIsNone(
+            Storage.get_token(refresh_token=old['refresh_token']))
+        self.assertEqual(Storage.get_tokens(
+            [old['access_token'], new['access_token']])[1].access_token,
+            new['access_token'])
+
+    def test_revoke_token(self):
+        son = self.get_token()
+        self.assertIsNone(Storage.revoke_token(son['refresh_token'],
+                                               client_id='notreally'))
+        token = Storage.revoke_token(son['refresh_token'])
+        self.assertEqual(token.access_token, son['access_token'])
+        self.assertIsNone(Storage.get_token(access_token=son['access_token']))
+        self.assertIsNone(
+            Storage.get_token(refresh_token=son['refresh_token']))
+        # the next grant is stored as usual.
+        self.get_token()
+
+    def test_man_existing_user(self):
+        r = self.test_client.post(self.man_endpoint, data={
+            'submit': 'Add User', 'username': self.username,
+            'password': 'other'})
+        self.assertEqual(r.status_code, 409)
+        self.assertIn('User user already exists.', r.get_data(as_text=True))
+
+    def test_users(self):
+        self.assertRaises(ValueError, Storage.save_user, 'user', 'pw')
+        self.assertIsNone(Storage.get_user('user', 'notreally'))
+        self.assertIsNone(Storage.get_user('notreally', 'notreally'))
+        self.assertEqual(Storage.get_user('user', 'pw').id, self.user.id)
+
+        for username in ('usa', 'uk', 'ab'):
+            Storage.save_user(username, 'pw')
+        self.assertEqual(Storage.count_users(), 4)
+        self.assertEqual(Storage.count_users('us'), 2)
+        self.assertEqual([u.username for u in Storage.all_users()],
+                         ['ab', 'uk', 'usa', 'user'])
+
+        users, after = Storage.users_page(prefix='u', limit=2)
+        self.assertEqual([u.username for u in users], ['uk', 'usa'])
+        self.assertIsNone(users[0].hashpw)
+        self.assertEqual(after, 'usa')
+        users, after = Storage.users_page(after, 'u', 2)
+        self.assertEqual([u.username for u in users], ['user'])
+        self.assertIsNone(after)
+
+    def test_update_user(self):
+        son = self.get_token()
+        Storage.save_user('taken', 'pw')
+        self.assertRaises(ValueError, Storage.update_user, self.user.id,
+                          username='taken')
+        self.assertEqual(Storage.get_user('taken', 'pw').username, 'taken')
+
+        user = Storage.update_user(self.user.id, username='renamed',
+                                   password='newpw')
+        self.assertEqual((user.id, user.username), (self.user.id, 'renamed'))
+        self.assertEqual(Storage.get_user('renamed', 'newpw').id,
+                         self.user.id)
+        self.assertIsNone(Storage.get_user('renamed', self.pw))
+        self.assertIsNone(Storage.get_user(self.username, self.pw))
+        self.assertEqual([u.username for u in Storage.all_users()],
+                         ['renamed', 'taken'])
+        # tokens carry the new username.
+        self.assertEqual(Storage.get_token(son['access_token']).user.username,
+                         'renamed')
+
+        Storage.update_user(self.user.id, password='other')
+        self.assertEqual(Storage.get_user('renamed', 'other').id,
+                         self.user.id)
+        self.assertIsNone(Storage.update_user('notreally', 'test'))
+
+    def test_clients(self):
+        clients = [self.clientid, Storage.generate_client().client_id]
+        clients.sort()
+        self.assertEqual(Storage.count_clients(), 2)
+        self.assertEqual(Storage.count_clients(clients[1][:20]), 1)
+        self.assertEqual([c.client_id for c in Storage.all_clients()],
+                         clients)
+
+        page, after = Storage.clients_page(limit=1)
+        self.assertEqual(page[0].client_id, clients[0])
+        self.assertEqual(page[0].client_type, 'public')
+        page, after = Storage.clients_page(after, limit=1)
+        self.assertEqual(page[0].client_id, clients[1])
+        self.assertIsNone(after)
+
+
+class TestMemoryBackend(BackendTests, TestBase):
+    backend = 'memory'
+
+    def test_load(self):
+        self.assertIsInstance(Storage.backend, MemoryBackend)
+        self.assertIsInstance(
+            load('flask_sentinel.backends.MemoryBackend'), MemoryBackend)
+        self.assertRaises(ValueError, load, Client)
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestRedisBackend(BackendTests, TestBase):
+    backend = 'redis'
+
+    def setUp(self):
+        # keys left behind by an interrupted run would clash with the user
+        # TestBase creates.
+        self.clear()
+        super(TestRedisBackend, self).setUp()
+
+    def tearDown(self):
+        super(TestRedisBackend, self).tearDown()
+        self.clear()
+
+    def clear(self):
+        # keys are deleted once scanned, as deleting them while scanning may
+        # skip some.
+        for key in list(redis.scan_iter('sentinel:*')):
+            redis.delete(key)
+
+    def test_no_deprecated_commands(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', DeprecationWarning)
+            Storage.generate_client()
+            self.get_token()
+        self.assertEqual([w for w in caught
+                          if issubclass(w.category, DeprecationWarning) and
+                          'backends.py' in w.filename], [])
+
+    def test_expiration(self):
+        son = self.get_token()
+        key = 'sentinel:access:%s' % son['access_token']
+        # tokens can be refreshed for a while after they expire.
+        self.assertTrue(999 < redis.ttl(key) <= 999 + EXPIRED_TOKEN_TTL)
+
+
+class _Request(object):
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+
+
+@unittest.skipIf(aio is None, "asyncio drivers unavailable")
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestAsyncStorage(TestBase):
+    def setUp(self):
+        super(TestAsyncStorage, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.storage = aio.AsyncStorage(self.app)
+        self.validator = aio.AsyncValidator(self.storage)
+
+    def tearDown(self):
+        self.wait(self.storage.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(TestAsyncStorage, self).tearDown()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def assertSameToken(self, token, compare):
+        if token is None or compare is None:
+            self.assertIs(token, compare)
+            return
+        fields = [_to_json(tok) for tok in (token, compare)]
+        for doc in fields:
+            # tokens served from the redis cache carry no document id.
+            del doc['user']
+            doc.pop('_id', None)
+        self.assertEqual(fields[0], fields[1])
+        self.assertEqual(token.user.id, compare.user.id)
+        self.assertEqual(token.user.username, compare.user.username)
+
+    def test_get_client(self):
+        for client_id in (self.clientid, 'notreally'):
+            client = Storage.get_client(client_id)
+            compare = self.wait(self.storage.get_client(client_id))
+            if client is None:
+                self.assertIsNone(compare)
+                continue
+            self.assertEqual(_to_json(client), _to_json(compare))
+
+    def test_get_user(self):
+        for username, password in ((self.username, self.pw),
+                                   (self.username, 'notreally'),
+                                   ('notreally', self.pw),
+                                   (self.username, None)):
+            user = Storage.get_user(username, password)
+            compare = self.wait(self.storage.get_user(username, password))
+            if user is None:
+                self.assertIsNone(compare)
+                continue
+            self.assertEqual(_to_json(user), _to_json(compare))
+
+    def test_get_user_executor(self):
+        class Executor(ThreadPoolExecutor):
+            submitted = 0
+
+            def submit(self, *args, **kwargs):
+                self.submitted += 1
+                return super(Executor, self).submit(*args, **kwargs)
+
+        self.storage.executor = Executor(1)
+        user = self.wait(self.storage.get_user(self.username, self.pw))
+        self.assertEqual(user.username, self.username)
+        self.assertEqual(self.storage.executor.submitted, 1)
+        self.storage.executor.shutdown()
+
+    def test_get_token(self):
+        son = self.get_token()
+        key = TOKEN_KEY % son['access_token']
+        for kwargs in ({'access_token': son['access_token']},
+                       {'refresh_token': son['refresh_token']},
+                       {'access_token': 'notreally'}):
+            # served from the redis cache, then from MongoDB.
+            for cached in (True, False):
+                if not cached:
+                    redis.delete(key)
+                compare = self.wait(self.storage.get_token(**kwargs))
+                if not cached:
+                    redis.delete(key)
+                self.assertSameToken(Storage.get_token(**kwargs), compare)
+
+        redis.delete(key)
+        self.wait(self.storage.get_token(access_token=son['access_token']))
+        self.assertTrue(redis.exists(key))
+
+    def test_get_tokens(self):
+        son = self.get_token()
+        other = Storage.save_user('other', 'pw')
+        Storage.save_token({'token_type': 'Bearer', 'access_token': 'a',
+                            'refresh_token': 'r', 'expires_in': 999},
+                           _Request(self.clientapp, other))
+        redis.delete(TOKEN_KEY % 'a')
+
+        access_tokens = [son['access_token'], 'a', 'notreally']
+        tokens = self.wait(self.storage.get_tokens(access_tokens))
+        for token, compare in zip(Storage.get_tokens(access_tokens), tokens):
+            self.assertSameToken(token, compare)
+        self.assertEqual(self.wait(self.storage.get_tokens([])), [])
+
+    def test_save_token(self):
+        son = self.get_token()
+        self.wait(self.storage.save_token(
+            {'token_type': 'Bearer', 'access_token': 'a',
+             'refresh_token': 'r', 'expires_in': 999},
+            _Request(self.clientapp, self.user)))
+
+        self.assertIsNone(Storage.get_token(access_token=son['access_token']))
+        self.assertEqual(mongo.db.tokens.count(), 1)
+        token = Storage.get_token(refresh_token='r')
+        self.assertEqual(token.access_token, 'a')
+        self.assertEqual(redis.get('a').decode('utf-8'), str(self.user.id))
+        self.assertSameToken(token,
+                             self.wait(self.storage.get_token('a')))
+
+    def test_validate_bearer_token(self):
+        son = self.get_token()
+        validate = self.validator.validate_bearer_token
+        tokens = self.wait(asyncio.gather(*[
+            validate(son['access_token']) for _ in range(20)]))
+        self.assertEqual(set(t.access_token for t in tokens),
+                         set([son['access_token']]))
+        self.assertIsNone(self.wait(validate('notreally')))
+        self.assertIsNone(self.wait(validate(son['access_token'],
+                                             ['email'])))
+
+        mongo.db.tokens.update(
+            {'access_token': son['access_token']},
+            {'$set': {'expires': datetime.utcnow() - timedelta(seconds=1)}})
+        redis.delete(TOKEN_KEY % son['access_token'])
+        self.assertIsNone(self.wait(validate(son['access_token'])))
+
+    def test_validate_user(self):
+        client = self.wait(self.validator.authenticate_client_id(
+            self.clientid))
+        self.assertEqual(client.client_id, self.clientid)
+        user = self.wait(self.validator.validate_user(self.username, self.pw,
+                                                      client))
+        self.assertEqual(user.id, self.user.id)
+        self.assertIsNone(self.wait(self.validator.validate_user(
+            self.username, 'notreally', client)))
+
+
+class _Replica(StrictRedis):
+    """ Replica stand-in, on another database of the test server. """
+    down = False
+    link = 'up'
+
+    def execute_command(self, *args, **options):
+        if self.down:
+            raise RedisConnectionError('replica is down')
+        return super(_Replica, self).execute_command(*args, **options)
+
+    def info(self, section=None):
+        self.ping()
+        return {'role': 'slave', 'master_link_status': self.link,
+                'master_last_io_seconds_ago': 0}
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestRedisReplicas(TestBase):
+    def settings(self):
+        settings = super(TestRedisReplicas, self).settings()
+        settings['SENTINEL_REDIS_READ_FROM_REPLICAS'] = True
+        settings['SENTINEL_REDIS_REPLICA_URL'] = 'redis://localhost:6379/1'
+        return settings
+
+    def setUp(self):
+        super(TestRedisReplicas, self).setUp()
+        redis.replica = self.replica = _Replica(db=1)
+        self.replica.flushdb()
+
+    def tearDown(self):
+        self.replica.down = False
+        self.replica.flushdb()
+        super(TestRedisReplicas, self).tearDown()
+
+    def cache_on_replica(self, access_token):
+        """ Puts a token only the replica knows about. """
+        son = self.get_token()
+        redis.replica.set(TOKEN_KEY % access_token,
+                          redis.get(TOKEN_KEY % son['access_token']))
+
+    def test_replica_read(self):
+        self.cache_on_replica('x')
+        token = Storage.get_token(access_token='x')
+        self.assertEqual(token.user.username, self.username)
+        self.assertEqual(Storage.get_tokens(['x'])[0].access_token, 'x')
+        self.assertEqual(redis.replica_reads, 2)
+        self.assertEqual(redis.replica_fallbacks, 0)
+
+    def test_replica_miss(self):
+        # tokens are read from the primary until replicated.
+        son = self.get_token()
+        token = Storage.get_token(access_token=son['access_token'])
+        self.assertEqual(token.user.username, self.username)
+        self.assertEqual(redis.replica_fallbacks, 1)
+
+    def test_replica_down(self):
+        son = self.get_token()
+        redis.replica.down = True
+        for _ in range(2):
+            token = Storage.get_token(access_token=son['access_token'])
+            self.assertEqual(token.user.username, self.username)
+        # the replica is left alone for a while.
+        self.assertEqual(redis.replica_fallbacks, 0)
+        self.assertEqual(redis.replica_reads, 0)
+
+    def test_replica_stale(self):
+        self.cache_on_replica('x')
+        redis.replica.link = 'down'
+        self.assertIsNone(Storage.get_token(access_token='x'))
+        self.assertEqual(redis.replica_reads, 0)
+
+    def test_replica_url_required(self):
+        app = Flask(__name__)
+        app.config.update(self.settings())
+        app.config['SENTINEL_REDIS_REPLICA_URL'] = None
+        self.assertRaises(ValueError, ResourceOwnerPasswordCredentials, app)
+
+
+@unittest.skipIf(REDIS_SERVER is None, "redis-server not installed")
+class TestRedisSentinel(TestBase):
+    """ Runs a primary, a replica and a sentinel on local ports. """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        config = os.path.join(cls.tmp, 'sentinel.conf')
+        with open(config, 'w') as f:
+            f.write('sentinel monitor test 127.0.0.1 6390 1\n'
+                    'sentinel down-after-milliseconds test 1000\n')
+        cls.processes = [
+            redis_server(6390),
+            redis_server(6391, '--replicaof', '127.0.0.1', '6390'),
+            redis_server(26390, '--sentinel', config=config),
+        ]
+
+    @classmethod
+    def tearDownClass(cls):
+        for process in cls.processes:
+            process.kill()
+            process.wait()
+        shutil.rmtree(cls.tmp)
+
+    def settings(self):
+        settings = super(TestRedisSentinel, self).settings()
+        settings['SENTINEL_REDIS_SENTINELS'] = [('127.0.0.1', 26390)]
+        settings['SENTINEL_REDIS_SERVICE_NAME'] = 'test'
+        settings['SENTINEL_REDIS_READ_FROM_REPLICAS'] = True
+        return settings
+
+    def test_sentinel(self):
+        son = self.get_token()
+        key = TOKEN_KEY % son['access_token']
+        primary = StrictRedis(port=6390)
+        self.assertTrue(primary.exists(key))
+        primary.wait(1, 1000)
+
+        headers = [('Authorization', 'Bearer %s' % son['access_token'])]
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assert200(r.status_code)
+        self.assertEqual(redis.replica_reads, 1)
+
+    def test_stale_replica(self):
+        son = self.get_token()
+        replica = StrictRedis(port=6391)
+        replica.execute_command('REPLICAOF', '127.0.0.1', '1')
+        try:
+            token = Storage.get_token(access_token=son['access_token'])
+            self.assertEqual(token.user.username, self.username)
+            self.assertEqual(redis.replica_reads, 0)
+        finally:
+            replica.execute_command('REPLICAOF', '127.0.0.1', '6390')
+
+
+@unittest.skipIf(REDIS_SERVER is None, "redis-server not installed")
+class TestRedisCluster(TestBase):
+    """ Runs a three nodes cluster on local ports. """
+    ports = (7390, 7391, 7392)
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import redis.cluster  # noqa
+        except ImportError:
+            raise unittest.SkipTest('redis-py 4.1+ required')
+        cls.tmp = tempfile.mkdtemp()
+        cls.processes = []
+        nodes = []
+        for port in cls.ports:
+            cls.processes.append(redis_server(
+                port, '--cluster-enabled', 'yes', '--cluster-config-file',
+                os.path.join(cls.tmp, 'nodes-%d.conf' % port)))
+            nodes.append(StrictRedis(port=port))
+
+        slots = 16384 // len(nodes) + 1
+        for index, node in enumerate(nodes):
+            node.execute_command('CLUSTER', 'ADDSLOTS', *range(
+                index * slots, min((index + 1) * slots, 16384)))
+            node.execute_command('CLUSTER', 'MEET', '127.0.0.1',
+                                 cls.ports[0])
+        for _ in range(100):
+            if all(b'cluster_state:ok' in node.execute_command(
+                    'CLUSTER', 'INFO') for node in nodes):
+                return
+            time.sleep(.1)
+        raise RuntimeError('the cluster is not ready')
+
+    @classmethod
+    def tearDownClass(cls):
+        for process in cls.processes:
+            process.kill()
+            process.wait()
+        shutil.rmtree(cls.tmp)
+
+    def settings(self):
+        settings = super(TestRedisCluster, self).settings()
+        settings['SENTINEL_REDIS_URL'] = 'redis://127.0.0.1:7390/0'
+        settings['SENTINEL_REDIS_CLUSTER'] = True
+        settings['SENTINEL_REDIS_READ_FROM_REPLICAS'] = True
+        settings['SENTINEL_REVOKE_FLUSH_INTERVAL'] = 0
+        return settings
+
+    def test_cluster(self):
+        tokens = [self.get_token()['access_token'] for _ in range(2)]
+        self.assertIsNone(Storage.get_tokens(tokens)[0])
+        self.assertEqual(Storage.get_tokens(tokens)[1].access_token,
+                         tokens[1])
+
+        headers = [('Authorization', 'Bearer %s' % tokens[1])]
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assert200(r.status_code)
+
+        self.assertIsNotNone(Storage.revoke_token(tokens[1]))
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assert401(r.status_code)
+
+
+class _Lagging(object):
+    """ Secondary stand-in which has not replicated anything yet. """
+    read_preference = Nearest()
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find_one(self, *args, **kwargs):
+        return None
+
+    def with_options(self, read_preference):
+        return self.collection.with_options(read_preference=read_preference)
+
+
+class TestMongoReads(TestBase):
+    def settings(self):
+        settings = super(TestMongoReads, self).settings()
+        settings['SENTINEL_MONGO_READ_PREFERENCES'] = {
+            'get_token': 'nearest', 'get_client': 'secondaryPreferred'}
+        settings['SENTINEL_MONGO_READ_CONCERNS'] = {'get_token': 'local'}
+        settings['SENTINEL_MONGO_MAX_STALENESS'] = 120
+        return settings
+
+    def test_read_options(self):
+        tokens = _reads(mongo.db.tokens, 'get_token')
+        self.assertEqual(tokens.read_preference, Nearest(max_staleness=120))
+        self.assertEqual(tokens.read_concern.level, 'local')
+        self.assertEqual(_read_options(self.app.config, 'get_user'), {})
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_primary_fallback(self):
+        son = self.get_token()
+        redis.delete(TOKEN_KEY % son['access_token'])
+        reads = data._reads
+        data._reads = lambda collection, operation: _Lagging(collection)
+        try:
+            client = Storage.get_client(self.clientid)
+            token = Storage.get_token(access_token=son['access_token'])
+        finally:
+            data._reads = reads
+        self.assertEqual(client.client_id, self.clientid)
+        self.assertEqual(token.user.username, self.username)
+
+    def test_unknown_read_preference(self):
+        app = Flask(__name__)
+        app.config.update(self.settings())
+        app.config['SENTINEL_MONGO_READ_PREFERENCES'] = {
+            'get_token': 'sometimes'}
+        self.assertRaises(ValueError, ResourceOwnerPasswordCredentials, app)
+
+
+class TestTokenCache(TestBase):
+    def settings(self):
+        settings = super(TestTokenCache, self).settings()
+        settings['SENTINEL_TOKEN_CACHE'] = True
+        settings['SENTINEL_TOKEN_CACHE_SIZE'] = 2
+        return settings
+
+    def token(self, access_token, expires_in=999):
+        expires = datetime.utcnow() + timedelta(seconds=expires_in)
+        return Token(access_token=access_token, expires=expires)
+
+    def test_size(self):
+        cache = TokenCache()
+        cache.size = 2
+        cache._pid = os.getpid()
+        for access_token in ('a', 'b', 'c'):
+            cache.set(self.token(access_token), cache.generation)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'size': 2})
+
+    def test_expires(self):
+        cache = TokenCache()
+        cache._pid = os.getpid()
+        cache.set(self.token('a', expires_in=-1), cache.generation)
+        self.assertIsNone(cache.get('a'))
+
+    def test_generation(self):
+        cache = TokenCache()
+        cache._pid = os.getpid()
+        generation = cache.generation
+        # a token dropped while another one was being loaded.
+        cache.invalidate('b')
+        cache.set(self.token('a'), generation)
+        self.assertIsNone(cache.get('a'))
+        cache.set(self.token('a'), cache.generation)
+        self.assertIsNotNone(cache.get('a'))
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_revoked_while_loading(self):
+        access_token = self.get_token()['access_token']
+        cached_token = data._cached_token
+
+        def revoked_meanwhile(access_token):
+            token = cached_token(access_token)
+            # as the invalidation listener would.
+            token_cache.invalidate(access_token)
+            return token
+        data._cached_token = revoked_meanwhile
+        try:
+            self.assertIsNotNone(Storage.get_token(access_token=access_token))
+        finally:
+            data._cached_token = cached_token
+        self.assertIsNone(token_cache.get(access_token))
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_get_token(self):
+        access_token = self.get_token()['access_token']
+        token = Storage.get_token(access_token=access_token)
+        self.assertIs(Storage.get_token(access_token=access_token), token)
+        self.assertEqual(token_cache.hits, 1)
+
+    @unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+    def test_invalidation(self):
+        access_token = self.get_token()['access_token']
+        self.assertIsNotNone(Storage.get_token(access_token=access_token))
+
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(token_cache.channel)
+        pubsub.get_message()
+
+        # a new grant for the same (client, user) replaces the token.
+        self.get_token()
+        self.assertIsNone(Storage.get_token(access_token=access_token))
+
+        message = pubsub.get_message(timeout=1)
+        self.assertEqual(message['data'].decode('utf-8'), access_token)
+
+
+class TestIndexes(TestBase):
+    def statuses(self):
+        return dict(((e['collection'], e['keys'][0][0]), e['status'])
+                    for e in self.sentinel.index_report())
+
+    def test_ensure_indexes(self):
+        statuses = self.statuses()
+        self.assertEqual(statuses[('users', 'username')], 'missing')
+
+        self.assertEqual(self.sentinel.ensure_indexes(), [])
+        statuses = self.statuses()
+        self.assertEqual(len(statuses), 7)
+        self.assertEqual(set(statuses.values()), set(['ok']))
+
+    def test_conflicting_index(self):
+        mongo.db.users.create_index('username')
+        statuses = self.statuses()
+        self.assertEqual(statuses[('users', 'username')], 'conflicting')
+
+    def test_expired_token_ttl(self):
+        self.app.config['SENTINEL_EXPIRED_TOKEN_TTL'] = None
+        self.sentinel.ensure_indexes()
+        statuses = self.statuses()
+        self.assertEqual(len(statuses), 6)
+        self.assertFalse(('tokens', 'expires') in statuses)
+
+    def test_unreachable_at_init(self):
+        calls = []
+
+        def ensure_indexes():
+            calls.append('indexes')
+            raise ConnectionFailure('unreachable')
+        self.sentinel.ensure_indexes = ensure_indexes
+        metadata_cache.enabled = True
+        metadata_cache.warm = lambda load: calls.append('clients')
+        try:
+            with self.app.app_context():
+                self.sentinel._load(self.app, Config(self.app))
+                self.assertEqual(calls, ['clients'])
+                # the clients are not loaded once MongoDB is found down.
+                self.app.config['SENTINEL_ENSURE_INDEXES'] = True
+                self.sentinel._load(self.app, Config(self.app))
+                self.assertEqual(calls, ['clients', 'indexes'])
+        finally:
+            metadata_cache.enabled = False
+            del metadata_cache.warm
+
+
+class TestBulk(TestBase):
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.sentinel.ensure_indexes()
+
+    def test_import_users(self):
+        records = read_records(StringIO(
+            '{"username": "a", "password": "pa"}\n'
+            '{"username": "user", "password": "pw"}\n'
+            'nope\n'
+            '\n'
+            '{"username": "b"}\n'
+            '{"username": "c", "password": "pc"}\n'))
+        progress = []
+        report = import_users(mongo.db, records, processes=0, batch_size=2,
+                              rounds=4, progress=progress.append)
+
+        self.assertEqual(report.keys, ['a', 'c'])
+        self.assertEqual([n for n, _ in report.errors], [2, 3, 4])
+        self.assertEqual(report.errors[0][1], 'user already exists')
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(Storage.get_user('c', 'pc').username, 'c')
+        self.assertEqual(mongo.db.users.count(), 3)
+
+    def test_import_users_processes(self):
+        records = read_records(StringIO(
+            'username,password\nx,px\ny,py\nz,pz\n'), 'csv')
+        report = import_users(mongo.db, records, processes=2, batch_size=2,
+                              rounds=4)
+        self.assertEqual(report.keys, ['x', 'y', 'z'])
+        self.assertEqual(report.errors, [])
+        self.assertEqual(Storage.get_user('y', 'py').username, 'y')
+
+    def test_import_clients(self):
+        records = [{}, {'client_id': 'mine', 'client_type': 'confidential'},
+                   {'client_id': self.clientid}]
+        report = import_clients(mongo.db, records)
+
+        self.assertEqual(len(report.keys), 2)
+        self.assertEqual(report.keys[1], 'mine')
+        self.assertEqual(report.errors,
+                         [(3, '%s already exists' % self.clientid)])
+        self.assertEqual(Storage.get_client('mine').client_type,
+                         'confidential')
+        self.assertIsNotNone(Storage.get_client(report.keys[0]))
+
+
+class TestHasher(TestBase):
+    def settings(self):
+        settings = super(TestHasher, self).settings()
+        settings['SENTINEL_BCRYPT_WORKERS'] = 1
+        settings['SENTINEL_BCRYPT_QUEUE_SIZE'] = 1
+        settings['SENTINEL_BCRYPT_TIMEOUT'] = 0.1
+        return settings
+
+    def setUp(self):
+        super(TestHasher, self).setUp()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        hasher._hashpw = bcrypt.hashpw
+        super(TestHasher, self).tearDown()
+
+    def block(self, count):
+        """ Submits `count` hashes which won't complete until released. """
+        def hashpw(password, salt):
+            self.release.wait()
+            return bcrypt.hashpw(password, salt)
+        hasher._hashpw = hashpw
+
+        def get_user():
+            with self.app.app_context():
+                Storage.get_user(self.username, self.pw)
+
+        for n in range(count):
+            threading.Thread(target=get_user).start()
+        while hasher.busy < 1 or hasher.busy + hasher.depth < count:
+            time.sleep(0.01)
+
+    def test_get_user(self):
+        completed = hasher.completed
+        user = Storage.get_user(self.username, self.pw)
+        self.assertEqual(user.username, self.username)
+        self.assertEqual(hasher.completed, completed + 1)
+
+    def test_overloaded(self):
+        rejected = hasher.rejected
+        self.block(2)
+        self.assertRaises(Overloaded, Storage.get_user, self.username,
+                          self.pw)
+        self.assertEqual(hasher.stats()['rejected'], rejected + 1)
+        self.assertEqual(hasher.stats()['depth'], 1)
+
+        query = self.url % (self.clientid, self.username, self.pw)
+        r = self.test_client.post(query)
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.headers['Retry-After'], '1')
+
+    def test_management_overloaded(self):
+        self.block(2)
+        form = {'submit': 'Add User', 'username': 'other', 'password': 'pw'}
+        r = self.test_client.post(self.man_endpoint, data=form)
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.headers['Retry-After'], '1')
+        self.assertIn('User other was not added', r.get_data(as_text=True))
+        self.assertEqual(Storage.count_users(), 1)
+
+    def test_timeout(self):
+        timeouts = hasher.timeouts
+        self.block(1)
+        self.assertRaises(Overloaded, Storage.get_user, self.username,
+                          self.pw)
+        self.assertEqual(hasher.stats()['timeouts'], timeouts + 1)
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestRateLimits(TestBase):
+    def settings(self):
+        settings = super(TestRateLimits, self).settings()
+        settings['SENTINEL_RATE_LIMITS'] = {'username': (2, 60),
+                                            'remote_addr': (3, 60)}
+        return settings
+
+    def setUp(self):
+        super(TestRateLimits, self).setUp()
+        self.clear()
+
+    def tearDown(self):
+        self.clear()
+        hasher._hashpw = bcrypt.hashpw
+        Storage.backend.__dict__.pop('get_user', None)
+        super(TestRateLimits, self).tearDown()
+
+    def clear(self):
+        for key in list(redis.scan_iter(RATE_KEY % ('*', '*'))):
+            redis.delete(key)
+
+    def token_request(self, username):
+        return self.test_client.post(self.url % (self.clientid, username,
+                                                 self.pw))
+
+    def test_username_limit(self):
+        r = self.token_request(self.username)
+        self.assert200(r.status_code)
+        self.assertEqual(r.headers['X-RateLimit-Limit'], '2')
+        self.assertEqual(r.headers['X-RateLimit-Remaining'], '1')
+        self.assert200(self.token_request(self.username).status_code)
+
+        calls = []
+        hasher._hashpw = lambda *args: calls.append(args)
+        Storage.backend.get_user = lambda *args: calls.append(args)
+        rejected = limiter.rejected
+        r = self.token_request(self.username)
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(json.loads(r.get_data(as_text=True)),
+                         {'error': 'too_many_requests'})
+        self.assertEqual(r.headers['X-RateLimit-Remaining'], '0')
+        self.assertTrue(0 < int(r.headers['Retry-After']) <= 60)
+        self.assertEqual(calls, [])
+        self.assertEqual(limiter.rejected, rejected + 1)
+
+    def test_remote_addr_limit(self):
+        for username in ('a', 'b', 'c'):
+            self.assertNotEqual(self.token_request(username).status_code, 429)
+        r = self.token_request('d')
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(r.headers['X-RateLimit-Limit'], '3')
+
+    def test_rejected_requests_not_counted(self):
+        for n in range(3):
+            self.token_request(self.username)
+        # the third request was rejected, so one is left for the address.
+        self.assertNotEqual(self.token_request('other').status_code, 429)
+
+    def test_window_slides(self):
+        self.app.config['SENTINEL_RATE_LIMITS'] = {'username': (1, 0.5)}
+        limiter.init_app(Config(self.app), redis)
+        self.assertTrue(limiter.hit({'username': 'x'}).allowed)
+        self.assertFalse(limiter.hit({'username': 'x'}).allowed)
+        time.sleep(0.6)
+        self.assertTrue(limiter.hit({'username': 'x'}).allowed)
+
+    def test_unknown_limit(self):
+        self.app.config['SENTINEL_RATE_LIMITS'] = {'password': (1, 1)}
+        self.assertRaises(ValueError, RateLimiter().init_app,
+                          Config(self.app), redis)
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestLookupFilter(TestBase):
+    def settings(self):
+        settings = super(TestLookupFilter, self).settings()
+        settings['SENTINEL_NEGATIVE_CACHE_TTL'] = 30
+        settings['SENTINEL_FILTER'] = 'redis'
+        settings['SENTINEL_FILTER_CAPACITY'] = 1000
+        settings['SENTINEL_FILTER_ERROR_RATE'] = 0.01
+        return settings
+
+    def setUp(self):
+        self.clear()
+        super(TestLookupFilter, self).setUp()
+        self.queries = []
+        find_one = data._find_one
+
+        def count(collection, operation, spec, projection=None):
+            self.queries.append(spec)
+            return find_one(collection, operation, spec, projection)
+        data._find_one = count
+        self.find_one = find_one
+
+    def tearDown(self):
+        data._find_one = self.find_one
+        super(TestLookupFilter, self).tearDown()
+        self.clear()
+
+    def clear(self):
+        redis.delete(FILTER_KEY, NEXT_FILTER_KEY)
+        for key in list(redis.scan_iter(MISS_KEY % ('*', '*'))):
+            redis.delete(key)
+
+    @unittest.skipIf(aio is None, "asyncio drivers unavailable")
+    def test_async_save_token(self):
+        # remembered as missing, before being issued.
+        self.assertIsNone(Storage.get_token(refresh_token='r'))
+        lookup_filter.missed('refresh', 'r')
+
+        loop = asyncio.new_event_loop()
+        storage = aio.AsyncStorage(self.app)
+        loop.run_until_complete(storage.save_token(
+            {'token_type': 'Bearer', 'access_token': 'a',
+             'refresh_token': 'r', 'expires_in': 999},
+            _Request(self.clientapp, self.user)))
+        loop.run_until_complete(storage.close())
+        loop.close()
+
+        self.assertFalse(redis.exists(MISS_KEY % ('refresh', 'r')))
+        self.assertEqual(Storage.get_token(refresh_token='r').access_token,
+                         'a')
+        redis.delete(TOKEN_KEY % 'a')
+        self.assertEqual(Storage.get_token(access_token='a').refresh_token,
+                         'r')
+
+    def test_unknown_values(self):
+        self.assertIsNone(Storage.get_token(access_token='notreally'))
+        self.assertIsNone(Storage.get_token(refresh_token='notreally'))
+        self.assertIsNone(Storage.get_client('notreally'))
+        self.assertEqual(self.queries, [])
+        self.assertEqual(lookup_filter.filtered, 3)
+
+    def test_known_values(self):
+        son = self.get_token()
+        redis.delete(TOKEN_KEY % son['access_token'])
+        self.assertIsNotNone(Storage.get_token(son['access_token']))
+        self.assertIsNotNone(Storage.get_token(
+            refresh_token=son['refresh_token']))
+        self.assertIsNotNone(Storage.get_client(self.clientid))
+        self.assertEqual(lookup_filter.filtered, 0)
+
+    def test_negative_cache(self):
+        # without filter, misses are only remembered.
+        self.app.config['SENTINEL_FILTER'] = None
+        lookup_filter.init_app(Config(self.app), redis)
+        for n in range(3):
+            self.assertIsNone(Storage.get_client('notreally'))
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(lookup_filter.negative_hits, 2)
+        self.assertTrue(0 < redis.ttl(MISS_KEY % ('client',
+                                                  'notreally')) <= 30)
+
+    def test_rebuild(self):
+        son = self.get_token()
+        mongo.db.tokens.remove()
+        redis.delete(TOKEN_KEY % son['access_token'])
+
+        self.assertEqual(self.sentinel.rebuild_filter(), 1)
+        del self.queries[:]
+        self.assertIsNone(Storage.get_token(son['access_token']))
+        self.assertEqual(self.queries, [])
+        self.assertIsNotNone(Storage.get_client(self.clientid))
+        # values added while rebuilding are kept.
+        redis.set(NEXT_FILTER_KEY, b'\0')
+        client = Storage.generate_client()
+        redis.rename(NEXT_FILTER_KEY, FILTER_KEY)
+        self.assertFalse(lookup_filter.rejects('client', client.client_id))
+        self.assertTrue(lookup_filter.rejects('client', self.clientid))
+
+    def test_memory_filter(self):
+        self.app.config['SENTINEL_FILTER'] = 'memory'
+        lookup_filter.init_app(Config(self.app), redis)
+        self.assertFalse(lookup_filter.built)
+        self.assertEqual(self.sentinel.rebuild_filter(), 1)
+        self.assertIsNotNone(Storage.get_client(self.clientid))
+        client = Storage.generate_client()
+        self.assertIsNotNone(Storage.get_client(client.client_id))
+        self.assertIsNone(Storage.get_client('notreally'))
+        self.assertEqual(lookup_filter.filtered, 1)
+
+    def test_stats(self):
+        for n in range(50):
+            Storage.generate_client()
+        stats = lookup_filter.stats()
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual((stats['bytes'], stats['hashes']),
+                         ((bloom.size + 7) // 8, bloom.hashes))
+        self.assertTrue(0 < stats['fill'] < 0.1)
+        self.assertTrue(0 < stats['false_positive_rate'] < 0.01)
+
+    def test_unknown_filter(self):
+        self.app.config['SENTINEL_FILTER'] = 'cuckoo'
+        self.assertRaises(ValueError, lookup_filter.init_app,
+                          Config(self.app), redis)
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestMetadataCache(TestBase):
+    def settings(self):
+        settings = super(TestMetadataCache, self).settings()
+        settings['SENTINEL_METADATA_CACHE'] = True
+        settings['SENTINEL_METADATA_CACHE_INTERVAL'] = 0
+        return settings
+
+    def setUp(self):
+        super(TestMetadataCache, self).setUp()
+        self.queries = []
+        find_one = data._find_one
+
+        def count(collection, operation, spec, projection=None):
+            self.queries.append(collection.name)
+            return find_one(collection, operation, spec, projection)
+        data._find_one = count
+        self.find_one = find_one
+
+    def tearDown(self):
+        data._find_one = self.find_one
+        super(TestMetadataCache, self).tearDown()
+
+    def test_warm(self):
+        metadata_cache.warm(Storage.all_clients)
+        self.assertEqual(Storage.get_client(self.clientid).client_id,
+                         self.clientid)
+        self.assertEqual(self.queries, [])
+
+    def test_token_requests(self):
+        self.get_token()
+        self.get_token()
+        self.assertEqual(self.queries.count('clients'), 1)
+        self.assertTrue(metadata_cache.stats()['hits'] > 1)
+
+    def test_version_bumped(self):
+        Storage.get_client(self.clientid)
+        mongo.db.clients.update({'client_id': self.clientid},
+                                {'$set': {'client_type': 'confidential'}})
+        self.assertEqual(Storage.get_client(self.clientid).client_type,
+                         'public')
+
+        # another process updated the client.
+        redis.incr(CLIENTS_VERSION_KEY)
+        self.assertEqual(Storage.get_client(self.clientid).client_type,
+                         'confidential')
+
+    def test_users(self):
+        son = self.get_token()
+        mongo.db.tokens.update({}, {'$set': {'user': None}})
+        for n in range(2):
+            token = Storage.get_token(refresh_token=son['refresh_token'])
+            self.assertEqual(token.user.username, self.username)
+            self.assertIsNone(token.user.hashpw)
+        self.assertEqual(self.queries.count('users'), 2)
+
+        # updates reach the cache, and the tokens, at once.
+        Storage.update_user(self.user.id, username='renamed')
+        token = Storage.get_token(refresh_token=son['refresh_token'])
+        self.assertEqual(token.user.username, 'renamed')
+
+    def test_stale_generation(self):
+        generation = metadata_cache.generation
+        metadata_cache.bump(clients=True)
+        metadata_cache.set_client(Client(client_id='old'), generation)
+        self.assertIsNone(metadata_cache.get_client('old'))
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestTokenReuse(TestBase):
+    def settings(self):
+        settings = super(TestTokenReuse, self).settings()
+        settings['SENTINEL_TOKEN_REUSE_MIN_TTL'] = 600
+        settings['SENTINEL_REVOKE_URL'] = '/testrevoke'
+        settings['SENTINEL_REVOKE_FLUSH_INTERVAL'] = 0
+        return settings
+
+    def tearDown(self):
+        redis.delete(PAIR_KEY % (self.clientid, self.user.id))
+        super(TestTokenReuse, self).tearDown()
+
+    def test_reuse(self):
+        son = self.get_token()
+        doc = mongo.db.tokens.find_one()
+        keys = redis.dbsize()
+
+        compare = self.get_token()
+        self.assertEqual(compare['access_token'], son['access_token'])
+        self.assertEqual(compare['refresh_token'], son['refresh_token'])
+        self.assertEqual(compare['token_type'], son['token_type'])
+        self.assertTrue(990 < compare['expires_in'] <= 999)
+        # nothing was written.
+        self.assertEqual(mongo.db.tokens.find_one(), doc)
+        self.assertEqual(redis.dbsize(), keys)
+        self.assertEqual((token_reuse.issued, token_reuse.reused), (1, 1))
+
+    def test_min_ttl(self):
+        son = self.get_token()
+        token_reuse.min_ttl = 999
+        compare = self.get_token()
+        self.assertNotEqual(compare['access_token'], son['access_token'])
+        self.assertEqual(mongo.db.tokens.count(), 1)
+        self.assertEqual(token_reuse.reused, 0)
+
+    def test_revoked(self):
+        son = self.get_token()
+        r = self.test_client.post('/testauth/testrevoke', data={
+            'client_id': self.clientid, 'token': son['access_token']})
+        self.assert200(r.status_code)
+        compare = self.get_token()
+        self.assertNotEqual(compare['access_token'], son['access_token'])
+
+    def test_racing_grants(self):
+        self.sentinel.ensure_indexes()
+        writes = data._writes
+        blocked, release = threading.Event(), threading.Event()
+
+        class Blocking(object):
+            """ Holds the first token write until released. """
+            def __init__(self, collection):
+                self.collection = collection
+
+            def __getattr__(self, name):
+                return getattr(self.collection, name)
+
+            def find_and_modify(self, *args, **kwargs):
+                if not blocked.is_set():
+                    blocked.set()
+                    release.wait()
+                return self.collection.find_and_modify(*args, **kwargs)
+        data._writes = lambda collection: Blocking(writes(collection))
+
+        def grant(access_token):
+            request = _Request(self.clientapp, self.user)
+            request.grant_type = 'password'
+            with self.app.app_context():
+                Storage.save_token(
+                    {'token_type': 'Bearer', 'access_token': access_token,
+                     'refresh_token': access_token + 'r', 'scope': '',
+                     'expires_in': 999},
+                    request)
+
+        try:
+            # b looks for a token before a is remembered, and is remembered
+            # after it, but is replaced by a.
+            first = threading.Thread(target=grant, args=('a',))
+            first.start()
+            self.assertTrue(blocked.wait(5))
+            token_reuse.reuse = lambda token, request: False
+            grant('b')
+            release.set()
+            first.join()
+        finally:
+            data._writes = writes
+            token_reuse.__dict__.pop('reuse', None)
+        self.assertEqual(mongo.db.tokens.find_one()['access_token'], 'a')
+
+        son = self.get_token()
+        self.assertNotEqual(son['access_token'], 'b')
+        headers = [('Authorization', 'Bearer %s' % son['access_token'])]
+        r = self.test_client.get(self.auth_endpoint, headers=headers)
+        self.assert200(r.status_code)
+        self.assertEqual(token_reuse.reused, 0)
+
+    def test_refresh_grant(self):
+        son = self.get_token()
+        token = {'scope': son.get('scope')}
+        request = _Request(self.clientapp, self.user)
+        request.grant_type = 'refresh_token'
+        self.assertFalse(token_reuse.reuse(token, request))
+        request.grant_type = 'password'
+        self.assertTrue(token_reuse.reuse(token, request))
+        self.assertEqual(token['access_token'], son['access_token'])
+
+
+@unittest.skipIf(is_redis_available() is False, "redis server unavailable")
+class TestCoalescing(TestBase):
+    def settings(self):
+        settings = super(TestCoalescing, self).settings()
+        settings['SECRET_KEY'] = 'secret'
+        settings['SENTINEL_COALESCE'] = 'process'
+        return settings
+
+    def tearDown(self):
+        hasher._hashpw = bcrypt.hashpw
+        Storage.backend.__dict__.pop('save_token', None)
+        for key in list(redis.scan_iter('{sentinel:flight:*')):
+            redis.delete(key)
+        super(TestCoalescing, self).tearDown()
+
+    def key(self, password):
+        return coalescer.key(self.clientid, None, self.username, password,
+                             None)
+
+    def test_single_flight(self):
+        hashes, writes = [], []
+
+        def hashpw(password, salt):
+            hashes.append(password)
+            time.sleep(0.5)
+            return bcrypt.hashpw(password, salt)
+        hasher._hashpw = hashpw
+
+        save_token = Storage.backend.save_token
+
+        def counted_save_token(*args, **kwargs):
+            writes.append(args)
+            return save_token(*args, **kwargs)
+        Storage.backend.save_token = counted_save_token
+
+        query = self.url % (self.clientid, self.username, self.pw)
+        responses = []
+
+        def grant():
+            responses.append(self.app.test_client().post(query))
+
+        threads = [threading.Thread(target=grant) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([r.status_code for r in responses], [200] * 8)
+        tokens = set(json.loads(r.get_data(as_text=True))['access_token']
+                     for r in responses)
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual((len(hashes), len(writes)), (1, 1))
+        self.assertEqual(coalescer.coalesced, 7)
+
+    def test_key(self):
+        self.assertEqual(self.key(self.pw), self.key(self.pw))
+        self.assertNotEqual(self.key(self.pw), self.key('other'))
+        self.assertNotIn(self.pw, self.key(self.pw))
+
+    def test_failed_flight(self):
+        def work():
+            raise ValueError()
+        self.assertRaises(ValueError, coalescer.run, 'key', work)
+        self.assertEqual(coalescer.run('key', lambda: 'done'), 'done')
+        self.assertEqual(coalescer.coalesced, 0)
+
+    def other_process(self):
+        """ Returns a coalescer sharing grants with this process through
+            redis only, like the one of another process.
+        """
+        self.app.config['SENTINEL_COALESCE'] = 'redis'
+        coalescer.init_app(Config(self.app), redis)
+        other = Coalescer()
+        other.init_app(Config(self.app), redis)
+        return other
+
+    def test_other_process(self):
+        other = self.other_process()
+        key = self.key(self.pw)
+        release = threading.Event()
+
+        def hashpw(password, salt):
+            release.wait()
+            return bcrypt.hashpw(password, salt)
+        hasher._hashpw = hashpw
+
+        responses, results, calls = [], [], []
+        leader = threading.Thread(target=lambda: responses.append(
+            self.app.test_client().post(self.url % (
+                self.clientid, self.username, self.pw))))
+        leader.start()
+        while not redis.exists(FLIGHT_KEY % key):
+            time.sleep(0.01)
+        follower = threading.Thread(target=lambda: results.append(
+            other.run(key, lambda: calls.append(1))))
+        follower.start()
+        time.sleep(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assert200(responses[0].status_code)
+        body, status, headers = results[0]
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['access_token'],
+                         json.loads(responses[0].get_data(
+                             as_text=True))['access_token'])
+        self.assertEqual(calls, [])
+        self.assertEqual(other.coalesced, 1)
+        self.assertEqual(mongo.db.tokens.count(), 1)
+
+    def test_other_process_failed(self):
+        other = self.other_process()
+        release = threading.Event()
+
+        def work():
+            release.wait()
+            raise ValueError()
+        leader = threading.Thread(target=lambda: self.assertRaises(
+            ValueError, coalescer.run, 'key', work))
+        leader.start()
+        while not redis.exists(FLIGHT_KEY % 'key'):
+            time.sleep(0.01)
+        results = []
+        follower = threading.Thread(target=lambda: results.append(
+            other.run('key', lambda: 'done')))
+        follower.start()
+        started = time.time()
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, ['done'])
+        self.assertLess(time.time() - started, coalescer.timeout)
+        self.assertEqual(other.coalesced, 0)
+
+    def test_leader_releases_lock(self):
+        self.other_process()
+        self.get_token()
+        self.assertFalse(redis.exists(FLIGHT_KEY % self.key(self.pw)))
+
+    def test_configuration(self):
+        self.app.config['SENTINEL_COALESCE'] = 'cluster'
+        self.assertRaises(ValueError, Coalescer().init_app, Config(self.app),
+                          redis)
+        self.app.config['SENTINEL_COALESCE'] = 'redis'
+        self.app.secret_key = None
+        self.assertRaises(ValueError, Coalescer().init_app, Config(self.app),
+                          redis)
+
+
+class TestSerializers(unittest.TestCase):
+    def test_to_json(self):
+        client = Client(id='id', client_id='client', client_type='public')
+        self.assertEqual(_to_json(client), {
+            '_id': 'id',
+            'client_id': 'client',
+            'client_type': 'public',
+            'allowed_grant_types': ['password'],
+            'default_redirect_uri': '',
+            'default_scopes': [],
+        })
+        self.assertFalse('_id' in _to_json(Client()))
+
+    def test_from_json(self):
+        expires = datetime.utcnow()
+        token = _from_json({'_id': 'id', 'access_token': 'access',
+                            'expires': expires, 'unknown': 'value',
+                            'allowed_grant_types': []}, Token)
+        self.assertIsInstance(token, Token)
+        self.assertEqual(token.id, 'id')
+        self.assertEqual(token.access_token, 'access')
+        self.assertEqual(token.expires, expires)
+        self.assertIsNone(token.refresh_token)
+
+        users = _from_json([{'username': 'a'}, {'username': 'b'}], User,
+                           as_list=True)
+        self.assertEqual([u.username for u in users], ['a', 'b'])
+        self.assertIsNone(users[0].id)
+        self.assertIsNone(_from_json(None, User))
+
+    def test_properties(self):
+        self.assertEqual(_properties(User()),
+                         ['hashpw', 'username', 'version'])
+        self.assertEqual(_properties(User(), include_id=True),
+                         ['hashpw', 'id', 'username', 'version'])
+
+
+class TestModels(unittest.TestCase):
+    def test_slots(self):
+        for model in (User(), Client(), Token()):
+            self.assertFalse(hasattr(model, '__dict__'))
+            self.assertRaises(AttributeError, setattr, model, 'notreally',
+                              None)
+
+    def test_expires(self):
+        class UTC(tzinfo):
+            def utcoffset(self, dt):
+                return timedelta(0)
+
+        expires = datetime(2015, 1, 1, tzinfo=UTC())
+        token = Token(expires=expires)
+        self.assertIsNone(token.expires.tzinfo)
+        self.assertEqual(token.expires, datetime(2015, 1, 1))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    flask-sentinel.topology
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2015 by Nicola Iarocci.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+
+from redis import StrictRedis
+from redis.connection import ConnectionPool
+from redis.exceptions import RedisError
+
+
+def _missing(value):
+    """ Whether a read came back empty, in full or in part. """
+    return value is None or value == {} or \
+        (isinstance(value, list) and None in value)
+
+
+class RedisClient(object):
+    """ Redis connection of the storage layer. Commands go to the primary,
+        except for the token lookups made while validating, which may go to
+        a replica, see :meth:`read`.
+
+    The primary is a single server (``SENTINEL_REDIS_URL``), the current
+    master of a Redis Sentinel service (``SENTINEL_REDIS_SENTINELS``), or a
+    Redis Cluster (``SENTINEL_REDIS_CLUSTER``). With a cluster, pipelines
+    are never transactions, since their keys live on different nodes.
+
+    A replica which cannot be reached is skipped for `retry_interval`
+    seconds. One which is disconnected from its master, or has not heard
+    from it for more than `max_lag` seconds, is skipped until it catches up.
+    Reads which miss on a replica are retried on the primary, as the token
+    may have been issued moments ago.
+    """
+    def __init__(self):
+        self.primary = StrictRedis()
+        self.replica = None
+        self.cluster = False
+        self.max_lag = 10
+        self.retry_interval = 5
+        self.check_interval = 1
+
+        self.replica_reads = 0
+        self.replica_fallbacks = 0
+
+        self._app = None
+        self._down_until = 0
+        self._checked_until = 0
+        self._stale = False
+
+    def init_app(self, config):
+        url = config.value('REDIS_URL')
+        options = config.value('REDIS_OPTIONS') or {}
+        sentinels = config.value('REDIS_SENTINELS')
+        replicas = config.value('REDIS_READ_FROM_REPLICAS')
+        self.cluster = bool(config.value('REDIS_CLUSTER'))
+        self.max_lag = config.value('REDIS_REPLICA_MAX_LAG')
+        self.retry_interval = config.value('REDIS_REPLICA_RETRY')
+        self.replica = None
+        self.replica_reads = self.replica_fallbacks = 0
+        self._app = config.app
+        self._down_until = self._checked_until = 0
+
+        if sentinels:
+            from redis.sentinel import Sentinel
+            service = config.value('REDIS_SERVICE_NAME')
+            sentinel = Sentinel(sentinels, **options)
+            self.primary = sentinel.master_for(service, StrictRedis)
+            if replicas:
+                # falls back to the master when no replica is available.
+                self.replica = sentinel.slave_for(service, StrictRedis)
+        elif self.cluster:
+            from redis.cluster import RedisCluster
+            self.primary = RedisCluster.from_url(url, **options)
+            if replicas:
+                self.replica = RedisCluster.from_url(
+                    url, read_from_replicas=True, **options)
+        else:
+            self.primary = StrictRedis()
+            self.primary.connection_pool = ConnectionPool.from_url(url,
+                                                                   **options)
+            if replicas:
+                replica_url = config.value('REDIS_REPLICA_URL')
+                if not replica_url:
+                    raise ValueError('SENTINEL_REDIS_REPLICA_URL is required '
+                                     'to read from replicas.')
+                self.replica = StrictRedis()
+                self.replica.connection_pool = ConnectionPool.from_url(
+                    replica_url, **options)
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        if self.cluster:
+            return self.primary.pipeline()
+        return self.primary.pipeline(transaction, shard_hint)
+
+    def mget(self, keys, *args):
+        return self._command(self.primary, 'mget')(keys, *args)
+
+    def read(self, command, *args):
+        """ Runs a read-only command on a usable replica, if any, and on the
+            primary otherwise.
+        """
+        replica = self._usable_replica()
+        if replica is not None:
+            try:
+                value = self._command(replica, command)(*args)
+            except RedisError as e:
+                self._replica_failed(e)
+            else:
+                if not _missing(value):
+                    self.replica_reads += 1
+                    return value
+            self.replica_fallbacks += 1
+        return self._command(self.primary, command)(*args)
+
+    def stats(self):
+        return {
+            'replica_reads': self.replica_reads,
+            'replica_fallbacks': self.replica_fallbacks,
+        }
+
+    def _command(self, client, command):
+        if command == 'mget' and self.cluster:
+            # keys are spread over the cluster slots.
+            command = 'mget_nonatomic'
+        return getattr(client, command)
+
+    def _usable_replica(self):
+        if self.replica is None:
+            return None
+        now = time.time()
+        if now < self._down_until:
+            return None
+        if now >= self._checked_until and not self.cluster:
+            # cluster replicas are watched by the cluster itself.
+            try:
+                info = self.replica.info('replication')
+            except RedisError as e:
+                self._replica_failed(e)
+                return None
+            self._stale = info.get('role') == 'slave' and (
+                info.get('master_link_status') != 'up' or
+                info.get('master_last_io_seconds_ago', 0) > self.max_lag)
+            self._checked_until = now + self.check_interval
+        return None if self._stale else self.replica
+
+    def _replica_failed(self, error):
+        self._down_until = time.time() + self.retry_interval
+        if self._app is not None:
+            self._app.logger.warning(
+                'Redis replica unavailable for %s seconds: %s',
+                self.retry_interval, error)
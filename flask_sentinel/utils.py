@@ -6,6 +6,8 @@
     :copyright: (c) 2015 by Nicola Iarocci.
     :license: BSD, see LICENSE for more details.
 """
+from .indexes import EXPIRED_TOKEN_TTL
+from .metrics import BUCKETS
 
 
 class Config(object):
@@ -13,12 +15,65 @@ class Config(object):
         self.prefix = 'SENTINEL'
         self.app = app
 
+        app.config.setdefault(self._key('BACKEND'), 'mongo')
         app.config.setdefault(self._key('MONGO_DBNAME'), 'oauth')
+        app.config.setdefault(self._key('MONGO_READ_PREFERENCES'), None)
+        app.config.setdefault(self._key('MONGO_READ_CONCERNS'), None)
+        app.config.setdefault(self._key('MONGO_MAX_STALENESS'), None)
         app.config.setdefault(self._key('ROUTE_PREFIX'), '/oauth')
         app.config.setdefault(self._key('TOKEN_URL'), '/token')
+        app.config.setdefault(self._key('RATE_LIMITS'), None)
+        app.config.setdefault(self._key('REVOKE_URL'), '/revoke')
+        app.config.setdefault(self._key('REVOKE_FLUSH_INTERVAL'), 1)
+        app.config.setdefault(self._key('REVOKE_BATCH_SIZE'), 500)
+        app.config.setdefault(self._key('INTROSPECT_URL'), '/introspect')
+        app.config.setdefault(self._key('INTROSPECT_BATCH_URL'),
+                              '/introspect/batch')
+        app.config.setdefault(self._key('INTROSPECT_BATCH_SIZE'), 100)
+        app.config.setdefault(self._key('INTROSPECT_MAX_AGE'), 60)
         app.config.setdefault(self._key('MANAGEMENT_URL'), '/management')
+        app.config.setdefault(self._key('METRICS'), False)
+        app.config.setdefault(self._key('METRICS_URL'), '/metrics')
+        app.config.setdefault(self._key('METRICS_BUCKETS'), BUCKETS)
+        app.config.setdefault(self._key('MANAGEMENT_PAGE_SIZE'), 50)
         app.config.setdefault(self._key('REDIS_URL'),
                               'redis://localhost:6379/0')
+        app.config.setdefault(self._key('REDIS_OPTIONS'), None)
+        app.config.setdefault(self._key('REDIS_SENTINELS'), None)
+        app.config.setdefault(self._key('REDIS_SERVICE_NAME'), 'mymaster')
+        app.config.setdefault(self._key('REDIS_CLUSTER'), False)
+        app.config.setdefault(self._key('REDIS_READ_FROM_REPLICAS'), False)
+        app.config.setdefault(self._key('REDIS_REPLICA_URL'), None)
+        app.config.setdefault(self._key('REDIS_REPLICA_MAX_LAG'), 10)
+        app.config.setdefault(self._key('REDIS_REPLICA_RETRY'), 5)
+        app.config.setdefault(self._key('WRITE_CONCERN'), None)
+        app.config.setdefault(self._key('WRITE_JOURNAL'), None)
+        app.config.setdefault(self._key('TOKEN_SIGNING'), False)
+        app.config.setdefault(self._key('SIGNING_KEYS'), None)
+        app.config.setdefault(self._key('SIGNING_KEY_ID'), None)
+        app.config.setdefault(self._key('ENSURE_INDEXES'), False)
+        app.config.setdefault(self._key('EXPIRED_TOKEN_TTL'),
+                              EXPIRED_TOKEN_TTL)
+        app.config.setdefault(self._key('BCRYPT_WORKERS'), 0)
+        app.config.setdefault(self._key('BCRYPT_QUEUE_SIZE'), 16)
+        app.config.setdefault(self._key('BCRYPT_TIMEOUT'), 5)
+        app.config.setdefault(self._key('BCRYPT_RETRY_AFTER'), 1)
+        app.config.setdefault(self._key('TOKEN_CACHE'), False)
+        app.config.setdefault(self._key('TOKEN_CACHE_SIZE'), 1024)
+        app.config.setdefault(self._key('TOKEN_CACHE_TTL'), 60)
+        app.config.setdefault(self._key('TOKEN_CACHE_CHANNEL'),
+                              'sentinel:invalidate')
+        app.config.setdefault(self._key('TOKEN_REUSE_MIN_TTL'), None)
+        app.config.setdefault(self._key('COALESCE'), None)
+        app.config.setdefault(self._key('COALESCE_TIMEOUT'), 5)
+        app.config.setdefault(self._key('METADATA_CACHE'), False)
+        app.config.setdefault(self._key('METADATA_CACHE_SIZE'), 10000)
+        app.config.setdefault(self._key('METADATA_CACHE_INTERVAL'), 1)
+        app.config.setdefault(self._key('METADATA_CHANGE_STREAM'), False)
+        app.config.setdefault(self._key('NEGATIVE_CACHE_TTL'), None)
+        app.config.setdefault(self._key('FILTER'), None)
+        app.config.setdefault(self._key('FILTER_CAPACITY'), 1000000)
+        app.config.setdefault(self._key('FILTER_ERROR_RATE'), 0.001)
 
     def url_rule_for(self, _key):
         return '%s%s' % (self.value('ROUTE_PREFIX'), self.value(_key))
@@ -8,7 +8,9 @@
 """
 from flask_oauthlib.provider import OAuth2RequestValidator
 
+from .core import signer
 from .data import Storage
+from .models import Client
 
 
 class MyRequestValidator(OAuth2RequestValidator):
@@ -20,3 +22,43 @@ class MyRequestValidator(OAuth2RequestValidator):
         self._usergetter = Storage.get_user
         self._tokengetter = Storage.get_token
         self._tokensetter = Storage.save_token
+
+    def validate_bearer_token(self, token, scopes, request):
+        """ Validates signed access tokens without any datastore lookup.
+            Other tokens are validated as usual.
+        """
+        if not signer.enabled or token.count('.') != 2:
+            return super(MyRequestValidator, self).validate_bearer_token(
+                token, scopes, request)
+
+        tok = signer.load_token(token)
+        if tok is None:
+            request.error_message = 'Bearer token not valid.'
+            return False
+
+        if scopes and not set(tok.scopes) & set(scopes):
+            request.error_message = 'Bearer token scope not valid.'
+            return False
+
+        request.access_token = tok
+        request.user = tok.user
+        request.scopes = scopes
+        # only the client id is known, the client is not loaded.
+        request.client = Client(client_id=tok.client_id)
+        return True
+
+    def revoke_token(self, token, token_type_hint, request, *args, **kwargs):
+        """ Revokes an access or refresh token issued to the requesting
+            client.
+        """
+        # request.client_id is only set when the client id is in the body,
+        # not when the client authenticates with HTTP Basic.
+        client_id = request.client.client_id if request.client else None
+        tok = None
+        if client_id:
+            tok = Storage.revoke_token(token, token_type_hint, client_id)
+        if tok is None:
+            request.error_message = 'Invalid token supplied.'
+            return False
+        request.user = tok.user
+        return True
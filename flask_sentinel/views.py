@@ -6,32 +6,326 @@
     :copyright: (c) 2015 by Nicola Iarocci.
     :license: BSD, see LICENSE for more details.
 """
-from flask import render_template, request
+import calendar
+import json
+from datetime import datetime
 
-from .core import oauth
+from flask import Response, current_app, render_template, request
+from pymongo.errors import DuplicateKeyError
+from werkzeug.urls import url_encode
+
+from .core import oauth, coalescer, hasher, limiter, lookup_filter, \
+    metadata_cache, metrics, redis, token_cache, token_reuse
 from .data import Storage
-from .basicauth import requires_basicauth
+from .basicauth import basicauth, requires_basicauth
+from .hashing import Overloaded
+from .metrics import timed
 
 
+@timed('oauthlib.token')
 @oauth.token_handler
+def _token_response(*args, **kwargs):
+    """ Returns a dictionary or None as the extra credentials for creating
+    the token response.
+    """
+    return None
+
+
+def _client_credentials():
+    """ Returns the client id and secret of the current token request. """
+    if request.values.get('client_id') or not request.authorization:
+        return (request.values.get('client_id'),
+                request.values.get('client_secret'))
+    return request.authorization.username, request.authorization.password
+
+
+def _rate_limit():
+    """ Counts the current token request against the rate limits. """
+    return limiter.hit({
+        'client_id': _client_credentials()[0],
+        'username': request.values.get('username'),
+        'remote_addr': request.remote_addr,
+    })
+
+
+def _coalesced_token_response(*args, **kwargs):
+    """ Returns the token response, shared by concurrent, identical password
+    grants.
+    """
+    values = request.values
+    key = coalescer.key(*(_client_credentials() + (
+        values.get('username'), values.get('password'), values.get('scope'))))
+
+    def work():
+        response = _token_response(*args, **kwargs)
+        return [response.get_data(as_text=True), response.status_code,
+                [[name, value] for name, value in response.headers
+                 if name != 'Content-Length']]
+
+    body, status, headers = coalescer.run(key, work)
+    return Response(body, status, [tuple(header) for header in headers])
+
+
 def access_token(*args, **kwargs):
     """ This endpoint is for exchanging/refreshing an access token.
 
-    Returns a dictionary or None as the extra credentials for creating the
-    token response.
+    Answers with a 429 status when a rate limit is exceeded, before the
+    password is hashed or anything is loaded, and with a 503 status right
+    away when the password hashing pool is saturated, instead of piling up
+    requests. Concurrent, identical password grants are answered once, see
+    ``SENTINEL_COALESCE``.
 
     :param *args: Variable length argument list.
     :param **kwargs: Arbitrary keyword arguments.
     """
-    return None
+    limit = _rate_limit() if limiter.enabled else None
+    if limit is not None and not limit.allowed:
+        return Response(json.dumps({'error': 'too_many_requests'}), 429,
+                        {'Content-Type': 'application/json',
+                         'Cache-Control': 'no-store',
+                         'Retry-After': str(limit.retry_after),
+                         'X-RateLimit-Limit': str(limit.limit),
+                         'X-RateLimit-Remaining': '0'})
+
+    coalesce = coalescer.enabled and \
+        request.values.get('grant_type') == 'password' and \
+        request.values.get('username') and request.values.get('password')
+    try:
+        if coalesce:
+            response = _coalesced_token_response(*args, **kwargs)
+        else:
+            response = _token_response(*args, **kwargs)
+    except Overloaded as e:
+        return Response(json.dumps({'error': 'temporarily_unavailable'}), 503,
+                        {'Content-Type': 'application/json',
+                         'Cache-Control': 'no-store',
+                         'Retry-After': str(e.retry_after)})
+    if limit is not None and limit.limit is not None:
+        response.headers['X-RateLimit-Limit'] = str(limit.limit)
+        response.headers['X-RateLimit-Remaining'] = str(limit.remaining)
+    return response
+
+
+@oauth.revoke_handler
+def revoke_token(*args, **kwargs):
+    """ This endpoint is for revoking an access or refresh token, as defined
+    in RFC 7009.
+
+    :param *args: Variable length argument list.
+    :param **kwargs: Arbitrary keyword arguments.
+    """
+    pass
+
+
+def _introspection(token, token_type='access_token'):
+    """ Returns the RFC 7662 introspection response of a Token, or None,
+    along with the number of seconds the response is good for.
+    """
+    if token is None or token.user is None:
+        return {'active': False}, 0
+
+    response = {
+        'active': True,
+        'client_id': token.client_id,
+        'username': token.user.username,
+        'sub': str(token.user_id),
+        'scope': ' '.join(s for s in token.scopes or () if s),
+        'token_type': token.token_type,
+    }
+    if token_type == 'refresh_token':
+        # refresh tokens are good until revoked or replaced.
+        response['token_type'] = 'refresh_token'
+        return response, 0
+
+    if token.expires is None:
+        return {'active': False}, 0
+    remaining = int((token.expires - datetime.utcnow()).total_seconds())
+    if remaining <= 0:
+        return {'active': False}, 0
+    response['exp'] = calendar.timegm(token.expires.utctimetuple())
+    return response, remaining
+
+
+def _json_response(body, status=200, max_age=0):
+    """ Returns a JSON response which can be cached for `max_age` seconds,
+    up to ``SENTINEL_INTROSPECT_MAX_AGE``.
+    """
+    max_age = min(max_age, current_app.config['SENTINEL_INTROSPECT_MAX_AGE'])
+    return Response(json.dumps(body), status,
+                    {'Content-Type': 'application/json',
+                     'Cache-Control': 'private, max-age=%d' % max_age
+                     if max_age > 0 else 'no-store'})
+
+
+@basicauth('SENTINEL_INTROSPECT', required=True)
+def introspect():
+    """ This endpoint is for resource servers to check whether an access or
+    refresh token is active, as defined in RFC 7662.
+    """
+    token = request.form.get('token')
+    if not token:
+        return _json_response({'error': 'invalid_request'}, 400)
+
+    lookups = [
+        ('access_token', lambda t: Storage.get_tokens([t])[0]),
+        ('refresh_token', lambda t: Storage.get_token(refresh_token=t)),
+    ]
+    if request.form.get('token_type_hint') == 'refresh_token':
+        lookups.reverse()
+    for token_type, lookup in lookups:
+        tok = lookup(token)
+        if tok is not None:
+            body, max_age = _introspection(tok, token_type)
+            return _json_response(body, max_age=max_age)
+    return _json_response({'active': False})
+
+
+@basicauth('SENTINEL_INTROSPECT', required=True)
+def introspect_batch():
+    """ This endpoint is for resource servers to check many access tokens at
+    once. Tokens are sent either as a JSON ``{"tokens": [...]}`` body or as
+    repeated ``token`` form fields, and the introspection responses are
+    returned in the same order, as ``{"tokens": [...]}``.
+
+    The response can be cached until the first of the active tokens expires.
+    """
+    json = request.get_json(silent=True)
+    if json is not None:
+        tokens = json.get('tokens') if isinstance(json, dict) else None
+    else:
+        tokens = request.form.getlist('token')
+    limit = current_app.config['SENTINEL_INTROSPECT_BATCH_SIZE']
+    if not isinstance(tokens, list) or not 0 < len(tokens) <= limit or \
+            not all(isinstance(t, type(u'')) for t in tokens):
+        return _json_response({'error': 'invalid_request'}, 400)
+
+    results = [_introspection(tok) for tok in Storage.get_tokens(tokens)]
+    ages = [max_age for body, max_age in results if body['active']]
+    return _json_response({'tokens': [body for body, _ in results]},
+                          max_age=min(ages) if ages else 0)
+
+
+@requires_basicauth
+def metrics_endpoint():
+    """ This endpoint exposes latency histograms and counters in the
+    Prometheus text format.
+    """
+    cache = token_cache.stats()
+    pool = hasher.stats()
+    replica = redis.stats()
+    lookups = lookup_filter.stats()
+    metadata = metadata_cache.stats()
+    counters = [
+        ('sentinel_token_cache_hits_total', 'In-process token cache hits.',
+         cache['hits']),
+        ('sentinel_token_cache_misses_total',
+         'In-process token cache misses.', cache['misses']),
+        ('sentinel_metadata_cache_hits_total',
+         'Client and user lookups served by the metadata cache.',
+         metadata['hits']),
+        ('sentinel_metadata_cache_misses_total',
+         'Client and user lookups the metadata cache could not serve.',
+         metadata['misses']),
+        ('sentinel_bcrypt_completed_total', 'Passwords hashed on the pool.',
+         pool['completed']),
+        ('sentinel_bcrypt_rejected_total',
+         'Passwords rejected by the saturated pool.', pool['rejected']),
+        ('sentinel_bcrypt_timeouts_total',
+         'Passwords which waited too long for a worker.', pool['timeouts']),
+        ('sentinel_bcrypt_wait_seconds_total',
+         'Time passwords waited for a worker.', pool['wait_time']),
+        ('sentinel_tokens_issued_total',
+         'Tokens issued while token reuse is enabled.', token_reuse.issued),
+        ('sentinel_tokens_reused_total',
+         'Password grants answered with the current token.',
+         token_reuse.reused),
+        ('sentinel_grants_coalesced_total',
+         'Password grants answered with the response of an identical one.',
+         coalescer.coalesced),
+        ('sentinel_rate_limited_total',
+         'Token requests rejected by a rate limit.', limiter.rejected),
+        ('sentinel_negative_cache_hits_total',
+         'Lookups of tokens and clients known not to exist.',
+         lookups['negative_hits']),
+        ('sentinel_filter_rejections_total',
+         'Lookups of unknown tokens and clients rejected by the filter.',
+         lookups['filtered']),
+        ('sentinel_redis_replica_reads_total',
+         'Token lookups served by a Redis replica.',
+         replica['replica_reads']),
+        ('sentinel_redis_replica_fallbacks_total',
+         'Token lookups a Redis replica could not serve.',
+         replica['replica_fallbacks']),
+    ]
+    gauges = [
+        ('sentinel_token_cache_size', 'Tokens in the in-process cache.',
+         cache['size']),
+        ('sentinel_bcrypt_busy', 'Passwords being hashed.', pool['busy']),
+        ('sentinel_bcrypt_queue_depth', 'Passwords waiting for a worker.',
+         pool['depth']),
+        ('sentinel_filter_bytes', 'Memory used by the lookup filter.',
+         lookups['bytes']),
+        ('sentinel_filter_fill_ratio', 'Share of the filter bits set.',
+         lookups['fill']),
+        ('sentinel_filter_false_positive_rate',
+         'Estimated false positive rate of the lookup filter.',
+         lookups['false_positive_rate']),
+    ]
+    return Response(metrics.render(counters, gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def _page_url(**params):
+    """ Returns the current url with its query string updated by `params`.
+    """
+    args = request.args.to_dict()
+    args.update(params)
+    return '%s?%s' % (request.path, url_encode(args))
 
 
 @requires_basicauth
 def management():
-    """ This endpoint is for vieweing and adding users and clients. """
+    """ This endpoint is for vieweing and adding users and clients.
+
+    Users and clients are paginated and can be searched by username and
+    client_id prefix. Taken usernames are refused with a 409 status, and
+    users are not added, with a 503 status, while the password hashing pool
+    is saturated.
+    """
+    status, headers, user_error = 200, {}, None
     if request.method == 'POST' and request.form['submit'] == 'Add User':
-        Storage.save_user(request.form['username'], request.form['password'])
+        username = request.form['username']
+        try:
+            Storage.save_user(username, request.form['password'])
+        except (DuplicateKeyError, ValueError):
+            status = 409
+            user_error = 'User %s already exists.' % username
+        except Overloaded as e:
+            status, headers = 503, {'Retry-After': str(e.retry_after)}
+            user_error = 'User %s was not added, please retry later.' % \
+                username
     if request.method == 'POST' and request.form['submit'] == 'Add Client':
         Storage.generate_client()
-    return render_template('management.html', users=Storage.all_users(),
-                           clients=Storage.all_clients())
+
+    limit = current_app.config['SENTINEL_MANAGEMENT_PAGE_SIZE']
+    user_prefix = request.args.get('user_prefix')
+    client_prefix = request.args.get('client_prefix')
+
+    users, next_user = Storage.users_page(
+        request.args.get('user_after'), user_prefix, limit)
+    clients, next_client = Storage.clients_page(
+        request.args.get('client_after'), client_prefix, limit)
+
+    return render_template(
+        'management.html',
+        user_error=user_error,
+        users=users,
+        clients=clients,
+        user_count=Storage.count_users(user_prefix),
+        client_count=Storage.count_clients(client_prefix),
+        user_prefix=user_prefix or '',
+        client_prefix=client_prefix or '',
+        next_users_url=_page_url(user_after=next_user) if next_user else None,
+        next_clients_url=(_page_url(client_after=next_client)
+                          if next_client else None),
+    ), status, headers
@@ -10,7 +10,8 @@ install_requires = [
     'Flask-PyMongo',
     'bcrypt',
     'pyOpenSSL',
-    'redis',
+    'pymongo<4',
+    'redis>=3.5',
 ]
 
 
@@ -28,6 +29,16 @@ setup(
     package_data={'flask_sentinel': ['templates/*']},
     test_suite="flask.ext.sentinel.tests",
     install_requires=install_requires,
+    extras_require={
+        'asyncio': ['motor<3', 'redis>=4.2'],
+    },
+    entry_points={
+        'console_scripts': [
+            'sentinel-indexes = flask_sentinel.indexes:main',
+            'sentinel-import = flask_sentinel.bulk:main',
+            'sentinel-migrate = flask_sentinel.migrations:main',
+        ],
+    },
     tests_require=['redis'],
     classifiers=[
         'Development Status :: 3 - Alpha',